@@ -1,9 +1,12 @@
 import cv2
+import time
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
 from utils import Utils
+from early_stopping import EarlyStopping
+from async_writer import AsyncWriter
 try:
   from conv_nets.vgg19 import VGG19
 except ImportError: #gcloud
@@ -30,7 +33,16 @@ class StyleTransfer():
       gamma=0.03,
       learning_rate=2,
       num_iters=2000,
-      output_img_init='random'):
+      optimizer='adam',
+      target_loss=None,
+      stop_rel_tol=None,
+      stop_window=100,
+      stop_max_time=None,
+      stop_min_iters=0,
+      log_interval=1.0,
+      output_img_init='random',
+      freeze_content=True,
+      batch_size=1):
     self.model_name = model_name
     self.tensorflow_model_path = tensorflow_model_path
 
@@ -53,8 +65,23 @@ class StyleTransfer():
 
     self.learning_rate = learning_rate
     self.num_iters = num_iters
+    self.optimizer = optimizer
+    self.target_loss = target_loss
+
+    self.stop_rel_tol = stop_rel_tol
+    self.stop_window = stop_window
+    self.stop_max_time = stop_max_time
+    self.stop_min_iters = stop_min_iters
+
+    # seconds between two loss lines
+    self.log_interval = log_interval
+    self.last_log_time = 0.0
 
     self.output_img_init = output_img_init
+    self.freeze_content = freeze_content
+
+    # number of content/style pairs optimized together in one graph
+    self.batch_size = batch_size
 
   def _get_content_loss(self, content_layer, noise_layer):
     content_loss = tf.constant(0.0)
@@ -72,33 +99,138 @@ class StyleTransfer():
 
     return content_loss
 
-  def _get_style_loss(self, style_layer, noise_layer):
-    style_loss = tf.constant(0.0)
+  def _get_gram_matrix(self, layer):
+    # one gram per sample, [N, C, C]
+    channels_matrix = tf.reshape(layer, [tf.shape(layer)[0],
+                                         -1,
+                                         tf.shape(layer)[3]])
+    gram_matrix = tf.matmul(channels_matrix, channels_matrix, transpose_a=True)
 
-    channels_matrix_style_img = tf.reshape(style_layer,
-                                           [-1, tf.shape(style_layer)[3]])
-    channels_matrix_noise_img = tf.reshape(noise_layer,
-                                           [-1, tf.shape(noise_layer)[3]])
+    return gram_matrix
 
-    gram_matrix_style = tf.matmul(tf.transpose(channels_matrix_style_img),
-                                  channels_matrix_style_img)
-    gram_matrix_noise = tf.matmul(tf.transpose(channels_matrix_noise_img),
-                                  channels_matrix_noise_img)
+  def _get_style_loss(self, gram_matrix_style, style_layer_shape, noise_layer):
+    style_loss = tf.constant(0.0)
+
+    gram_matrix_noise = self._get_gram_matrix(noise_layer)
 
     El = tf.reduce_sum(tf.square(gram_matrix_style - gram_matrix_noise))
     El = tf.scalar_mul(1.0 / (4.0
-                       * tf.square(tf.cast(tf.shape(style_layer)[1],
-                                           tf.float32))
-                       * tf.square(tf.cast(tf.shape(style_layer)[2],
-                                           tf.float32))
-                       * tf.square(tf.cast(tf.shape(style_layer)[3],
-                                           tf.float32))),
+                       * float(style_layer_shape[1]) ** 2
+                       * float(style_layer_shape[2]) ** 2
+                       * float(style_layer_shape[3]) ** 2),
                        El)
 
     style_loss = style_loss + El
 
     return style_loss
 
+  def _load_style_grams(self, sess, ut, style_img_bytes, style_img, cache_path):
+    style_grams = {style_layer_name: [] for style_layer_name in self.style_layers}
+    for n in range(self.batch_size):
+      key = ut.get_cache_key(style_img_bytes[n],
+                             self.style_img_height,
+                             self.style_img_width,
+                             self.style_layers,
+                             self.tensorflow_model_path)
+      img_style_grams = ut.load_cache(cache_path, key)
+      if img_style_grams is None:
+        img_style_grams = sess.run(self.style_grams,
+                                   feed_dict={self.style_img: style_img[n:n + 1]})
+        img_style_grams = {k: v[0] for k, v in img_style_grams.items()}
+        ut.save_cache(cache_path, key, img_style_grams)
+
+      for style_layer_name in self.style_layers:
+        style_grams[style_layer_name].append(img_style_grams[style_layer_name])
+
+    for style_layer_name, style_gram in self.style_grams_var.items():
+      style_gram.load(np.stack(style_grams[style_layer_name]), sess)
+
+  def _load_content_targets(self, sess, content_img):
+    content_targets = sess.run(self.content_targets,
+                               feed_dict={self.content_img: content_img})
+
+    for content_layer_name, content_target in self.content_targets_var.items():
+      content_target.load(content_targets[content_layer_name], sess)
+
+  def _get_img_paths(self, img_path):
+    img_paths = img_path if isinstance(img_path, list) else [img_path]
+    if len(img_paths) == 1:
+      img_paths = img_paths * self.batch_size
+    if len(img_paths) != self.batch_size:
+      raise ValueError('Expected 1 or %d image paths, got %d'
+                       % (self.batch_size, len(img_paths)))
+
+    return img_paths
+
+  def _read_imgs(self, sess, ut, img_paths, height, width, channels):
+    imgs_bytes = []
+    imgs = []
+    for img_path in img_paths:
+      img_bytes = sess.run(self.file_bytes,
+          feed_dict={self.name_file: img_path})
+      img_np = np.fromstring(img_bytes, np.uint8)
+      imgs_bytes.append(img_bytes)
+      imgs.append(np.reshape(ut.get_img(img_np,
+                                        width=width,
+                                        height=height),
+                             (height, width, channels)))
+
+    return imgs_bytes, np.array(imgs).astype(np.float32)
+
+  def _log_step(self, i, content_loss, style_loss, tv_loss, out_loss,
+                start_time):
+    if time.time() - self.last_log_time >= self.log_interval:
+      self.last_log_time = time.time()
+      print('it %d: content %g, style %g, tv %g, total %g'
+            % (i, content_loss, style_loss, tv_loss, out_loss))
+
+    self._log_target_loss(i, out_loss, start_time)
+
+  def _log_target_loss(self, i, out_loss, start_time):
+    if self.target_loss is None or self.target_evals is not None:
+      return
+
+    if out_loss <= self.target_loss:
+      self.target_evals = i + 1
+      print('Target loss %f reached after %d evaluations in %.2f s'
+            % (self.target_loss, self.target_evals, time.time() - start_time))
+
+  def _save_snapshot(self, sess, ut, writer, summ, feed_dict,
+                     i, out_img, output_img_path, show_img, s=None):
+    for n in range(self.batch_size):
+      decoded_img = ut.denormalize_img(out_img[n])
+      img_name = 'img' + str(i) if self.batch_size == 1 \
+                 else 'img' + str(i) + '_' + str(n)
+      self.async_writer.write_img(output_img_path + '/' + img_name + '.png',
+                                  decoded_img)
+
+      if show_img:
+        plt.axis("off")
+        plt.imshow(cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB))
+        plt.show()
+
+    if s is None:
+      s = sess.run(summ, feed_dict=feed_dict)
+    writer.add_summary(s, i)
+    writer.add_summary(self.async_writer.get_summary(), i)
+
+  def _warp_img(self, ut, img, prev_content_img, content_img):
+    # backward warp: the flow goes from the current frame to the previous
+    # one, so every output pixel samples the previous stylized frame
+    prev_gray = cv2.cvtColor(ut.denormalize_img(prev_content_img),
+                             cv2.COLOR_BGR2GRAY)
+    gray = cv2.cvtColor(ut.denormalize_img(content_img), cv2.COLOR_BGR2GRAY)
+    flow = cv2.calcOpticalFlowFarneback(gray, prev_gray, None,
+                                        0.5, 3, 15, 3, 5, 1.2, 0)
+
+    map_x, map_y = np.meshgrid(np.arange(flow.shape[1]),
+                               np.arange(flow.shape[0]))
+    return cv2.remap(img,
+                     (map_x + flow[:, :, 0]).astype(np.float32),
+                     (map_y + flow[:, :, 1]).astype(np.float32),
+                     cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_REPLICATE)
+
   def _get_total_variation_loss(self, noise_img):
     tv_loss = tf.reduce_sum(tf.image.total_variation(noise_img))
 
@@ -115,7 +247,8 @@ class StyleTransfer():
     self.style_img = tf.placeholder(tf.float32, [None, self.style_img_height,
                 self.style_img_width, self.style_img_channels])
 
-    self.noise_img_init = tf.placeholder(tf.float32, [1, self.noise_img_height,
+    self.noise_img_init = tf.placeholder(tf.float32, [self.batch_size,
+                self.noise_img_height,
                 self.noise_img_width, self.noise_img_channels])
 
     if self.output_img_init == 'content':
@@ -124,7 +257,7 @@ class StyleTransfer():
     elif self.output_img_init == 'random':
       # xavier init
       self.noise_img = tf.get_variable(name='output_image',
-                                       shape=[1,
+                                       shape=[self.batch_size,
                                               self.noise_img_height,
                                               self.noise_img_width,
                                               self.noise_img_channels],
@@ -132,20 +265,55 @@ class StyleTransfer():
 
     self.total_variation_loss = self._get_total_variation_loss(self.noise_img)
 
+    content_layers = self.model.run_layers(self.content_img, self.content_layers)
+    style_layers = self.model.run_layers(self.style_img, self.style_layers)
+    noise_layers = self.model.run_layers(self.noise_img,
+                                         self.content_layers + self.style_layers)
+
+    # with freeze_content the content features are evaluated once in train
+    # and kept in local variables, so a step only runs the output image
+    self.content_targets = {}
+    self.content_targets_var = {}
     self.content_loss = tf.constant(0.0)
     for content_layer_name in self.content_layers:
-      content_layer = self.model.run(self.content_img, content_layer_name)
-      noise_layer = self.model.run(self.noise_img, content_layer_name)
+      content_layer = content_layers[content_layer_name]
+      noise_layer = noise_layers[content_layer_name]
+      if self.freeze_content:
+        self.content_targets[content_layer_name] = content_layer
+        self.content_targets_var[content_layer_name] = tf.get_variable(
+            name='content_target_' + content_layer_name,
+            shape=[self.batch_size] + content_layer.get_shape().as_list()[1:],
+            initializer=tf.zeros_initializer(),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        content_layer = self.content_targets_var[content_layer_name]
       self.content_loss = self.content_loss \
                           + self._get_content_loss(content_layer, noise_layer)
 
+    # the style image never changes, its grams are evaluated once in train
+    # and kept in local (non-checkpointed) variables
+    self.style_grams = {}
+    self.style_grams_var = {}
     self.style_loss = tf.constant(0.0)
     for i, style_layer_name in enumerate(self.style_layers):
-      style_layer = self.model.run(self.style_img, style_layer_name)
-      noise_layer = self.model.run(self.noise_img, style_layer_name)
+      style_layer = style_layers[style_layer_name]
+      noise_layer = noise_layers[style_layer_name]
+      style_layer_shape = style_layer.get_shape().as_list()
+
+      self.style_grams[style_layer_name] = self._get_gram_matrix(style_layer)
+      self.style_grams_var[style_layer_name] = tf.get_variable(
+          name='style_gram_' + style_layer_name,
+          shape=[self.batch_size, style_layer_shape[3], style_layer_shape[3]],
+          initializer=tf.zeros_initializer(),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
       self.style_loss = self.style_loss \
                           + tf.scalar_mul(self.style_layers_w[i],
-                                self._get_style_loss(style_layer, noise_layer))
+                                self._get_style_loss(
+                                    self.style_grams_var[style_layer_name],
+                                    style_layer_shape,
+                                    noise_layer))
 
     if self.gamma == 0.0:
       self.total_loss = self.alfa * self.content_loss \
@@ -158,8 +326,20 @@ class StyleTransfer():
     var_list = tf.trainable_variables()
     self.var_list = [var for var in var_list if 'output_image' in var.name]
 
-    self.optim = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
-        name='adam_optimizer').minimize(self.total_loss, var_list=self.var_list)
+    if self.optimizer == 'lbfgs':
+      # one scipy iteration may take several loss evaluations
+      self.optim = tf.contrib.opt.ScipyOptimizerInterface(self.total_loss,
+          var_list=self.var_list,
+          method='L-BFGS-B',
+          options={'maxiter': self.num_iters})
+    else:
+      adam = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
+          name='adam_optimizer')
+      self.optim = adam.minimize(self.total_loss, var_list=self.var_list)
+      # fresh moments for every frame of train_sequence
+      self.optim_reset = tf.variables_initializer(adam.variables())
+
+    self.noise_img_assign = tf.assign(self.noise_img, self.noise_img_init)
 
     tf.summary.scalar('content_loss', self.content_loss)
     tf.summary.scalar('style_loss', self.style_loss)
@@ -185,72 +365,288 @@ class StyleTransfer():
             noise_img_path='images/content/content1.jpg',
             output_img_path='results/anaoas',
             tensorboard_path='tensorboard/tensorboard_anaoas',
-            show_img=None):
+            show_img=None,
+            cache_path='cache',
+            noise_img=None):
     summ = tf.summary.merge_all()
     with tf.Session() as sess:
       ut = Utils()
-      noise_img_bytes = sess.run(self.file_bytes,
-          feed_dict={self.name_file: noise_img_path})
-      noise_img_np = np.fromstring(noise_img_bytes, np.uint8)
-      noise_img = np.reshape(ut.add_noise(ut.get_img(noise_img_np,
-                                                     width=self.noise_img_width,
-                                                     height=self.noise_img_height)),
-                             (1,
-                             self.noise_img_height,
-                             self.noise_img_width,
-                             self.noise_img_channels))
+      self.async_writer = AsyncWriter()
+      content_img_paths = self._get_img_paths(content_img_path)
+      style_img_paths = self._get_img_paths(style_img_path)
+      noise_img_paths = self._get_img_paths(noise_img_path)
+
+      if noise_img is None:
+        _, noise_img = self._read_imgs(sess, ut, noise_img_paths,
+                                       self.noise_img_height,
+                                       self.noise_img_width,
+                                       self.noise_img_channels)
+        noise_img = np.array([ut.add_noise(img) for img in noise_img])
       sess.run(tf.global_variables_initializer(), feed_dict={self.noise_img_init: noise_img})
+      sess.run(tf.local_variables_initializer())
 
       writer = tf.summary.FileWriter(tensorboard_path)
       writer.add_graph(sess.graph)
 
-      content_img_bytes = sess.run(self.file_bytes,
-          feed_dict={self.name_file: content_img_path})
-      content_img_np = np.fromstring(content_img_bytes, np.uint8)
-      content_img = np.reshape(ut.get_img(content_img_np,
-                                          width=self.content_img_width,
-                                          height=self.content_img_height),
-                                          (1,
-                                           self.content_img_height,
-                                           self.content_img_width,
-                                           self.content_img_channels))
-      style_img_bytes = sess.run(self.file_bytes,
-          feed_dict={self.name_file: style_img_path})
-      style_img_np = np.fromstring(style_img_bytes, np.uint8)
-      style_img = np.reshape(ut.get_img(style_img_np,
-                                        width=self.style_img_width,
-                                        height=self.style_img_height),
-                                        (1,
-                                         self.style_img_height,
-                                         self.style_img_width,
-                                         self.style_img_channels))
-
-      for i in range(self.num_iters):
-        _, content_loss, style_loss, tv_loss, out_loss, out_img =  sess.run(
-              [self.optim, self.content_loss, self.style_loss, self.total_variation_loss,
-               self.total_loss, self.noise_img],
-              feed_dict={self.content_img: content_img,
-                         self.style_img: style_img})
-
-        print('it: ', i)
-        print('Content loss: ', content_loss)
-        print('Style loss: ', style_loss)
-        print('Total variation loss: ', tv_loss)
-        print('Total loss: ', out_loss)
-
-        if i % 50 == 0:
-          decoded_img = ut.denormalize_img(out_img[0])
-          decoded_img = cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB)
-          sess.run(self.fwrite,
-                   feed_dict={self.decoded_img: decoded_img,
-                              self.name_file: output_img_path + '/img' + str(i) + '.png'})
-
-          if show_img:
-            plt.axis("off")
-            plt.imshow(decoded_img)
-            plt.show()
-
-          s = sess.run(summ,
-                       feed_dict={self.content_img: content_img,
-                                  self.style_img: style_img})
-          writer.add_summary(s, i)
+      _, content_img = self._read_imgs(sess, ut, content_img_paths,
+                                       self.content_img_height,
+                                       self.content_img_width,
+                                       self.content_img_channels)
+      style_img_bytes, style_img = self._read_imgs(sess, ut, style_img_paths,
+                                                   self.style_img_height,
+                                                   self.style_img_width,
+                                                   self.style_img_channels)
+      self._load_style_grams(sess, ut, style_img_bytes, style_img, cache_path)
+
+      if self.freeze_content:
+        self._load_content_targets(sess, content_img)
+        feed_dict = {}
+      else:
+        feed_dict = {self.content_img: content_img}
+
+      losses = [self.content_loss, self.style_loss, self.total_variation_loss,
+                self.total_loss]
+      self.target_evals = None
+      start_time = time.time()
+
+      if self.optimizer == 'lbfgs':
+        evals = [0]
+
+        def loss_callback(content_loss, style_loss, tv_loss, out_loss, out_img):
+          i = evals[0]
+          evals[0] = i + 1
+          self._log_step(i, content_loss, style_loss, tv_loss, out_loss,
+                         start_time)
+
+          if i % 50 == 0:
+            self._save_snapshot(sess, ut, writer, summ, feed_dict,
+                                i, out_img, output_img_path, show_img)
+
+        self.optim.minimize(sess,
+                            feed_dict=feed_dict,
+                            fetches=losses + [self.noise_img],
+                            loss_callback=loss_callback)
+        num_evals = evals[0]
+      else:
+        stopping = EarlyStopping(rel_tol=self.stop_rel_tol,
+                                 window=self.stop_window,
+                                 max_time=self.stop_max_time,
+                                 min_iters=self.stop_min_iters)
+        i = -1
+        for i in range(self.num_iters):
+          # the image and the summaries ride along only on snapshot steps
+          snapshot = i % 50 == 0
+          fetches = [self.optim] + losses
+          if snapshot:
+            fetches = fetches + [self.noise_img, summ]
+          results = sess.run(fetches, feed_dict=feed_dict)
+          content_loss, style_loss, tv_loss, out_loss = results[1:5]
+          self._log_step(i, content_loss, style_loss, tv_loss, out_loss,
+                         start_time)
+
+          if snapshot:
+            self._save_snapshot(sess, ut, writer, summ, feed_dict,
+                                i, results[5], output_img_path, show_img,
+                                s=results[6])
+
+          if stopping.update(i, out_loss):
+            break
+        num_evals = i + 1
+        stopping.report(i, self.num_iters)
+
+      print('%s: %d evaluations in %.2f s'
+            % (self.optimizer, num_evals, time.time() - start_time))
+      if self.target_loss is not None and self.target_evals is None:
+        print('Target loss %f not reached' % self.target_loss)
+      self.async_writer.close()
+      print('Blocked on image writes: %.2f s' % self.async_writer.blocked_time)
+
+      return sess.run(self.noise_img)
+
+  def train_sequence(self,
+                     content_img_paths,
+                     style_img_path='images/style/style1.jpg',
+                     output_img_path='results/anaoas',
+                     tensorboard_path='tensorboard/tensorboard_anaoas',
+                     show_img=None,
+                     cache_path='cache',
+                     frame_iters=100):
+    # the graph, the session and the style grams are shared by all the
+    # frames; every frame after the first starts from the previous result
+    # warped by the optical flow and runs only frame_iters iterations
+    if self.batch_size != 1:
+      raise ValueError('train_sequence needs batch_size=1')
+    if self.optimizer != 'adam':
+      raise ValueError('train_sequence needs optimizer=adam')
+
+    summ = tf.summary.merge_all()
+    with tf.Session() as sess:
+      ut = Utils()
+      self.async_writer = AsyncWriter()
+      _, content_img = self._read_imgs(sess, ut, content_img_paths[:1],
+                                       self.content_img_height,
+                                       self.content_img_width,
+                                       self.content_img_channels)
+      noise_img = np.array([ut.add_noise(content_img[0])])
+      sess.run(tf.global_variables_initializer(), feed_dict={self.noise_img_init: noise_img})
+      sess.run(tf.local_variables_initializer())
+
+      writer = tf.summary.FileWriter(tensorboard_path)
+      writer.add_graph(sess.graph)
+
+      style_img_bytes, style_img = self._read_imgs(sess, ut, [style_img_path],
+                                                   self.style_img_height,
+                                                   self.style_img_width,
+                                                   self.style_img_channels)
+      self._load_style_grams(sess, ut, style_img_bytes, style_img, cache_path)
+
+      losses = [self.content_loss, self.style_loss, self.total_variation_loss,
+                self.total_loss]
+      self.target_evals = None
+      out_img = None
+      prev_content_img = None
+      frame_times = []
+      it = 0
+      for frame, content_img_path in enumerate(content_img_paths):
+        frame_start_time = time.time()
+        _, content_img = self._read_imgs(sess, ut, [content_img_path],
+                                         self.content_img_height,
+                                         self.content_img_width,
+                                         self.content_img_channels)
+        if self.freeze_content:
+          self._load_content_targets(sess, content_img)
+          feed_dict = {}
+        else:
+          feed_dict = {self.content_img: content_img}
+
+        if out_img is not None:
+          warped_img = self._warp_img(ut, out_img[0], prev_content_img[0],
+                                      content_img[0])
+          sess.run([self.noise_img_assign, self.optim_reset],
+                   feed_dict={self.noise_img_init: warped_img[np.newaxis]})
+
+        num_iters = self.num_iters if frame == 0 else frame_iters
+        stopping = EarlyStopping(rel_tol=self.stop_rel_tol,
+                                 window=self.stop_window,
+                                 max_time=self.stop_max_time,
+                                 min_iters=self.stop_min_iters)
+        i = -1
+        for i in range(num_iters):
+          _, content_loss, style_loss, tv_loss, out_loss =  sess.run(
+                [self.optim] + losses, feed_dict=feed_dict)
+          self._log_step(it, content_loss, style_loss, tv_loss, out_loss,
+                         frame_start_time)
+          it += 1
+
+          if stopping.update(i, out_loss):
+            break
+
+        out_img = sess.run(self.noise_img)
+        decoded_img = ut.denormalize_img(out_img[0])
+        self.async_writer.write_img(output_img_path + '/frame%05d.png' % frame,
+                                    decoded_img)
+        s = sess.run(summ, feed_dict=feed_dict)
+        writer.add_summary(s, it)
+        writer.add_summary(self.async_writer.get_summary(), it)
+
+        if show_img:
+          plt.axis("off")
+          plt.imshow(cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB))
+          plt.show()
+
+        prev_content_img = content_img
+        frame_times.append(time.time() - frame_start_time)
+        print('Frame %d: %d iterations in %.2f s'
+              % (frame, i + 1, frame_times[-1]))
+
+      if len(frame_times) > 1:
+        print('First frame %.2f s, next frames %.2f s on average'
+              % (frame_times[0], np.mean(frame_times[1:])))
+      self.async_writer.close()
+      print('Blocked on image writes: %.2f s' % self.async_writer.blocked_time)
+
+      return out_img
+
+  def train_pyramid(self,
+                    pyramid_levels=[4, 2, 1],
+                    pyramid_iters=None,
+                    content_img_path='images/content/content1.jpg',
+                    style_img_path='images/style/style1.jpg',
+                    noise_img_path='images/content/content1.jpg',
+                    output_img_path='results/anaoas',
+                    tensorboard_path='tensorboard/tensorboard_anaoas',
+                    show_img=None,
+                    cache_path='cache'):
+    # optimize at 1 / pyramid_levels[0] of the size first, then upsample the
+    # result as the init of the next level. By default num_iters is split
+    # over the levels, every finer level gets half of the previous one, so
+    # the run costs less than a plain one at full size
+    if pyramid_iters is None:
+      pyramid_iters = [max(self.num_iters * 2 ** (len(pyramid_levels) - 1 - l)
+                           // (2 ** len(pyramid_levels) - 1), 1)
+                       for l in range(len(pyramid_levels))]
+    if len(pyramid_levels) != len(pyramid_iters):
+      raise ValueError('pyramid_levels and pyramid_iters must have the same length')
+
+    ut = Utils()
+    content_img_height = self.content_img_height
+    content_img_width = self.content_img_width
+    style_img_height = self.style_img_height
+    style_img_width = self.style_img_width
+    num_iters = self.num_iters
+    output_img_init = self.output_img_init
+
+    noise_img = None
+    for level, (scale, level_iters) in enumerate(zip(pyramid_levels,
+                                                     pyramid_iters)):
+      self.content_img_height, self.content_img_width = \
+          ut.resize_with_ratio(height=content_img_height,
+                               width=content_img_width,
+                               size=max(content_img_height,
+                                        content_img_width) // scale)
+      self.style_img_height, self.style_img_width = \
+          ut.resize_with_ratio(height=style_img_height,
+                               width=style_img_width,
+                               size=max(style_img_height,
+                                        style_img_width) // scale)
+      self.noise_img_height = self.content_img_height
+      self.noise_img_width = self.content_img_width
+      self.num_iters = level_iters
+
+      if noise_img is not None:
+        self.output_img_init = 'content'
+        noise_img = np.array([np.reshape(ut.resize_img(img,
+                                                       self.noise_img_width,
+                                                       self.noise_img_height),
+                                         (self.noise_img_height,
+                                          self.noise_img_width,
+                                          self.noise_img_channels))
+                              for img in noise_img])
+
+      level_img_path = output_img_path + '/level' + str(level)
+      tf.gfile.MakeDirs(level_img_path)
+
+      print('Pyramid level %d: %dx%d, %d iterations'
+            % (level, self.content_img_width, self.content_img_height,
+               level_iters))
+      self.build()
+      noise_img = self.train(content_img_path=content_img_path,
+                             style_img_path=style_img_path,
+                             noise_img_path=noise_img_path,
+                             output_img_path=level_img_path,
+                             tensorboard_path=tensorboard_path
+                                              + '/level' + str(level),
+                             show_img=show_img,
+                             cache_path=cache_path,
+                             noise_img=noise_img)
+
+    self.content_img_height = content_img_height
+    self.content_img_width = content_img_width
+    self.style_img_height = style_img_height
+    self.style_img_width = style_img_width
+    self.noise_img_height = content_img_height
+    self.noise_img_width = content_img_width
+    self.num_iters = num_iters
+    self.output_img_init = output_img_init
+
+    return noise_img
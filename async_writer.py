@@ -0,0 +1,83 @@
+import cv2
+import os
+import queue
+import threading
+import time
+import tensorflow as tf
+
+class AsyncWriter():
+  # encodes and writes files (local or gs://) on a background thread, a
+  # write only blocks the caller when max_pending writes are already
+  # queued, the time spent blocked is kept in blocked_time
+  def __init__(self, max_pending=8):
+    self.queue = queue.Queue(maxsize=max_pending)
+    self.blocked_time = 0.0
+    self.error = None
+
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        fn, args = item
+        if self.error is None:
+          fn(*args)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+  def _check_error(self):
+    if self.error is not None:
+      error, self.error = self.error, None
+      raise error
+
+  def _put(self, fn, *args):
+    self._check_error()
+    start_time = time.time()
+    self.queue.put((fn, args))
+    self.blocked_time += time.time() - start_time
+
+  def _write(self, file_path, data):
+    with tf.gfile.GFile(file_path, 'wb') as f:
+      f.write(data)
+
+  def _write_atomic(self, file_path, data):
+    # readers see the old or the new file, never a partial one
+    tmp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+    self._write(tmp_path, data)
+    tf.gfile.Rename(tmp_path, file_path, overwrite=True)
+
+  def _write_img(self, file_path, img):
+    _, encoded_img = cv2.imencode(os.path.splitext(file_path)[1], img)
+    self._write(file_path, encoded_img.tobytes())
+
+  def write(self, file_path, data):
+    self._put(self._write, file_path, data)
+
+  def write_atomic(self, file_path, data):
+    self._put(self._write_atomic, file_path, data)
+
+  def write_img(self, file_path, img):
+    # img is uint8 BGR, as given by cv2/Utils
+    self._put(self._write_img, file_path, img)
+
+  def get_summary(self):
+    return tf.Summary(value=[tf.Summary.Value(tag='io_blocked_time',
+                                              simple_value=self.blocked_time)])
+
+  def flush(self):
+    start_time = time.time()
+    self.queue.join()
+    self.blocked_time += time.time() - start_time
+    self._check_error()
+
+  def close(self):
+    self.flush()
+    self.queue.put(None)
+    self.thread.join()
@@ -0,0 +1,55 @@
+# python -m benchmarks.anaoas_frozen_content --tensorflow_model_path <conv_wb.pkl>
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+import a_neural_algorithm_of_artistic_style.anaoas_style_transfer as anaoas
+
+def bench(tensorflow_model_path, img_size, freeze_content, num_iters):
+  model = anaoas.StyleTransfer(
+      tensorflow_model_path=tensorflow_model_path,
+      content_img_height=img_size,
+      content_img_width=img_size,
+      style_img_height=img_size,
+      style_img_width=img_size,
+      noise_img_height=img_size,
+      noise_img_width=img_size,
+      freeze_content=freeze_content)
+  model.build()
+
+  content_img = np.random.uniform(-100, 100, (1, img_size, img_size, 3))
+  style_img = np.random.uniform(-100, 100, (1, img_size, img_size, 3))
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+    style_grams = sess.run(model.style_grams,
+                           feed_dict={model.style_img: style_img})
+    for style_layer_name, style_gram in model.style_grams_var.items():
+      style_gram.load(style_grams[style_layer_name], sess)
+
+    if freeze_content:
+      model._load_content_targets(sess, content_img)
+      feed_dict = {}
+    else:
+      feed_dict = {model.content_img: content_img}
+
+    sess.run(model.optim, feed_dict=feed_dict) # warmup
+    start = time.time()
+    for _ in range(num_iters):
+      sess.run(model.optim, feed_dict=feed_dict)
+    return (time.time() - start) / num_iters
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tensorflow_model_path',
+                      default='pretrained_models/vgg19/model/tensorflow/conv_wb.pkl')
+  parser.add_argument('--img_sizes', type=int, nargs='+', default=[512, 1024])
+  parser.add_argument('--num_iters', type=int, default=10)
+  args = parser.parse_args()
+
+  for img_size in args.img_sizes:
+    dynamic = bench(args.tensorflow_model_path, img_size, False, args.num_iters)
+    frozen = bench(args.tensorflow_model_path, img_size, True, args.num_iters)
+    print('%dpx: %.3f s/it recomputed, %.3f s/it frozen, %.1f%% saved'
+          % (img_size, dynamic, frozen, 100.0 * (1.0 - frozen / dynamic)))
@@ -0,0 +1,75 @@
+# python -m benchmarks.anaoas_hot_loop --tensorflow_model_path <conv_wb.pkl>
+# per-iteration time of the old ANAOAS loop (image fetched every step,
+# separate summary pass on snapshot steps, five prints per step) against
+# the current one (image and summaries only on snapshot steps, in the
+# optimizer run, rate-limited logging)
+import argparse
+import contextlib
+import os
+import time
+import tensorflow as tf
+
+from a_neural_algorithm_of_artistic_style.anaoas_style_transfer \
+    import StyleTransfer
+
+def old_loop(model, sess, summ, losses, num_iters):
+  for i in range(num_iters):
+    _, content_loss, style_loss, tv_loss, out_loss, out_img = sess.run(
+        [model.optim] + losses + [model.noise_img])
+    print('it: ', i)
+    print('Content loss: ', content_loss)
+    print('Style loss: ', style_loss)
+    print('Total variation loss: ', tv_loss)
+    print('Total loss: ', out_loss)
+    if i % 50 == 0:
+      sess.run(summ)
+
+def new_loop(model, sess, summ, losses, num_iters):
+  for i in range(num_iters):
+    fetches = [model.optim] + losses
+    if i % 50 == 0:
+      fetches = fetches + [model.noise_img, summ]
+    results = sess.run(fetches)
+    model._log_step(i, results[1], results[2], results[3], results[4],
+                    time.time())
+
+def bench(loop, model, sess, summ, losses, num_iters):
+  with open(os.devnull, 'w') as devnull:
+    with contextlib.redirect_stdout(devnull):
+      loop(model, sess, summ, losses, 1) # warmup
+      start = time.time()
+      loop(model, sess, summ, losses, num_iters)
+
+  return (time.time() - start) / num_iters * 1000.0
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tensorflow_model_path',
+                      default='pretrained_models/vgg19/model/tensorflow/conv_wb.pkl')
+  parser.add_argument('--img_size', type=int, default=256)
+  parser.add_argument('--num_iters', type=int, default=200)
+  args = parser.parse_args()
+
+  model = StyleTransfer(tensorflow_model_path=args.tensorflow_model_path,
+                        content_img_height=args.img_size,
+                        content_img_width=args.img_size,
+                        style_img_height=args.img_size,
+                        style_img_width=args.img_size,
+                        noise_img_height=args.img_size,
+                        noise_img_width=args.img_size)
+  model.target_evals = None
+  model.build()
+  summ = tf.summary.merge_all()
+  losses = [model.content_loss, model.style_loss, model.total_variation_loss,
+            model.total_loss]
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(tf.local_variables_initializer())
+    before = bench(old_loop, model, sess, summ, losses, args.num_iters)
+    after = bench(new_loop, model, sess, summ, losses, args.num_iters)
+
+  print('old loop: %.2f ms/it' % before)
+  print('new loop: %.2f ms/it' % after)
+  print('overhead removed: %.2f ms/it (%.1f%%)'
+        % (before - after, 100.0 * (before - after) / before))
@@ -0,0 +1,68 @@
+# python -m benchmarks.dataset_shards --data_path <dataset> [--build]
+# time to load num_batches training batches with the raw jpeg path
+# (Utils.get_img per file), the tf.data pipeline and the prebuilt shards,
+# scaled to a full epoch; --build writes the shards first
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from utils import Utils
+from perceptual_losses_for_real_time_style_transfer.dataset import Dataset
+
+def raw_jpeg(ds, img_paths, args):
+  ut = Utils()
+  for b in range(0, len(img_paths), args.batch_size):
+    np.array([ut.get_img(img_path,
+                         width=args.img_size,
+                         height=args.img_size,
+                         model='transform_net')
+              for img_path in img_paths[b:b + args.batch_size]])
+
+def tf_data(ds, img_paths, args):
+  tf.reset_default_graph()
+  files, iterator_init, next_batch = ds.build_train_pipeline(
+      args.batch_size, args.img_size, args.img_size,
+      num_parallel_calls=args.num_parallel_calls)
+  with tf.Session() as sess:
+    sess.run(iterator_init, feed_dict={files: img_paths})
+    for _ in range(len(img_paths) // args.batch_size):
+      sess.run(next_batch)
+
+def shards(ds, img_paths, args):
+  for b in range(0, len(img_paths), args.batch_size):
+    ds.get_train_imgs(img_paths[b:b + args.batch_size],
+                      args.img_size, args.img_size)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_path',
+                      default='perceptual_losses_for_real_time_style_transfer/dataset')
+  parser.add_argument('--img_size', type=int, default=256)
+  parser.add_argument('--batch_size', type=int, default=4)
+  parser.add_argument('--num_batches', type=int, default=500)
+  parser.add_argument('--num_parallel_calls', type=int, default=4)
+  parser.add_argument('--build', action='store_true')
+  args = parser.parse_args()
+
+  if args.build:
+    Dataset.build_dataset_shards(data_path=args.data_path,
+                                 output_path=args.data_path + '/shards/train',
+                                 height=args.img_size,
+                                 width=args.img_size)
+
+  ds = Dataset(args.data_path)
+  train_files = ds.get_train_files()
+  img_paths = train_files[:args.num_batches * args.batch_size]
+  print('%d images, %d in the epoch' % (len(img_paths), len(train_files)))
+
+  modes = [('raw jpeg', raw_jpeg), ('tf.data', tf_data)]
+  if ds.has_shards():
+    modes.append(('shards', shards))
+  for name, fn in modes:
+    start = time.time()
+    fn(ds, img_paths, args)
+    elapsed = time.time() - start
+    print('%10s: %.2f ms/batch, %.1f s/epoch'
+          % (name, elapsed * 1000.0 * args.batch_size / len(img_paths),
+             elapsed * len(train_files) / len(img_paths)))
@@ -0,0 +1,68 @@
+# python -m benchmarks.dpst_masked_gram
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+import deep_photo_style_transfer.dpst_style_transfer as dpst
+
+def loop_masked_gram_matrices(layer, mask_img, mask_channels):
+  # the per-label loop DPST used before
+  sz = tf.constant([layer.get_shape().as_list()[1],
+                    layer.get_shape().as_list()[2]])
+  mask_img = tf.image.resize_images(mask_img, sz)
+
+  gram_matrices = []
+  for c in range(mask_channels):
+    mask_matrix_img = tf.multiply(layer, mask_img[:, :, :, c:c + 1])
+    channels_matrix_img = tf.reshape(mask_matrix_img,
+                                     [-1, tf.shape(mask_matrix_img)[3]])
+    gram_matrices.append(tf.matmul(tf.transpose(channels_matrix_img),
+                                   channels_matrix_img))
+
+  return tf.stack(gram_matrices)
+
+def bench(mode, mask_channels, img_size, channels, num_iters):
+  tf.reset_default_graph()
+  layer = tf.get_variable('layer', shape=[1, img_size, img_size, channels])
+  labels = np.random.randint(mask_channels, size=(img_size // 8, img_size // 8))
+  labels = upsample_labels(labels, 8)
+  mask_img = tf.constant(np.eye(mask_channels, dtype=np.float32)[labels][np.newaxis])
+
+  if mode == 'loop':
+    gram_matrices = loop_masked_gram_matrices(layer, mask_img, mask_channels)
+  else:
+    model = dpst.StyleTransfer(mask_palette=[[0, 0, 0]] * mask_channels,
+                               mask_gram_mode=mode)
+    gram_matrices = model._get_masked_gram_matrices(layer, mask_img)
+
+  loss = tf.reduce_sum(tf.square(gram_matrices))
+  optim = tf.train.GradientDescentOptimizer(1e-12).minimize(loss)
+
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(optim) # warmup
+    start = time.time()
+    for _ in range(num_iters):
+      sess.run(optim)
+    return (time.time() - start) / num_iters
+
+def upsample_labels(labels, factor):
+  # blocky label map, so every label covers contiguous regions
+  return np.repeat(np.repeat(labels, factor, axis=0), factor, axis=1)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--img_size', type=int, default=128)
+  parser.add_argument('--channels', type=int, default=128)
+  parser.add_argument('--mask_channels', type=int, nargs='+', default=[2, 5, 20])
+  parser.add_argument('--num_iters', type=int, default=20)
+  args = parser.parse_args()
+
+  for mask_channels in args.mask_channels:
+    times = [bench(mode, mask_channels, args.img_size, args.channels,
+                   args.num_iters)
+             for mode in ['loop', 'batched', 'gather']]
+    print('%2d labels: loop %.4f s, batched %.4f s (%.2fx), gather %.4f s (%.2fx)'
+          % (mask_channels, times[0], times[1], times[0] / times[1],
+             times[2], times[0] / times[2]))
@@ -0,0 +1,59 @@
+# python -m benchmarks.dpst_matting_laplacian
+import argparse
+import resource
+import time
+import numpy as np
+import tensorflow as tf
+
+import deep_photo_style_transfer.dpst_style_transfer as dpst
+
+def bench_step(laplacian, img_size, num_iters):
+  tf.reset_default_graph()
+  model = dpst.StyleTransfer(noise_img_height=img_size,
+                             noise_img_width=img_size)
+  noise_img = tf.get_variable('output_image', shape=[1, img_size, img_size, 3])
+  base_loss = tf.reduce_sum(tf.square(noise_img))
+
+  num_pixels = img_size * img_size
+  photorealism_loss = model._get_photorealism_loss(
+      tf.SparseTensor(indices=laplacian['indices'],
+                      values=laplacian['values'],
+                      dense_shape=[num_pixels, num_pixels]),
+      noise_img)
+
+  times = []
+  for loss in [base_loss, base_loss + photorealism_loss]:
+    optim = tf.train.AdamOptimizer(learning_rate=2).minimize(loss)
+    with tf.Session() as sess:
+      sess.run(tf.global_variables_initializer())
+      sess.run(optim) # warmup
+      start = time.time()
+      for _ in range(num_iters):
+        sess.run(optim)
+      times.append((time.time() - start) / num_iters)
+
+  return times[1] - times[0]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--img_sizes', type=int, nargs='+', default=[512, 1024])
+  parser.add_argument('--num_iters', type=int, default=10)
+  args = parser.parse_args()
+
+  model = dpst.StyleTransfer()
+  for img_size in args.img_sizes:
+    img = np.random.uniform(0.0, 1.0, (img_size, img_size, 3))
+
+    start = time.time()
+    laplacian = model._get_matting_laplacian(img).tocoo()
+    build_time = time.time() - start
+    # peak of the whole process so far, the sizes run in increasing order
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    laplacian = {'indices': np.stack([laplacian.row, laplacian.col],
+                                     axis=1).astype(np.int64),
+                 'values': laplacian.data.astype(np.float32)}
+    step_time = bench_step(laplacian, img_size, args.num_iters)
+    print('%dpx: build %.2f s, peak rss %.0f MB, nnz %d, +%.4f s per step'
+          % (img_size, build_time, peak_rss, len(laplacian['values']),
+             step_time))
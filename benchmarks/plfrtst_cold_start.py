@@ -0,0 +1,84 @@
+# python -m benchmarks.plfrtst_cold_start --model_path models_freeze/model_freeze_s1.ckpt
+# time to the first stylized image and peak rss of a fresh process for the
+# full predict graph (StyleTransfer.build + saver.restore), the Stylizer on
+# the checkpoint and the Stylizer on the exported frozen graph
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+def child(mode, model_path, tensorflow_model_path, img_size):
+  start = time.time()
+  import numpy as np
+  import tensorflow as tf
+
+  img = np.random.randint(0, 256, (1, img_size, img_size, 3)).astype(np.uint8)
+  if mode == 'predict':
+    from perceptual_losses_for_real_time_style_transfer.plfrtst_style_transfer \
+        import StyleTransfer
+
+    model = StyleTransfer(tensorflow_model_path=tensorflow_model_path,
+                          content_img_height=img_size,
+                          content_img_width=img_size)
+    model.build()
+    saver = tf.train.Saver()
+    with tf.Session() as sess:
+      saver.restore(sess, model_path)
+      sess.run(model.noise_img,
+               feed_dict={model.content_img_transform:
+                              img.astype(np.float32) / 127.5 - 1})
+  else:
+    from perceptual_losses_for_real_time_style_transfer.stylizer import Stylizer
+
+    stylizer = Stylizer(model_path=model_path)
+    stylizer.stylize(img)
+    stylizer.close()
+
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  print('%f %f' % (time.time() - start, maxrss))
+
+def bench(mode, model_path, args):
+  cmd = [sys.executable, '-m', 'benchmarks.plfrtst_cold_start',
+         '--child', mode,
+         '--model_path', model_path,
+         '--tensorflow_model_path', args.tensorflow_model_path,
+         '--img_size', str(args.img_size)]
+  start = time.time()
+  out = subprocess.check_output(cmd).decode()
+  wall = time.time() - start
+  first_img, maxrss = out.split('\n')[-2].split()
+
+  return wall, float(first_img), float(maxrss)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model_path',
+                      default='models_freeze/model_freeze_s1.ckpt')
+  parser.add_argument('--tensorflow_model_path',
+                      default='pretrained_models/vgg19/model/tensorflow/conv_wb.pkl')
+  parser.add_argument('--img_size', type=int, default=256)
+  parser.add_argument('--child')
+  args = parser.parse_args()
+
+  if args.child:
+    child(args.child, args.model_path, args.tensorflow_model_path,
+          args.img_size)
+  else:
+    from perceptual_losses_for_real_time_style_transfer.stylizer import Stylizer
+
+    export_path = os.path.join(tempfile.mkdtemp(), 'transform_net.pb')
+    stylizer = Stylizer(model_path=args.model_path)
+    stylizer.export(export_path)
+    stylizer.close()
+    print('frozen graph: %.1f MB' % (os.path.getsize(export_path) / 2.0 ** 20))
+
+    print('%12s %10s %16s %10s' % ('mode', 'wall (s)', 'first img (s)',
+                                   'rss (MB)'))
+    for mode, model_path in [('predict', args.model_path),
+                             ('checkpoint', args.model_path),
+                             ('frozen', export_path)]:
+      wall, first_img, maxrss = bench(mode, model_path, args)
+      print('%12s %10.2f %16.2f %10.1f' % (mode, wall, first_img, maxrss))
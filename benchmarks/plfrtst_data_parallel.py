@@ -0,0 +1,53 @@
+# python -m benchmarks.plfrtst_data_parallel --data_path <dataset>
+# images/s of the data parallel PLFRTST training (main.py --num_local_workers)
+# with 1, 2, 4 and 8 localhost workers and one ps, each run stops after
+# max_steps global steps. The outputs go to a temporary directory
+import argparse
+import re
+import subprocess
+import sys
+import tempfile
+
+def run(num_workers, tmp_path, args):
+  cmd = [sys.executable, 'main.py',
+         '--method', 'plfrtst',
+         '--train',
+         '--num_local_workers', str(num_workers),
+         '--max_steps', str(args.max_steps),
+         '--batch_size', str(args.batch_size),
+         '--content_img_height', str(args.img_size),
+         '--content_img_width', str(args.img_size),
+         '--style_img_size', str(args.img_size),
+         '--data_path', args.data_path,
+         '--tensorflow_model_path', args.tensorflow_model_path,
+         '--tensorboard_path', tmp_path + '/tensorboard',
+         '--output_img_path', tmp_path + '/results',
+         '--model_path', tmp_path + '/models',
+         '--checkpoints_path', tmp_path + '/checkpoints_' + str(num_workers),
+         '--cache_path', tmp_path + '/cache']
+  output = subprocess.check_output(cmd, universal_newlines=True)
+  match = re.search(r'Throughput: ([0-9.]+) images/s', output)
+  if match is None:
+    raise RuntimeError('No throughput in the output of ' + ' '.join(cmd))
+
+  return float(match.group(1))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--data_path',
+                      default='perceptual_losses_for_real_time_style_transfer/dataset')
+  parser.add_argument('--tensorflow_model_path',
+                      default='pretrained_models/vgg19/model/tensorflow/conv_wb.pkl')
+  parser.add_argument('--img_size', type=int, default=256)
+  parser.add_argument('--batch_size', type=int, default=2)
+  parser.add_argument('--max_steps', type=int, default=50)
+  parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2, 4, 8])
+  args = parser.parse_args()
+
+  tmp_path = tempfile.mkdtemp()
+  base = None
+  for num_workers in args.num_workers:
+    images_per_sec = run(num_workers, tmp_path, args)
+    base = base or images_per_sec
+    print('%d workers: %.2f images/s (%.2fx)'
+          % (num_workers, images_per_sec, images_per_sec / base))
@@ -0,0 +1,80 @@
+# python -m benchmarks.plfrtst_tiled_predict --img_sizes 512 1024 2048 4096
+# every configuration runs in its own process so the peak rss is its own,
+# the transform_net weights are random (the cost does not depend on them)
+import argparse
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+from conv_nets.transform_net import TransformNet
+from perceptual_losses_for_real_time_style_transfer.plfrtst_style_transfer \
+    import StyleTransfer
+
+def child(img_size, tile_size, tile_overlap, tile_batch_size, num_iters):
+  model = StyleTransfer(model_name=None,
+                        content_img_height=img_size,
+                        content_img_width=img_size)
+  model.model_transform = TransformNet()
+  img = tf.placeholder(tf.float32, [None, None, None, 3])
+  noise_img = model.model_transform.run(img)
+  if tile_size:
+    model._build_tiled()
+
+  content_img = np.random.uniform(-1, 1,
+                                  (img_size, img_size, 3)).astype(np.float32)
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    times = []
+    for _ in range(num_iters + 1): # the first run is a warmup
+      start = time.time()
+      if tile_size:
+        model._run_tiled(sess, content_img, tile_size, tile_overlap,
+                         tile_batch_size)
+      else:
+        sess.run(noise_img, feed_dict={img: content_img[np.newaxis]})
+      times.append(time.time() - start)
+
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  print('%f %f' % (np.mean(times[1:]), maxrss))
+
+def bench(img_size, tile_size, args):
+  cmd = [sys.executable, '-m', 'benchmarks.plfrtst_tiled_predict',
+         '--child',
+         '--img_sizes', str(img_size),
+         '--tile_size', str(tile_size),
+         '--tile_overlap', str(args.tile_overlap),
+         '--tile_batch_size', str(args.tile_batch_size),
+         '--num_iters', str(args.num_iters)]
+  proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if proc.returncode != 0: # most likely out of memory
+    return None, None
+  latency, maxrss = proc.stdout.decode().split('\n')[-2].split()
+
+  return float(latency), float(maxrss)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--img_sizes', type=int, nargs='+',
+                      default=[512, 1024, 2048, 4096])
+  parser.add_argument('--tile_size', type=int, default=512)
+  parser.add_argument('--tile_overlap', type=int, default=32)
+  parser.add_argument('--tile_batch_size', type=int, default=4)
+  parser.add_argument('--num_iters', type=int, default=3)
+  parser.add_argument('--child', action='store_true')
+  args = parser.parse_args()
+
+  if args.child:
+    child(args.img_sizes[0], args.tile_size, args.tile_overlap,
+          args.tile_batch_size, args.num_iters)
+  else:
+    print('%8s %8s %12s %12s' % ('size', 'mode', 'latency (s)', 'rss (MB)'))
+    for img_size in args.img_sizes:
+      for mode, tile_size in [('full', 0), ('tiled', args.tile_size)]:
+        latency, maxrss = bench(img_size, tile_size, args)
+        if latency is None:
+          print('%8d %8s %12s %12s' % (img_size, mode, 'failed', '-'))
+        else:
+          print('%8d %8s %12.3f %12.1f' % (img_size, mode, latency, maxrss))
@@ -0,0 +1,41 @@
+# python -m benchmarks.stylizer_batch_consistency --model_path <ckpt or .pb> --content_imgs <dir/glob>
+# checks that batch predict (Stylizer.stylize_imgs over all the images)
+# gives the same pixels as stylizing every image alone, for every
+# --batch_sizes, exits with 1 when an image differs by more than --max_diff
+import argparse
+import sys
+import numpy as np
+
+from perceptual_losses_for_real_time_style_transfer.stylizer import Stylizer
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model_path',
+                      default='models_freeze/model_freeze_s1.ckpt')
+  parser.add_argument('--content_imgs', default='images/content')
+  parser.add_argument('--content_img_size', type=int, default=512)
+  parser.add_argument('--batch_sizes', type=int, nargs='+', default=[2, 4, 8])
+  parser.add_argument('--bucket_size', type=int, default=64)
+  parser.add_argument('--max_diff', type=int, default=1)
+  args = parser.parse_args()
+
+  ok = True
+  for batch_size in args.batch_sizes:
+    stylizer = Stylizer(model_path=args.model_path,
+                        content_img_size=args.content_img_size,
+                        batch_size=batch_size,
+                        bucket_size=args.bucket_size)
+    imgs = [stylizer.read_img(img_path)
+            for img_path in stylizer.get_img_paths(args.content_imgs)]
+    single_imgs = [stylizer.stylize_imgs([img])[0] for img in imgs]
+    batch_imgs = stylizer.stylize_imgs(imgs)
+    stylizer.close()
+
+    diffs = [int(np.max(np.abs(single_img.astype(np.int32)
+                               - batch_img.astype(np.int32))))
+             for single_img, batch_img in zip(single_imgs, batch_imgs)]
+    print('batch_size %d: %d images, max diff %d'
+          % (batch_size, len(imgs), max(diffs or [0])))
+    ok = ok and max(diffs or [0]) <= args.max_diff
+
+  sys.exit(0 if ok else 1)
@@ -0,0 +1,73 @@
+# python -m benchmarks.vgg19_multi_tap --tensorflow_model_path <conv_wb.pkl>
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+from conv_nets.vgg19 import VGG19
+
+def build(model, img_size, content_layers, style_layers, multi_tap):
+  content_img = tf.placeholder(tf.float32, [1, img_size, img_size, 3])
+  style_img = tf.placeholder(tf.float32, [1, img_size, img_size, 3])
+  noise_img = tf.get_variable(name='output_image',
+                              shape=[1, img_size, img_size, 3])
+
+  if multi_tap:
+    content_taps = model.run_layers(content_img, content_layers)
+    style_taps = model.run_layers(style_img, style_layers)
+    noise_taps = model.run_layers(noise_img, content_layers + style_layers)
+  else: # one partial forward per layer and per input
+    content_taps = {l: model.run(content_img, l) for l in content_layers}
+    style_taps = {l: model.run(style_img, l) for l in style_layers}
+    noise_taps = {l: model.run(noise_img, l)
+                  for l in content_layers + style_layers}
+
+  loss = tf.constant(0.0)
+  for l in content_layers:
+    loss = loss + tf.reduce_mean(tf.square(content_taps[l] - noise_taps[l]))
+  for l in style_layers:
+    s = tf.reshape(style_taps[l], [-1, tf.shape(style_taps[l])[3]])
+    n = tf.reshape(noise_taps[l], [-1, tf.shape(noise_taps[l])[3]])
+    loss = loss + tf.reduce_mean(tf.square(tf.matmul(s, s, transpose_a=True)
+                                           - tf.matmul(n, n, transpose_a=True)))
+
+  optim = tf.train.AdamOptimizer(learning_rate=2).minimize(
+      loss, var_list=[noise_img])
+
+  return content_img, style_img, optim
+
+def bench(model, img_size, content_layers, style_layers, multi_tap, num_iters):
+  tf.reset_default_graph()
+  content_img, style_img, optim = build(model, img_size, content_layers,
+                                        style_layers, multi_tap)
+  feed = {content_img: np.random.uniform(-100, 100,
+                                         (1, img_size, img_size, 3)),
+          style_img: np.random.uniform(-100, 100,
+                                       (1, img_size, img_size, 3))}
+  with tf.Session() as sess:
+    sess.run(tf.global_variables_initializer())
+    sess.run(optim, feed_dict=feed) # warmup
+    start = time.time()
+    for _ in range(num_iters):
+      sess.run(optim, feed_dict=feed)
+    return num_iters / (time.time() - start)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--tensorflow_model_path',
+                      default='pretrained_models/vgg19/model/tensorflow/conv_wb.pkl')
+  parser.add_argument('--img_size', type=int, default=256)
+  parser.add_argument('--num_iters', type=int, default=20)
+  args = parser.parse_args()
+
+  model = VGG19(tensorflow_model_path=args.tensorflow_model_path)
+  content_layers = ['relu4_2']
+  style_layers = ['relu1_1', 'relu2_1', 'relu3_1', 'relu4_1', 'relu5_1']
+
+  before = bench(model, args.img_size, content_layers, style_layers,
+                 False, args.num_iters)
+  after = bench(model, args.img_size, content_layers, style_layers,
+                True, args.num_iters)
+  print('per-layer forwards: %.3f it/s' % before)
+  print('multi-tap forwards: %.3f it/s' % after)
+  print('speedup: %.2fx' % (after / before))
@@ -1,16 +1,92 @@
+import numpy as np
 import tensorflow as tf
 
 class TransformNet():
-  def __init__(self):
-    pass
-
-  def run(self, img, name='transform_net'):
-    with tf.variable_scope(name):
+  # with num_styles the batch norms are replaced by conditional instance
+  # norms, one scale and shift per style and channel, so every extra style
+  # only adds those. style_weights [batch, num_styles] picks (one-hot) or
+  # blends the styles of each image.
+  # tf.contrib.layers.batch_norm normalizes with the statistics of the
+  # whole fed batch, so the output of an image depends on the others in
+  # it. per_sample_norm takes them over every image alone instead, the
+  # batch of 1 result, with the same beta variables. mask [batch, height,
+  # width, 1] limits them to the valid pixels of padded images, norm_stats
+  # replaces them by given (mean, variance) pairs, one per norm in the
+  # order of norm_stats after a run
+  def __init__(self, num_styles=None):
+    self.num_styles = num_styles
+    self.norm_stats = []
+
+  def get_style_weights(self, style=None):
+    # a style index or a blend vector with a weight per style, None is
+    # the first style
+    if style is None or np.ndim(style) == 0:
+      return np.eye(self.num_styles, dtype=np.float32)[style or 0]
+
+    style_weights = np.asarray(style, np.float32)
+    if style_weights.shape != (self.num_styles,):
+      raise ValueError('Expected %d style weights, got %d'
+                       % (self.num_styles, style_weights.size))
+
+    return style_weights
+
+  def _get_moments(self, net, mask):
+    if mask is None:
+      return tf.nn.moments(net, [1, 2], keep_dims=True)
+
+    # the mask at the resolution of net, the stride 2 layers keep the
+    # pixels 2i, like nearest neighbor
+    mask = tf.image.resize_nearest_neighbor(mask, tf.shape(net)[1:3])
+    count = tf.maximum(tf.reduce_sum(mask, [1, 2], keep_dims=True), 1.0)
+    mean = tf.reduce_sum(net * mask, [1, 2], keep_dims=True) / count
+    variance = tf.reduce_sum(tf.square(net - mean) * mask, [1, 2],
+                             keep_dims=True) / count
+
+    return mean, variance
+
+  def _norm(self, net, style_weights, per_sample_norm, mask, norm_stats):
+    if self.num_styles is None and not per_sample_norm:
+      return tf.contrib.layers.batch_norm(net)
+
+    with tf.variable_scope(None, default_name='StyleNorm' if self.num_styles
+                                              else 'BatchNorm'):
+      channels = net.get_shape().as_list()[3]
+      if norm_stats is not None:
+        mean, variance = norm_stats[len(self.norm_stats)]
+      else:
+        mean, variance = self._get_moments(net, mask)
+      self.norm_stats.append((mean, variance))
+      net = (net - mean) * tf.rsqrt(variance + 1e-3)
+
+      if self.num_styles is None:
+        # the beta of tf.contrib.layers.batch_norm, it has no scale
+        beta = tf.get_variable('beta', [channels],
+                               initializer=tf.zeros_initializer())
+
+        return net + beta
+
+      gamma = tf.get_variable('gamma', [self.num_styles, channels],
+                              initializer=tf.ones_initializer())
+      beta = tf.get_variable('beta', [self.num_styles, channels],
+                             initializer=tf.zeros_initializer())
+      scale = tf.matmul(style_weights, gamma)[:, tf.newaxis, tf.newaxis]
+      shift = tf.matmul(style_weights, beta)[:, tf.newaxis, tf.newaxis]
+
+      return net * scale + shift
+
+  def run(self, img, name='transform_net', reuse=None, style_weights=None,
+          per_sample_norm=False, mask=None, norm_stats=None):
+    self.norm_stats = []
+    norm_args = {'style_weights': style_weights,
+                 'per_sample_norm': per_sample_norm,
+                 'mask': mask,
+                 'norm_stats': norm_stats}
+    with tf.variable_scope(name, reuse=reuse):
 
       # conv1
       with tf.variable_scope('conv1'):
         net = tf.contrib.layers.conv2d(img, 32, 9, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.relu(net)
 
         tf.summary.histogram("activation", net)
@@ -18,7 +94,7 @@ class TransformNet():
       # conv2
       with tf.variable_scope('conv2'):
         net = tf.contrib.layers.conv2d(net, 64, 3, stride=2, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.relu(net)
 
         tf.summary.histogram("activation", net)
@@ -26,7 +102,7 @@ class TransformNet():
       # conv3
       with tf.variable_scope('conv3'):
         net = tf.contrib.layers.conv2d(net, 128, 3, stride=2, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.relu(net)
 
         tf.summary.histogram("activation", net)
@@ -34,10 +110,10 @@ class TransformNet():
       # res_block1
       with tf.variable_scope('res_block1'):
         res_net = tf.contrib.layers.conv2d(net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         res_net = tf.nn.relu(res_net)
         res_net = tf.contrib.layers.conv2d(res_net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         net = net + res_net
 
         tf.summary.histogram("activation", net)
@@ -45,10 +121,10 @@ class TransformNet():
       # res_block2
       with tf.variable_scope('res_block2'):
         res_net = tf.contrib.layers.conv2d(net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         res_net = tf.nn.relu(res_net)
         res_net = tf.contrib.layers.conv2d(res_net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         net = net + res_net
 
         tf.summary.histogram("activation", net)
@@ -56,10 +132,10 @@ class TransformNet():
       # res_block3
       with tf.variable_scope('res_block3'):
         res_net = tf.contrib.layers.conv2d(net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         res_net = tf.nn.relu(res_net)
         res_net = tf.contrib.layers.conv2d(res_net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         net = net + res_net
 
         tf.summary.histogram("activation", net)
@@ -67,10 +143,10 @@ class TransformNet():
       # res_block4
       with tf.variable_scope('res_block4'):
         res_net = tf.contrib.layers.conv2d(net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         res_net = tf.nn.relu(res_net)
         res_net = tf.contrib.layers.conv2d(res_net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         net = net + res_net
 
         tf.summary.histogram("activation", net)
@@ -78,10 +154,10 @@ class TransformNet():
       # res_block5
       with tf.variable_scope('res_block5'):
         res_net = tf.contrib.layers.conv2d(net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         res_net = tf.nn.relu(res_net)
         res_net = tf.contrib.layers.conv2d(res_net, 128, 3, activation_fn=None)
-        res_net = tf.contrib.layers.batch_norm(res_net)
+        res_net = self._norm(res_net, **norm_args)
         net = net + res_net
 
         tf.summary.histogram("activation", net)
@@ -89,7 +165,7 @@ class TransformNet():
       # conv_transpose1
       with tf.variable_scope('conv_transpose1'):
         net = tf.contrib.layers.conv2d_transpose(net, 64, 3, stride=2, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.relu(net)
 
         tf.summary.histogram("activation", net)
@@ -97,7 +173,7 @@ class TransformNet():
       # conv_transpose2
       with tf.variable_scope('conv_transpose2'):
         net = tf.contrib.layers.conv2d_transpose(net, 32, 3, stride=2, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.relu(net)
 
         tf.summary.histogram("activation", net)
@@ -105,7 +181,7 @@ class TransformNet():
       # conv_transpose3
       with tf.variable_scope('conv_transpose3'):
         net = tf.contrib.layers.conv2d_transpose(net, 3, 9, activation_fn=None)
-        net = tf.contrib.layers.batch_norm(net)
+        net = self._norm(net, **norm_args)
         net = tf.nn.tanh(net)
 
         tf.summary.histogram("activation", net)
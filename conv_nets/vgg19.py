@@ -16,248 +16,65 @@ class VGG19():
       self.tensorflow_model = pickle.loads(fread.eval())
       s.close()
 
-  def run(self, img, layer_name, name='vgg19'):
-    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
-      # conv1_1
-      with tf.variable_scope('conv1_1'):
-        net = tf.contrib.layers.conv2d(img, 64, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv1_1']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv1_1']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv1_1':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu1_1':
-          return net
-
-      # conv1_2
-      with tf.variable_scope('conv1_2'):
-        net = tf.contrib.layers.conv2d(net, 64, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv1_2']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv1_2']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv1_2':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu1_2':
-          return net
-
-      # maxpool
-      with tf.variable_scope('pool1'):
-        net = tf.contrib.layers.avg_pool2d(net, 2)
-
-      # conv2_1
-      with tf.variable_scope('conv2_1'):
-        net = tf.contrib.layers.conv2d(net, 128, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv2_1']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv2_1']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv2_1':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu2_1':
-          return net
-
-      # conv2_2
-      with tf.variable_scope('conv2_2'):
-        net = tf.contrib.layers.conv2d(net, 128, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv2_2']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv2_2']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv2_2':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu2_2':
-          return net
-
-      # maxpool
-      with tf.variable_scope('pool2'):
-        net = tf.contrib.layers.avg_pool2d(net, 2)
-
-      # conv3_1
-      with tf.variable_scope('conv3_1'):
-        net = tf.contrib.layers.conv2d(net, 256, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_1']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_1']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv3_1':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu3_1':
-          return net
-
-      # conv3_2
-      with tf.variable_scope('conv3_2'):
-        net = tf.contrib.layers.conv2d(net, 256, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_2']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_2']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv3_2':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu3_2':
-          return net
-
-      # conv3_3
-      with tf.variable_scope('conv3_3'):
-        net = tf.contrib.layers.conv2d(net, 256, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_3']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_3']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv3_3':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu3_3':
-          return net
-
-      # conv3_4
-      with tf.variable_scope('conv3_4'):
-        net = tf.contrib.layers.conv2d(net, 256, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_4']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv3_4']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv3_4':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu3_4':
-          return net
+      # (layer, num_outputs), num_outputs is None for pooling layers
+      self.layers = [('conv1_1', 64), ('conv1_2', 64), ('pool1', None),
+                     ('conv2_1', 128), ('conv2_2', 128), ('pool2', None),
+                     ('conv3_1', 256), ('conv3_2', 256), ('conv3_3', 256),
+                     ('conv3_4', 256), ('pool3', None),
+                     ('conv4_1', 512), ('conv4_2', 512), ('conv4_3', 512),
+                     ('conv4_4', 512), ('pool4', None),
+                     ('conv5_1', 512), ('conv5_2', 512), ('conv5_3', 512),
+                     ('conv5_4', 512), ('pool5', None)]
+
+  def get_num_pools(self, layer_name):
+    # number of 2x2 poolings applied before layer_name
+    if layer_name.startswith('relu'):
+      layer_name = 'conv' + layer_name[len('relu'):]
+
+    num_pools = 0
+    for layer, num_outputs in self.layers:
+      if layer == layer_name:
+        return num_pools
+      if num_outputs is None:
+        num_pools = num_pools + 1
+
+    raise ValueError('Unknown VGG19 layer: ' + layer_name)
 
-      # maxpool
-      with tf.variable_scope('pool3'):
-        net = tf.contrib.layers.avg_pool2d(net, 2)
-
-      # conv4_1
-      with tf.variable_scope('conv4_1'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_1']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_1']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv4_1':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu4_1':
-          return net
-
-      # conv4_2
-      with tf.variable_scope('conv4_2'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_2']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_2']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv4_2':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu4_2':
-          return net
-
-      # conv4_3
-      with tf.variable_scope('conv4_3'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_3']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_3']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv4_3':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu4_3':
-          return net
-
-      # conv4_4
-      with tf.variable_scope('conv4_4'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_4']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv4_4']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv4_4':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu4_4':
-          return net
-
-      # maxpool
-      with tf.variable_scope('pool4'):
-        net = tf.contrib.layers.avg_pool2d(net, 2)
-
-      # conv5_1
-      with tf.variable_scope('conv5_1'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_1']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_1']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv5_1':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu5_1':
-          return net
-
-      # conv5_2
-      with tf.variable_scope('conv5_2'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_2']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_2']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv5_2':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu5_2':
-          return net
-
-      # conv5_3
-      with tf.variable_scope('conv5_3'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_3']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_3']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv5_3':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu5_3':
-          return net
+  def run(self, img, layer_name, name='vgg19'):
+    return self.run_layers(img, [layer_name], name=name)[layer_name]
 
-      # conv5_4
-      with tf.variable_scope('conv5_4'):
-        net = tf.contrib.layers.conv2d(net, 512, 3,
-                  weights_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_4']['weights']),
-                  biases_initializer=tf.constant_initializer(
-                      self.tensorflow_model['conv5_4']['biases']),
-                  activation_fn=None)
-        if layer_name == 'conv5_4':
-          return net
-        net = tf.nn.relu(net)
-        if layer_name == 'relu5_4':
-          return net
+  def run_layers(self, img, layer_names, name='vgg19'):
+    # single forward pass that stops after the deepest requested layer
+    remaining = set(layer_names)
+    taps = {}
 
-      # maxpool
-      with tf.variable_scope('pool5'):
-        net = tf.contrib.layers.avg_pool2d(net, 2)
+    with tf.variable_scope(name, reuse=tf.AUTO_REUSE):
+      net = img
+      for layer, num_outputs in self.layers:
+        if not remaining:
+          break
+
+        with tf.variable_scope(layer):
+          if num_outputs is None:
+            net = tf.contrib.layers.avg_pool2d(net, 2)
+            continue
+
+          net = tf.contrib.layers.conv2d(net, num_outputs, 3,
+                    weights_initializer=tf.constant_initializer(
+                        self.tensorflow_model[layer]['weights']),
+                    biases_initializer=tf.constant_initializer(
+                        self.tensorflow_model[layer]['biases']),
+                    activation_fn=None)
+          if layer in remaining:
+            taps[layer] = net
+            remaining.remove(layer)
+          net = tf.nn.relu(net)
+          relu_name = 'relu' + layer[len('conv'):]
+          if relu_name in remaining:
+            taps[relu_name] = net
+            remaining.remove(relu_name)
+
+    if remaining:
+      raise ValueError('Unknown VGG19 layers: ' + ', '.join(sorted(remaining)))
+
+    return taps
@@ -1,12 +1,15 @@
 import cv2
+import time
 import numpy as np
 import scipy.io as sio
 import tensorflow as tf
 from io import BytesIO
-from scipy.sparse import csr_matrix
+from scipy.sparse import coo_matrix, csr_matrix
 import matplotlib.pyplot as plt
 
 from utils import Utils
+from early_stopping import EarlyStopping
+from async_writer import AsyncWriter
 try:
   from conv_nets.vgg19 import VGG19
 except ImportError: #gcloud
@@ -31,9 +34,22 @@ class StyleTransfer():
       alfa=100.0,
       beta=1.0,
       gamma=0.03,
+      llambda=1e4,
+      matting_eps=1e-7,
+      matting_win_rad=1,
       learning_rate=2,
       num_iters=2000,
-      output_img_init='random'):
+      optimizer='adam',
+      target_loss=None,
+      stop_rel_tol=None,
+      stop_window=100,
+      stop_max_time=None,
+      stop_min_iters=0,
+      log_interval=1.0,
+      output_img_init='random',
+      mask_palette=None,
+      mask_tolerance=(49, 51),
+      mask_gram_mode='batched'):
     self.vgg_means = [103.939, 116.779, 123.68] # BGR
     self.model_name = model_name
     self.tensorflow_model_path = tensorflow_model_path
@@ -54,66 +70,90 @@ class StyleTransfer():
     self.alfa = alfa
     self.beta = beta
     self.gamma = gamma
+    self.llambda = llambda
+    self.matting_eps = matting_eps
+    self.matting_win_rad = matting_win_rad
 
     self.learning_rate = learning_rate
     self.num_iters = num_iters
+    self.optimizer = optimizer
+    self.target_loss = target_loss
+
+    self.stop_rel_tol = stop_rel_tol
+    self.stop_window = stop_window
+    self.stop_max_time = stop_max_time
+    self.stop_min_iters = stop_min_iters
+
+    # seconds between two loss lines
+    self.log_interval = log_interval
+    self.last_log_time = 0.0
 
     self.output_img_init = output_img_init
 
-    # self.mask_color = {'color': [B, G, R]}
-    self.mask_color = {'white': [205, 205, 205],
-                       'black': [52, 52, 52],
-                       'blue': [205, 52, 52],
-                       'green': [52, 205, 52],
-                       'red': [52, 52, 205]}
-    self.mask_channels = len(self.mask_color)
+    # self.mask_palette = [[B, G, R], ...], one mask channel per color
+    self.mask_palette = mask_palette or [[255, 255, 255], # white
+                                         [0, 0, 0], # black
+                                         [255, 0, 0], # blue
+                                         [0, 255, 0], # green
+                                         [0, 0, 255]] # red
+    # a pixel gets a label if every channel is within mask_tolerance of the
+    # label color, otherwise it belongs to no label. (high, low): the
+    # tolerance of the channels >= 128 and < 128 of the color, the default
+    # (49, 51) is exactly the old > 205 / < 52 thresholds. An int is the
+    # same tolerance on both sides
+    if np.ndim(mask_tolerance) == 0:
+      mask_tolerance = (mask_tolerance, mask_tolerance)
+    self.mask_tolerance = tuple(mask_tolerance)
+    self.mask_channels = len(self.mask_palette)
+    # 'batched': one batched matmul over all labels
+    # 'gather': per label matmul over only the pixels the label covers
+    self.mask_gram_mode = mask_gram_mode
 
   def _get_mask_img(self, mask_img_path,
                     mask_img_height,
                     mask_img_width,
-                    mask_img_channels):
+                    mask_img_channels,
+                    cache_path=None):
     ut = Utils()
+    if type(mask_img_path) == type(''):
+      key = None
+    else:
+      key = ut.get_cache_key(mask_img_path.tobytes(),
+                             mask_img_height,
+                             mask_img_width,
+                             self.mask_palette,
+                             self.mask_tolerance)
+      cached = ut.load_cache(cache_path, key)
+      if cached is not None:
+        return cached['mask']
+
     mask_img = ut.get_img(mask_img_path,
                           width=mask_img_width,
                           height=mask_img_height,
                           model=None)
-    input_mask = None
-
-    for k, v in self.mask_color.items():
-      curr_mask = np.zeros((mask_img.shape[0], mask_img.shape[1], 1), dtype=np.uint8)
-
-      for i in range(mask_img.shape[0]):
-        for j in range((mask_img.shape[1])):
-          if k == 'white' \
-                  and mask_img[i][j][0] > v[0] \
-                  and mask_img[i][j][1] > v[1] \
-                  and mask_img[i][j][2] > v[2]:
-            curr_mask[i][j][0] = 1
-          elif k == 'black' \
-                    and mask_img[i][j][0] < v[0] \
-                    and mask_img[i][j][1] < v[1] \
-                    and mask_img[i][j][2] < v[2]:
-            curr_mask[i][j][0] = 1
-          elif k == 'blue' \
-                    and mask_img[i][j][0] > v[0] \
-                    and mask_img[i][j][1] < v[1] \
-                    and mask_img[i][j][2] < v[2]:
-            curr_mask[i][j][0] = 1
-          elif k == 'green' \
-                    and mask_img[i][j][0] < v[0] \
-                    and mask_img[i][j][1] > v[1] \
-                    and mask_img[i][j][2] < v[2]:
-            curr_mask[i][j][0] = 1
-          elif k == 'red' \
-                    and mask_img[i][j][0] < v[0] \
-                    and mask_img[i][j][1] < v[1] \
-                    and mask_img[i][j][2] > v[2]:
-            curr_mask[i][j][0] = 1
-
-      if input_mask is None:
-        input_mask = curr_mask
-      else:
-        input_mask = np.concatenate((input_mask, curr_mask), axis=2)
+    palette = np.array(self.mask_palette, dtype=np.float32)
+    tolerance = np.where(palette >= 128,
+                         self.mask_tolerance[0],
+                         self.mask_tolerance[1]).astype(np.float32)
+
+    # largest per-channel distance beyond the tolerance from every pixel to
+    # every palette color, [H, W, K], <= 0 where the color matches
+    dist = np.full((mask_img.shape[0], mask_img.shape[1], self.mask_channels),
+                   -np.inf, dtype=np.float32)
+    for ch in range(palette.shape[1]):
+      np.maximum(dist,
+                 np.abs(mask_img[:, :, ch:ch + 1] - palette[:, ch])
+                 - tolerance[:, ch],
+                 out=dist)
+
+    label = np.argmin(dist, axis=2)
+    matched = np.min(dist, axis=2) <= 0
+    input_mask = np.logical_and(label[:, :, np.newaxis] \
+                                  == np.arange(self.mask_channels),
+                                matched[:, :, np.newaxis]).astype(np.uint8)
+
+    if key is not None:
+      ut.save_cache(cache_path, key, {'mask': input_mask})
 
     return input_mask
 
@@ -133,54 +173,202 @@ class StyleTransfer():
 
     return content_loss
 
-  def _get_style_loss(self, style_layer, noise_layer,
-                            mask_style_img, mask_content_img):
+  def _get_mask_pyramid(self, mask_img, num_levels):
+    # 2x2 average pooling, the same downsampling VGG19 applies to features
+    mask_pyramid = [mask_img]
+    for _ in range(num_levels - 1):
+      mask_pyramid.append(tf.nn.avg_pool(mask_pyramid[-1],
+                                         ksize=[1, 2, 2, 1],
+                                         strides=[1, 2, 2, 1],
+                                         padding='VALID'))
+
+    return mask_pyramid
+
+  def _get_masked_gram_matrices(self, layer, mask_img):
+    channels_matrix_img = tf.reshape(layer, [-1, tf.shape(layer)[3]])
+    mask_matrix_img = tf.reshape(mask_img, [-1, self.mask_channels])
+
+    if self.mask_gram_mode == 'gather':
+      gram_matrices = []
+      for c in range(self.mask_channels):
+        idx = tf.where(mask_matrix_img[:, c] > 0)[:, 0]
+        masked_matrix_img = tf.gather(channels_matrix_img, idx) \
+                            * tf.expand_dims(tf.gather(mask_matrix_img[:, c],
+                                                       idx), 1)
+        gram_matrices.append(tf.matmul(masked_matrix_img, masked_matrix_img,
+                                       transpose_a=True))
+
+      return tf.stack(gram_matrices)
+
+    # [K, H * W, C], every label masks its own copy of the features
+    masked_matrix_img = tf.expand_dims(tf.transpose(mask_matrix_img), 2) \
+                        * tf.expand_dims(channels_matrix_img, 0)
+
+    return tf.matmul(masked_matrix_img, masked_matrix_img, transpose_a=True)
+
+  def _get_style_loss(self, gram_matrices_style, style_layer_shape,
+                            noise_layer, mask_content_img):
     style_loss = tf.constant(0.0)
 
-    sz = tf.constant([style_layer.get_shape().as_list()[1],
-                      style_layer.get_shape().as_list()[2]])
-    style_img = tf.image.resize_images(mask_style_img, sz)
-    sz = tf.constant([noise_layer.get_shape().as_list()[1],
-                      noise_layer.get_shape().as_list()[2]])
-    content_img = tf.image.resize_images(mask_content_img, sz)
-
-    for c in range(self.mask_channels):
-      mask_matrix_style_img = tf.multiply(style_layer,
-                                          tf.reshape(style_img[:, :, :, c],
-                                                     [tf.shape(style_img)[0],
-                                                      tf.shape(style_img)[1],
-                                                      tf.shape(style_img)[2],
-                                                      1]))
-      mask_matrix_noise_img = tf.multiply(noise_layer,
-                                          tf.reshape(content_img[:, :, :, c],
-                                                     [tf.shape(content_img)[0],
-                                                      tf.shape(content_img)[1],
-                                                      tf.shape(content_img)[2],
-                                                      1]))
-
-      channels_matrix_style_img = tf.reshape(mask_matrix_style_img,
-                                             [-1, tf.shape(mask_matrix_style_img)[3]])
-      channels_matrix_noise_img = tf.reshape(mask_matrix_noise_img,
-                                             [-1, tf.shape(mask_matrix_noise_img)[3]])
-
-      gram_matrix_style = tf.matmul(tf.transpose(channels_matrix_style_img),
-                                    channels_matrix_style_img)
-      gram_matrix_noise = tf.matmul(tf.transpose(channels_matrix_noise_img),
-                                    channels_matrix_noise_img)
-
-      El = tf.reduce_sum(tf.square(gram_matrix_style - gram_matrix_noise))
-      El = tf.scalar_mul(1.0 / (4.0
-                         * tf.square(tf.cast(tf.shape(style_layer)[1],
-                                             tf.float32))
-                         * tf.square(tf.cast(tf.shape(style_layer)[2],
-                                             tf.float32))
-                         * tf.square(tf.cast(tf.shape(style_layer)[3],
-                                             tf.float32))),
-                         El)
-      style_loss = style_loss + El
+    gram_matrices_noise = self._get_masked_gram_matrices(noise_layer,
+                                                         mask_content_img)
+
+    # every label shares the same normalization, so the per-label terms
+    # can be summed in one reduction
+    El = tf.reduce_sum(tf.square(gram_matrices_style - gram_matrices_noise))
+    El = tf.scalar_mul(1.0 / (4.0
+                       * float(style_layer_shape[1]) ** 2
+                       * float(style_layer_shape[2]) ** 2
+                       * float(style_layer_shape[3]) ** 2),
+                       El)
+    style_loss = style_loss + El
 
     return style_loss
 
+  def _load_style_grams(self, sess, ut, style_img_bytes, mask_style_img_bytes,
+                        style_img, mask_style_img, cache_path):
+    key = ut.get_cache_key(style_img_bytes,
+                           mask_style_img_bytes,
+                           self.mask_palette,
+                           self.mask_tolerance,
+                           'avg_pool_mask_pyramid',
+                           self.style_img_height,
+                           self.style_img_width,
+                           self.style_layers,
+                           self.tensorflow_model_path)
+    style_grams = ut.load_cache(cache_path, key)
+    if style_grams is None:
+      style_grams = sess.run(self.style_grams,
+                             feed_dict={self.style_img: style_img,
+                                        self.mask_style_img: mask_style_img})
+      ut.save_cache(cache_path, key, style_grams)
+
+    for style_layer_name, style_gram in self.style_grams_var.items():
+      style_gram.load(style_grams[style_layer_name], sess)
+
+  def _load_mask_pyramid(self, sess, mask_content_img):
+    mask_content_pyramid = sess.run(self.mask_content_pyramid,
+        feed_dict={self.mask_content_img: mask_content_img})
+
+    for level, mask_content in self.mask_content_pyramid_var.items():
+      mask_content.load(mask_content_pyramid[level], sess)
+
+  def _get_matting_laplacian(self, img, eps=1e-7, win_rad=1,
+                             chunk_windows=65536):
+    # closed form matting laplacian (Levin et al.), img is [H, W, C] in [0, 1].
+    # Built over chunks of window rows, each chunk is summed into a csr
+    # piece right away, so the N x win_size^2 intermediates only exist for
+    # chunk_windows windows at a time
+    win_diam = 2 * win_rad + 1
+    win_size = win_diam ** 2
+    h, w, d = img.shape
+    img = img.reshape(h * w, d)
+
+    # pixel indices of every win_diam x win_diam window, [rows, cols, win_size]
+    idx = np.arange(h * w, dtype=np.int32).reshape((h, w))
+    win_idx = np.lib.stride_tricks.as_strided(
+        idx,
+        shape=(h - 2 * win_rad, w - 2 * win_rad, win_diam, win_diam),
+        strides=idx.strides * 2).reshape(h - 2 * win_rad, w - 2 * win_rad,
+                                         win_size)
+    chunk_rows = max(chunk_windows // max(w - 2 * win_rad, 1), 1)
+
+    rows = []
+    cols = []
+    values = []
+    for r in range(0, h - 2 * win_rad, chunk_rows):
+      chunk_idx = win_idx[r:r + chunk_rows].reshape(-1, win_size)
+
+      win_img = img[chunk_idx].astype(np.float64)
+      win_mu = np.mean(win_img, axis=1, keepdims=True)
+      win_var = np.einsum('nji,njk->nik', win_img, win_img) / win_size \
+                - np.einsum('nji,njk->nik', win_mu, win_mu)
+      win_inv = np.linalg.inv(win_var + (eps / win_size) * np.eye(d))
+
+      win_centered = win_img - win_mu
+      x = np.einsum('nij,njk->nik', win_centered, win_inv)
+      chunk_values = np.eye(win_size) \
+                     - (1.0 + np.einsum('nij,nkj->nik', x, win_centered)) \
+                       / win_size
+
+      # csr sums the contributions of overlapping windows in the chunk
+      piece = coo_matrix((chunk_values.ravel().astype(np.float32),
+                          (np.repeat(chunk_idx, win_size, axis=1).ravel(),
+                           np.tile(chunk_idx, win_size).ravel())),
+                         shape=(h * w, h * w)).tocsr().tocoo()
+      rows.append(piece.row.astype(np.int32))
+      cols.append(piece.col.astype(np.int32))
+      values.append(piece.data)
+
+    # the pieces only overlap on the window rows shared by two chunks
+    laplacian = coo_matrix((np.concatenate(values),
+                            (np.concatenate(rows), np.concatenate(cols))),
+                           shape=(h * w, h * w)).tocsr()
+
+    return laplacian
+
+  def _load_laplacian(self, ut, content_img_bytes, content_img, cache_path):
+    key = ut.get_cache_key(content_img_bytes,
+                           self.content_img_height,
+                           self.content_img_width,
+                           'matting_laplacian',
+                           self.matting_eps,
+                           self.matting_win_rad)
+    laplacian = ut.load_cache(cache_path, key)
+    if laplacian is None:
+      img = (content_img[0] + self.vgg_means) / 255.0
+      laplacian = self._get_matting_laplacian(img,
+                                              eps=self.matting_eps,
+                                              win_rad=self.matting_win_rad).tocoo()
+      laplacian = {'indices': np.stack([laplacian.row, laplacian.col],
+                                       axis=1).astype(np.int64),
+                   'values': laplacian.data.astype(np.float32)}
+      ut.save_cache(cache_path, key, laplacian)
+
+    return laplacian
+
+  def _get_photorealism_loss(self, laplacian, noise_img_normalized):
+    channels_matrix_img = tf.reshape(noise_img_normalized,
+                                     [-1, self.noise_img_channels])
+    photorealism_loss = tf.reduce_sum(channels_matrix_img
+        * tf.sparse_tensor_dense_matmul(laplacian, channels_matrix_img))
+
+    return photorealism_loss
+
+  def _log_step(self, i, content_loss, style_loss, tv_loss, photo_loss,
+                out_loss, start_time):
+    if time.time() - self.last_log_time >= self.log_interval:
+      self.last_log_time = time.time()
+      print('it %d: content %g, style %g, tv %g, photorealism %g, total %g'
+            % (i, content_loss, style_loss, tv_loss, photo_loss, out_loss))
+
+    self._log_target_loss(i, out_loss, start_time)
+
+  def _log_target_loss(self, i, out_loss, start_time):
+    if self.target_loss is None or self.target_evals is not None:
+      return
+
+    if out_loss <= self.target_loss:
+      self.target_evals = i + 1
+      print('Target loss %f reached after %d evaluations in %.2f s'
+            % (self.target_loss, self.target_evals, time.time() - start_time))
+
+  def _save_snapshot(self, sess, ut, writer, summ, feed_dict,
+                     i, out_img, output_img_path, show_img, s=None):
+    decoded_img = ut.denormalize_img(out_img[0])
+    self.async_writer.write_img(output_img_path + '/img' + str(i) + '.png',
+                                decoded_img)
+
+    if show_img:
+      plt.axis("off")
+      plt.imshow(cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB))
+      plt.show()
+
+    if s is None:
+      s = sess.run(summ, feed_dict=feed_dict)
+    writer.add_summary(s, i)
+    writer.add_summary(self.async_writer.get_summary(), i)
+
   def _get_total_variation_loss(self, noise_img):
     tv_loss = tf.reduce_sum(tf.image.total_variation(noise_img))
 
@@ -218,38 +406,118 @@ class StyleTransfer():
 
     self.total_variation_loss = self._get_total_variation_loss(self.noise_img)
 
+    content_layers = self.model.run_layers(self.content_img, self.content_layers)
+    style_layers = self.model.run_layers(self.style_img, self.style_layers)
+    noise_layers = self.model.run_layers(self.noise_img,
+                                         self.content_layers + self.style_layers)
+
     self.content_loss = tf.constant(0.0)
     for content_layer_name in self.content_layers:
-      content_layer = self.model.run(self.content_img, content_layer_name)
-      noise_layer = self.model.run(self.noise_img, content_layer_name)
+      content_layer = content_layers[content_layer_name]
+      noise_layer = noise_layers[content_layer_name]
       self.content_loss = self.content_loss \
                           + self._get_content_loss(content_layer, noise_layer)
 
+    # masks are downsampled once per VGG pooling level; the content mask
+    # pyramid is evaluated once in train and kept in local variables
+    num_levels = max([self.model.get_num_pools(style_layer_name)
+                      for style_layer_name in self.style_layers]) + 1
+    mask_style_pyramid = self._get_mask_pyramid(self.mask_style_img,
+                                                num_levels)
+    mask_content_pyramid = self._get_mask_pyramid(self.mask_content_img,
+                                                  num_levels)
+    self.mask_content_pyramid = {}
+    self.mask_content_pyramid_var = {}
+    for style_layer_name in self.style_layers:
+      level = self.model.get_num_pools(style_layer_name)
+      if level in self.mask_content_pyramid:
+        continue
+      self.mask_content_pyramid[level] = mask_content_pyramid[level]
+      self.mask_content_pyramid_var[level] = tf.get_variable(
+          name='mask_content_' + str(level),
+          shape=[1] + mask_content_pyramid[level].get_shape().as_list()[1:],
+          initializer=tf.zeros_initializer(),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+    # the style image and its mask never change, the masked grams are
+    # evaluated once in train and kept in local (non-checkpointed) variables
+    self.style_grams = {}
+    self.style_grams_var = {}
     self.style_loss = tf.constant(0.0)
     for i, style_layer_name in enumerate(self.style_layers):
-      style_layer = self.model.run(self.style_img, style_layer_name)
-      noise_layer = self.model.run(self.noise_img, style_layer_name)
+      style_layer = style_layers[style_layer_name]
+      noise_layer = noise_layers[style_layer_name]
+      style_layer_shape = style_layer.get_shape().as_list()
+      level = self.model.get_num_pools(style_layer_name)
+
+      self.style_grams[style_layer_name] = self._get_masked_gram_matrices(
+          style_layer, mask_style_pyramid[level])
+      self.style_grams_var[style_layer_name] = tf.get_variable(
+          name='style_gram_' + style_layer_name,
+          shape=[self.mask_channels,
+                 style_layer_shape[3],
+                 style_layer_shape[3]],
+          initializer=tf.zeros_initializer(),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
       self.style_loss = self.style_loss \
                           + tf.scalar_mul(self.style_layers_w[i],
-                                self._get_style_loss(style_layer, noise_layer,
-                                                     self.mask_style_img,
-                                                     self.mask_content_img))
+                                self._get_style_loss(
+                                    self.style_grams_var[style_layer_name],
+                                    style_layer_shape,
+                                    noise_layer,
+                                    self.mask_content_pyramid_var[level]))
 
     self.noise_img_normalized = (self.noise_img + self.vgg_means) / 255.0
 
+    # the sparse laplacian of the content image is built once in train and
+    # kept in local variables, its size is only known at that point
+    if self.llambda != 0.0:
+      self.laplacian_indices_init = tf.placeholder(tf.int64, [None, 2])
+      self.laplacian_values_init = tf.placeholder(tf.float32, [None])
+      laplacian_indices = tf.get_variable(name='laplacian_indices',
+          initializer=self.laplacian_indices_init,
+          validate_shape=False,
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      laplacian_values = tf.get_variable(name='laplacian_values',
+          initializer=self.laplacian_values_init,
+          validate_shape=False,
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      num_pixels = self.noise_img_height * self.noise_img_width
+      laplacian = tf.SparseTensor(indices=laplacian_indices,
+                                  values=laplacian_values,
+                                  dense_shape=[num_pixels, num_pixels])
+      self.photorealism_loss = self._get_photorealism_loss(
+          laplacian, self.noise_img_normalized)
+    else:
+      self.photorealism_loss = tf.constant(0.0)
+
     self.total_loss = self.alfa * self.content_loss \
                       + self.beta * self.style_loss \
-                      + self.gamma * self.total_variation_loss
+                      + self.gamma * self.total_variation_loss \
+                      + self.llambda * self.photorealism_loss
 
     var_list = tf.trainable_variables()
     self.var_list = [var for var in var_list if 'output_image' in var.name]
 
-    self.optim = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
-        name='adam_optimizer').minimize(self.total_loss, var_list=self.var_list)
+    if self.optimizer == 'lbfgs':
+      # one scipy iteration may take several loss evaluations
+      self.optim = tf.contrib.opt.ScipyOptimizerInterface(self.total_loss,
+          var_list=self.var_list,
+          method='L-BFGS-B',
+          options={'maxiter': self.num_iters})
+    else:
+      self.optim = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
+          name='adam_optimizer').minimize(self.total_loss, var_list=self.var_list)
 
     tf.summary.scalar('content_loss', self.content_loss)
     tf.summary.scalar('style_loss', self.style_loss)
     tf.summary.scalar('tv_loss', self.total_variation_loss)
+    tf.summary.scalar('photorealism_loss', self.photorealism_loss)
     tf.summary.scalar('total_loss', self.total_loss)
 
     tf.summary.histogram("noise_img", self.noise_img)
@@ -273,10 +541,12 @@ class StyleTransfer():
             mask_style_img_path='images/mask/mask_d_style6_resized.png',
             output_img_path='results/dpst',
             tensorboard_path='tensorboard/tensorboard_dpst',
-            show_img=None):
+            show_img=None,
+            cache_path='cache'):
     summ = tf.summary.merge_all()
     with tf.Session() as sess:
       ut = Utils()
+      self.async_writer = AsyncWriter()
       noise_img_bytes = sess.run(self.file_bytes,
           feed_dict={self.name_file: noise_img_path})
       noise_img_np = np.fromstring(noise_img_bytes, np.uint8)
@@ -292,9 +562,9 @@ class StyleTransfer():
       writer = tf.summary.FileWriter(tensorboard_path)
       writer.add_graph(sess.graph)
 
-      img_bytes = sess.run(self.file_bytes,
+      content_img_bytes = sess.run(self.file_bytes,
           feed_dict={self.name_file: content_img_path})
-      img_np = np.fromstring(img_bytes, np.uint8)
+      img_np = np.fromstring(content_img_bytes, np.uint8)
       content_img = np.reshape(ut.get_img(img_np,
                                           width=self.content_img_width,
                                           height=self.content_img_height),
@@ -302,9 +572,20 @@ class StyleTransfer():
                                            self.content_img_height,
                                            self.content_img_width,
                                            self.content_img_channels))
-      img_bytes = sess.run(self.file_bytes,
+
+      if self.llambda != 0.0:
+        laplacian = self._load_laplacian(ut, content_img_bytes, content_img,
+                                         cache_path)
+        sess.run(tf.local_variables_initializer(),
+                 feed_dict={self.laplacian_indices_init: laplacian['indices'],
+                            self.laplacian_values_init: laplacian['values']})
+        print('Done loading matting laplacian.')
+      else:
+        sess.run(tf.local_variables_initializer())
+
+      style_img_bytes = sess.run(self.file_bytes,
           feed_dict={self.name_file: style_img_path})
-      img_np = np.fromstring(img_bytes, np.uint8)
+      img_np = np.fromstring(style_img_bytes, np.uint8)
       style_img = np.reshape(ut.get_img(img_np,
                                         width=self.style_img_width,
                                         height=self.style_img_height),
@@ -319,58 +600,84 @@ class StyleTransfer():
       mask_content_img = np.reshape(self._get_mask_img(img_np,
                                                        self.content_img_height,
                                                        self.content_img_width,
-                                                       self.content_img_channels),
+                                                       self.content_img_channels,
+                                                       cache_path),
                                     (1,
                                      self.content_img_height,
                                      self.content_img_width,
                                      self.mask_channels))
-      img_bytes = sess.run(self.file_bytes,
+      mask_style_img_bytes = sess.run(self.file_bytes,
           feed_dict={self.name_file: mask_style_img_path})
-      img_np = np.fromstring(img_bytes, np.uint8)
+      img_np = np.fromstring(mask_style_img_bytes, np.uint8)
       mask_style_img = np.reshape(self._get_mask_img(img_np,
                                                      self.style_img_height,
                                                      self.style_img_width,
-                                                     self.style_img_channels),
+                                                     self.style_img_channels,
+                                                     cache_path),
                                   (1,
                                    self.style_img_height,
                                    self.style_img_width,
                                    self.mask_channels))
       print('Done loading mask images.')
-
-      for i in range(self.num_iters):
-        _, content_loss, style_loss, tv_loss, out_loss, out_img =  sess.run(
-              [self.optim,
-               self.content_loss,
-               self.style_loss,
-               self.total_variation_loss,
-               self.total_loss,
-               self.noise_img],
-              feed_dict={self.content_img: content_img,
-                         self.style_img: style_img,
-                         self.mask_content_img: mask_content_img,
-                         self.mask_style_img: mask_style_img})
-
-        print('it: ', i)
-        print('Content loss: ', content_loss)
-        print('Style loss: ', style_loss)
-        print('Total variation loss: ', tv_loss)
-        print('Total loss: ', out_loss)
-
-        if i % 50 == 0:
-          decoded_img = ut.denormalize_img(out_img[0])
-          decoded_img = cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB)
-          sess.run(self.fwrite,
-                   feed_dict={self.decoded_img: decoded_img,
-                              self.name_file: output_img_path + '/img' + str(i) + '.png'})
-
-          if show_img:
-            plt.axis("off")
-            plt.imshow(decoded_img)
-            plt.show()
-
-          s = sess.run(summ,
-                       feed_dict={self.content_img: content_img,
-                                  self.style_img: style_img,
-                                  self.mask_content_img: mask_content_img,
-                                  self.mask_style_img: mask_style_img})
-          writer.add_summary(s, i)
+      self._load_style_grams(sess, ut, style_img_bytes, mask_style_img_bytes,
+                             style_img, mask_style_img, cache_path)
+      self._load_mask_pyramid(sess, mask_content_img)
+      feed_dict = {self.content_img: content_img}
+
+      losses = [self.content_loss, self.style_loss, self.total_variation_loss,
+                self.photorealism_loss, self.total_loss]
+      self.target_evals = None
+      start_time = time.time()
+
+      if self.optimizer == 'lbfgs':
+        evals = [0]
+
+        def loss_callback(content_loss, style_loss, tv_loss, photo_loss,
+                          out_loss, out_img):
+          i = evals[0]
+          evals[0] = i + 1
+          self._log_step(i, content_loss, style_loss, tv_loss, photo_loss,
+                         out_loss, start_time)
+
+          if i % 50 == 0:
+            self._save_snapshot(sess, ut, writer, summ, feed_dict,
+                                i, out_img, output_img_path, show_img)
+
+        self.optim.minimize(sess,
+                            feed_dict=feed_dict,
+                            fetches=losses + [self.noise_img],
+                            loss_callback=loss_callback)
+        num_evals = evals[0]
+      else:
+        stopping = EarlyStopping(rel_tol=self.stop_rel_tol,
+                                 window=self.stop_window,
+                                 max_time=self.stop_max_time,
+                                 min_iters=self.stop_min_iters)
+        i = -1
+        for i in range(self.num_iters):
+          # the image and the summaries ride along only on snapshot steps
+          snapshot = i % 50 == 0
+          fetches = [self.optim] + losses
+          if snapshot:
+            fetches = fetches + [self.noise_img, summ]
+          results = sess.run(fetches, feed_dict=feed_dict)
+          content_loss, style_loss, tv_loss, photo_loss, out_loss = results[1:6]
+          self._log_step(i, content_loss, style_loss, tv_loss, photo_loss,
+                         out_loss, start_time)
+
+          if snapshot:
+            self._save_snapshot(sess, ut, writer, summ, feed_dict,
+                                i, results[6], output_img_path, show_img,
+                                s=results[7])
+
+          if stopping.update(i, out_loss):
+            break
+        num_evals = i + 1
+        stopping.report(i, self.num_iters)
+
+      print('%s: %d evaluations in %.2f s'
+            % (self.optimizer, num_evals, time.time() - start_time))
+      if self.target_loss is not None and self.target_evals is None:
+        print('Target loss %f not reached' % self.target_loss)
+      self.async_writer.close()
+      print('Blocked on image writes: %.2f s' % self.async_writer.blocked_time)
@@ -0,0 +1,49 @@
+import time
+from collections import deque
+
+class EarlyStopping():
+  def __init__(self,
+        rel_tol=None,
+        window=100,
+        max_time=None,
+        min_iters=0):
+    # stop when total_loss improved by less than rel_tol (relative) over
+    # the last window iterations, or after max_time seconds, but never
+    # before min_iters iterations
+    self.rel_tol = rel_tol
+    self.window = window
+    self.max_time = max_time
+    self.min_iters = min_iters
+
+    self.losses = deque(maxlen=window + 1)
+    self.start_time = time.time()
+    self.stop_reason = None
+
+  def update(self, i, loss):
+    self.losses.append(loss)
+
+    if i + 1 < self.min_iters:
+      return False
+
+    if self.max_time is not None \
+        and time.time() - self.start_time > self.max_time:
+      self.stop_reason = 'time budget of %.0f s exhausted' % self.max_time
+      return True
+
+    if self.rel_tol is not None and len(self.losses) == self.losses.maxlen:
+      old_loss = self.losses[0]
+      rel_improvement = (old_loss - loss) / max(abs(old_loss), 1e-12)
+      if rel_improvement < self.rel_tol:
+        self.stop_reason = 'relative improvement %g over %d iterations' \
+                           ' below %g' % (rel_improvement, self.window,
+                                          self.rel_tol)
+        return True
+
+    return False
+
+  def report(self, i, num_iters):
+    if self.stop_reason is None:
+      print('Ran all %d iterations' % num_iters)
+    else:
+      print('Stopped at it %d: %s, %d steps saved'
+            % (i, self.stop_reason, num_iters - i - 1))
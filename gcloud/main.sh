@@ -6,10 +6,17 @@ mkdir $DIRECTORY
 
 cp ../main.py $DIRECTORY/main.py
 cp ../utils.py $DIRECTORY/utils.py
+cp ../early_stopping.py $DIRECTORY/early_stopping.py
+cp ../async_writer.py $DIRECTORY/async_writer.py
 cp ../pretrained_models/model.py $DIRECTORY/model.py
 cp ../a_neural_algorithm_of_artistic_style/anaoas_style_transfer.py $DIRECTORY/anaoas_style_transfer.py
 cp ../perceptual_losses_for_real_time_style_transfer/plfrtst_style_transfer.py $DIRECTORY/plfrtst_style_transfer.py
 cp ../perceptual_losses_for_real_time_style_transfer/dataset.py $DIRECTORY/dataset.py
+cp ../perceptual_losses_for_real_time_style_transfer/stylizer.py $DIRECTORY/stylizer.py
+cp ../perceptual_losses_for_real_time_style_transfer/server.py $DIRECTORY/server.py
+cp ../perceptual_losses_for_real_time_style_transfer/registry.py $DIRECTORY/registry.py
+cp ../perceptual_losses_for_real_time_style_transfer/video.py $DIRECTORY/video.py
+cp ../perceptual_losses_for_real_time_style_transfer/cluster.py $DIRECTORY/cluster.py
 cp ../deep_photo_style_transfer/dpst_style_transfer.py $DIRECTORY/dpst_style_transfer.py
 cp ../conv_nets/transform_net.py $DIRECTORY/transform_net.py
 cp ../conv_nets/vgg19.py $DIRECTORY/vgg19.py
@@ -2,6 +2,7 @@ import argparse
 import cv2
 import os
 import shutil
+import sys
 import numpy as np
 import tensorflow as tf
 
@@ -10,10 +11,20 @@ try:
   import a_neural_algorithm_of_artistic_style.anaoas_style_transfer as anaoas
   import perceptual_losses_for_real_time_style_transfer.plfrtst_style_transfer as plfrtst
   import deep_photo_style_transfer.dpst_style_transfer as dpst
+  from perceptual_losses_for_real_time_style_transfer.stylizer import Stylizer
+  from perceptual_losses_for_real_time_style_transfer.server import MicroBatcher, StylizeServer
+  from perceptual_losses_for_real_time_style_transfer.registry import ModelRegistry
+  from perceptual_losses_for_real_time_style_transfer.video import VideoStylizer
+  from perceptual_losses_for_real_time_style_transfer.cluster import LocalCluster
 except ImportError: #gcloud
   import anaoas_style_transfer as anaoas
   import plfrtst_style_transfer as plfrtst
   import dpst_style_transfer as dpst
+  from stylizer import Stylizer
+  from server import MicroBatcher, StylizeServer
+  from registry import ModelRegistry
+  from video import VideoStylizer
+  from cluster import LocalCluster
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -82,7 +93,7 @@ if __name__ == '__main__':
                       help='',
                       type=float)
   parser.add_argument('--llambda',
-                      help='',
+                      help='weight of the matting laplacian photorealism loss',
                       type=float)
   parser.add_argument('--learning_rate',
                       help='',
@@ -90,9 +101,68 @@ if __name__ == '__main__':
   parser.add_argument('--num_iters',
                       help='',
                       type=int)
+  parser.add_argument('--pyramid_levels',
+                      help='downscale factors, coarsest first, e.g. 4 2 1',
+                      nargs='+',
+                      type=int)
+  parser.add_argument('--pyramid_iters',
+                      help='number of iterations for every pyramid level, '
+                           'by default num_iters split over the levels, '
+                           'halved at every finer level',
+                      nargs='+',
+                      type=int)
+  parser.add_argument('--optimizer',
+                      help='adam or lbfgs')
+  parser.add_argument('--target_loss',
+                      help='report the evaluations needed to reach this total loss',
+                      type=float)
+  parser.add_argument('--stop_rel_tol',
+                      help='stop when the total loss improves by less than this'
+                           ' fraction over --stop_window iterations',
+                      type=float)
+  parser.add_argument('--stop_window',
+                      help='',
+                      type=int)
+  parser.add_argument('--stop_max_time',
+                      help='wall-clock budget in seconds',
+                      type=float)
+  parser.add_argument('--stop_min_iters',
+                      help='never stop before this many iterations',
+                      type=int)
+  parser.add_argument('--log_interval',
+                      help='seconds between two loss lines (0 logs every '
+                           'iteration)',
+                      type=float)
   parser.add_argument('--batch_size',
                       help='',
                       type=int)
+  parser.add_argument('--num_parallel_calls',
+                      help='plfrtst train: parallel reads and decodes of the '
+                           'input pipeline',
+                      type=int)
+  parser.add_argument('--seed',
+                      help='plfrtst train: seed of the per-epoch shuffles',
+                      type=int)
+  parser.add_argument('--num_local_workers',
+                      help='plfrtst train: data parallel training with this '
+                           'many worker processes and one ps on localhost',
+                      type=int)
+  parser.add_argument('--job_name',
+                      help='plfrtst train: ps or worker, data parallel task '
+                           'of the cluster given by --ps_hosts/--worker_hosts')
+  parser.add_argument('--task_index',
+                      help='plfrtst train: index of the task in its job',
+                      type=int)
+  parser.add_argument('--ps_hosts',
+                      help='plfrtst train: comma separated host:port of the '
+                           'ps tasks')
+  parser.add_argument('--worker_hosts',
+                      help='plfrtst train: comma separated host:port of the '
+                           'worker tasks, worker 0 is the chief')
+  parser.add_argument('--max_steps',
+                      help='plfrtst train: data parallel, stop after this '
+                           'many global steps instead of --no_epochs',
+                      type=int)
   parser.add_argument('--no_epochs',
                       help='',
                       type=int)
@@ -102,10 +172,102 @@ if __name__ == '__main__':
                       help='')
   parser.add_argument('--noise_img_path',
                       help='')
+  parser.add_argument('--tile_size',
+                      help='plfrtst predict: run the transform net on '
+                           'overlapping tiles of this size (multiple of 4)',
+                      type=int)
+  parser.add_argument('--tile_overlap',
+                      help='plfrtst predict: overlap between tiles in pixels',
+                      type=int)
+  parser.add_argument('--tile_batch_size',
+                      help='plfrtst predict: tiles run together, bounds the '
+                           'peak memory',
+                      type=int)
+  parser.add_argument('--tile_stats_size',
+                      help='plfrtst predict: the tiles are normalized with '
+                           'the statistics of the image downscaled to this '
+                           'longest side',
+                      type=int)
+  parser.add_argument('--serve',
+                      help='plfrtst: keep the model warm and stylize images '
+                           'posted to http://host:port/stylize',
+                      action='store_true')
+  parser.add_argument('--host',
+                      help='')
+  parser.add_argument('--port',
+                      help='',
+                      type=int)
+  parser.add_argument('--max_wait',
+                      help='serve: seconds to wait for a batch to fill',
+                      type=float)
+  parser.add_argument('--video_path',
+                      help='plfrtst predict: stylize this video, the output '
+                           'is written to output_img_path/video.mp4')
+  parser.add_argument('--drop_frames',
+                      help='video: skip frames when inference falls behind',
+                      action='store_true')
+  parser.add_argument('--models_path',
+                      help='serve: directory of style checkpoints/frozen '
+                           'graphs, loaded on first use')
+  parser.add_argument('--max_models',
+                      help='serve: styles kept loaded at most',
+                      type=int)
+  parser.add_argument('--max_model_bytes',
+                      help='serve: weight bytes kept loaded at most',
+                      type=int)
+  parser.add_argument('--export_path',
+                      help='plfrtst: write the inference-only frozen graph '
+                           'of --model_path to this .pb file')
+  parser.add_argument('--content_imgs',
+                      help='plfrtst predict: directory, glob or manifest file '
+                           'of content images, the model is restored once')
+  parser.add_argument('--bucket_size',
+                      help='plfrtst predict: images are padded to a multiple '
+                           'of this size so mixed sizes batch together',
+                      type=int)
+  parser.add_argument('--num_threads',
+                      help='plfrtst predict: decode/encode threads',
+                      type=int)
+  parser.add_argument('--content_frames',
+                      help='anaoas: glob of video frames stylized in order, '
+                           'each one warm started from the previous result')
+  parser.add_argument('--frame_iters',
+                      help='anaoas: iterations for every frame after the '
+                           'first one',
+                      type=int)
+  parser.add_argument('--content_img_paths',
+                      help='anaoas: content images optimized together in one '
+                           'batch, all resized to the size of the first one',
+                      nargs='+')
+  parser.add_argument('--style_img_paths',
+                      help='anaoas: style image of each content image, or a '
+                           'single one shared by the whole batch. plfrtst '
+                           'train: trains one multi-style transform_net on '
+                           'all of them',
+                      nargs='+')
+  parser.add_argument('--num_styles',
+                      help='plfrtst predict: number of styles of a '
+                           'multi-style checkpoint',
+                      type=int)
+  parser.add_argument('--style',
+                      help='plfrtst predict: style of a multi-style model, an '
+                           'index or comma separated blend weights')
   parser.add_argument('--mask_content_img_path',
                       help='')
   parser.add_argument('--mask_style_img_path',
                       help='')
+  parser.add_argument('--mask_palette',
+                      help='mask label colors as B,G,R, one label per color',
+                      nargs='+')
+  parser.add_argument('--mask_tolerance',
+                      help='max per-channel distance from a label color, '
+                           'one value or two: for the channels >= 128 and '
+                           '< 128 of the color (default 49 51, the old > 205 '
+                           '/ < 52 thresholds)',
+                      nargs='+',
+                      type=int)
+  parser.add_argument('--mask_gram_mode',
+                      help='batched or gather')
   parser.add_argument('--output_img_path',
                       help='')
   parser.add_argument('--tensorboard_path',
@@ -116,19 +278,29 @@ if __name__ == '__main__':
                       help='')
   parser.add_argument('--output_img_init',
                       help='')
+  parser.add_argument('--no_freeze_content',
+                      help='recompute the content features on every iteration',
+                      action='store_true')
+  parser.add_argument('--cache_path',
+                      help='where precomputed style grams are stored')
 
   args = parser.parse_args()
 
   if args.method == 'anaoas':
     if args.train:
       ut = Utils()
-      content_img_path = args.content_img_path or 'images/content/content1.jpg'
-      style_img_path = args.style_img_path or 'images/style/style1.jpg'
-      noise_img_path = args.noise_img_path or 'images/content/content1.jpg'
+      content_frames = sorted(tf.gfile.Glob(args.content_frames)) \
+          if args.content_frames else []
+      content_img_path = content_frames[:1] or args.content_img_paths \
+          or [args.content_img_path or 'images/content/content1.jpg']
+      style_img_path = args.style_img_paths \
+          or [args.style_img_path or 'images/style/style1.jpg']
+      noise_img_path = [args.noise_img_path] if args.noise_img_path \
+          else args.content_img_paths or ['images/content/content1.jpg']
 
       s = tf.InteractiveSession()
-      content_img_bytes = tf.read_file(content_img_path)
-      style_img_bytes = tf.read_file(style_img_path)
+      content_img_bytes = tf.read_file(content_img_path[0])
+      style_img_bytes = tf.read_file(style_img_path[0])
 
       content_img_np = np.fromstring(content_img_bytes.eval(), np.uint8)
       style_img_np = np.fromstring(style_img_bytes.eval(), np.uint8)
@@ -177,7 +349,16 @@ if __name__ == '__main__':
           gamma=0.0 if args.gamma == 0 else args.gamma or 0.03,
           learning_rate=args.learning_rate or 2,
           num_iters=args.num_iters or 2000,
-          output_img_init=args.output_img_init or 'random')
+          optimizer=args.optimizer or 'adam',
+          target_loss=args.target_loss,
+          stop_rel_tol=args.stop_rel_tol,
+          stop_window=args.stop_window or 100,
+          stop_max_time=args.stop_max_time,
+          stop_min_iters=args.stop_min_iters or 0,
+          log_interval=1.0 if args.log_interval is None else args.log_interval,
+          output_img_init=args.output_img_init or 'random',
+          freeze_content=not args.no_freeze_content,
+          batch_size=len(content_img_path))
 
       tensorboard_path = args.tensorboard_path or 'tensorboard/tensorboard_anaoas'
       if tf.gfile.IsDirectory(tensorboard_path): # for gcloud comment this
@@ -189,20 +370,64 @@ if __name__ == '__main__':
         tf.gfile.DeleteRecursively(output_img_path)
       tf.gfile.MakeDirs(output_img_path)
 
-      model.build()
-      model.train(
-          content_img_path=content_img_path,
-          style_img_path=style_img_path,
-          noise_img_path=noise_img_path,
-          output_img_path=output_img_path,
-          tensorboard_path=tensorboard_path,
-          show_img=args.show_img)
+      if content_frames:
+        model.build()
+        model.train_sequence(
+            content_img_paths=content_frames,
+            style_img_path=style_img_path[0],
+            output_img_path=output_img_path,
+            tensorboard_path=tensorboard_path,
+            show_img=args.show_img,
+            cache_path=args.cache_path or 'cache',
+            frame_iters=args.frame_iters or 100)
+      elif args.pyramid_levels:
+        model.train_pyramid(
+            pyramid_levels=args.pyramid_levels,
+            pyramid_iters=args.pyramid_iters,
+            content_img_path=content_img_path,
+            style_img_path=style_img_path,
+            noise_img_path=noise_img_path,
+            output_img_path=output_img_path,
+            tensorboard_path=tensorboard_path,
+            show_img=args.show_img,
+            cache_path=args.cache_path or 'cache')
+      else:
+        model.build()
+        model.train(
+            content_img_path=content_img_path,
+            style_img_path=style_img_path,
+            noise_img_path=noise_img_path,
+            output_img_path=output_img_path,
+            tensorboard_path=tensorboard_path,
+            show_img=args.show_img,
+            cache_path=args.cache_path or 'cache')
     else:
       print('Nothing to be done!')
   elif args.method == 'plfrtst':
-    if args.train:
+    style = None
+    if args.style:
+      style = [float(w) for w in args.style.split(',')] \
+              if ',' in args.style else int(args.style)
+
+    if args.train and args.num_local_workers:
+      # the same command once per task, without --num_local_workers
+      argv = []
+      skip = False
+      for arg in sys.argv[1:]:
+        if skip:
+          skip = False
+        elif arg == '--num_local_workers':
+          skip = True
+        elif not arg.startswith('--num_local_workers='):
+          argv.append(arg)
+      cluster = LocalCluster([sys.executable, sys.argv[0]] + argv,
+                             num_workers=args.num_local_workers)
+      sys.exit(cluster.run())
+    elif args.train:
       ut = Utils()
       style_img_path = args.style_img_path or 'images/style/style1.jpg'
+      if args.style_img_paths:
+        style_img_path = args.style_img_paths[0]
 
       s = tf.InteractiveSession()
       style_img_bytes = tf.read_file(style_img_path)
@@ -242,41 +467,130 @@ if __name__ == '__main__':
           beta=0.0 if args.beta == 0 else args.beta or 1.0,
           gamma=0.0 if args.gamma == 0 else args.gamma or 0.03,
           batch_size=args.batch_size or 2,
+          num_parallel_calls=args.num_parallel_calls or 4,
+          seed=args.seed or 0,
+          num_styles=len(args.style_img_paths) if args.style_img_paths else None,
+          job_name=args.job_name,
+          task_index=args.task_index or 0,
+          ps_hosts=args.ps_hosts.split(',') if args.ps_hosts else None,
+          worker_hosts=args.worker_hosts.split(',') if args.worker_hosts else None,
           no_epochs=args.no_epochs or 2,
           learning_rate=args.learning_rate or 0.001)
 
+      # in a data parallel cluster only the chief (worker 0) owns the paths
+      is_chief = args.job_name is None \
+                 or (args.job_name == 'worker' and not args.task_index)
       tensorboard_path = args.tensorboard_path or 'tensorboard/tensorboard_plfrtst'
-      if args.resume is None or args.resume == False:
+      if (args.resume is None or args.resume == False) and is_chief:
         if tf.gfile.IsDirectory(tensorboard_path): # for gcloud comment this
           tf.gfile.DeleteRecursively(tensorboard_path)
         tf.gfile.MakeDirs(tensorboard_path)
 
       output_img_path = args.output_img_path or 'results/plfrtst'
-      if args.resume is None or args.resume == False:
+      if (args.resume is None or args.resume == False) and is_chief:
         if tf.gfile.IsDirectory(output_img_path): # for gcloud comment this
           tf.gfile.DeleteRecursively(output_img_path)
         tf.gfile.MakeDirs(output_img_path)
 
       model_path = args.model_path or 'models'
-      if args.resume is None or args.resume == False:
+      if (args.resume is None or args.resume == False) and is_chief:
         if tf.gfile.IsDirectory(model_path): # for gcloud comment this
           tf.gfile.DeleteRecursively(model_path)
         tf.gfile.MakeDirs(model_path)
 
       checkpoints_path = args.checkpoints_path or 'checkpoints'
-      if args.resume is None or args.resume == False:
+      if (args.resume is None or args.resume == False) and is_chief:
         if tf.gfile.IsDirectory(checkpoints_path): # for gcloud comment this
           tf.gfile.DeleteRecursively(checkpoints_path)
         tf.gfile.MakeDirs(checkpoints_path)
 
+      # a multi-style transform_net takes the list of style images
+      if args.style_img_paths:
+        style_img_path = args.style_img_paths
+
       model.build()
-      model.train(
-          model_path=model_path,
-          style_img_path=style_img_path,
-          output_img_path=output_img_path,
-          tensorboard_path=tensorboard_path,
-          resume=args.resume or False,
-          checkpoints_path=checkpoints_path)
+      if args.job_name:
+        model.train_distributed(
+            style_img_path=style_img_path,
+            tensorboard_path=tensorboard_path,
+            checkpoints_path=checkpoints_path,
+            cache_path=args.cache_path or 'cache',
+            max_steps=args.max_steps)
+      else:
+        model.train(
+            model_path=model_path,
+            style_img_path=style_img_path,
+            output_img_path=output_img_path,
+            tensorboard_path=tensorboard_path,
+            resume=args.resume or False,
+            checkpoints_path=checkpoints_path,
+            cache_path=args.cache_path or 'cache')
+    elif args.serve:
+      model_path = args.model_path or 'models_freeze/model_freeze_s1.ckpt'
+      registry = ModelRegistry(
+          models_path=args.models_path or {'default': model_path},
+          max_models=args.max_models,
+          max_bytes=args.max_model_bytes,
+          content_img_height=args.content_img_height,
+          content_img_width=args.content_img_width,
+          content_img_size=args.content_img_size,
+          content_img_channels=args.content_img_channels or 3,
+          batch_size=args.batch_size or 8,
+          bucket_size=args.bucket_size or 64,
+          style=style)
+      batcher = MicroBatcher(registry,
+                             max_batch_size=args.batch_size or 8,
+                             max_wait=0.01 if args.max_wait is None \
+                                      else args.max_wait)
+      server = StylizeServer(batcher,
+                             host=args.host or '127.0.0.1',
+                             port=args.port or 8000)
+      print('Serving on http://%s:%d' % server.server_address)
+      server.serve_forever()
+    elif args.export_path:
+      stylizer = Stylizer(
+          model_path=args.model_path or 'models_freeze/model_freeze_s1.ckpt',
+          content_img_channels=args.content_img_channels or 3)
+      stylizer.export(args.export_path)
+      stylizer.close()
+    elif args.predict and args.video_path:
+      output_img_path = args.output_img_path or 'results/plfrtst_predict'
+      if not tf.gfile.IsDirectory(output_img_path):
+        tf.gfile.MakeDirs(output_img_path)
+
+      stylizer = Stylizer(
+          model_path=args.model_path or 'models_freeze/model_freeze_s1.ckpt',
+          content_img_height=args.content_img_height,
+          content_img_width=args.content_img_width,
+          content_img_size=args.content_img_size,
+          content_img_channels=args.content_img_channels or 3,
+          batch_size=args.batch_size or 4,
+          bucket_size=args.bucket_size or 64,
+          style=style)
+      video_stylizer = VideoStylizer(stylizer,
+                                     batch_size=args.batch_size or 4,
+                                     drop_frames=args.drop_frames)
+      video_stylizer.stylize_video(args.video_path,
+                                   output_img_path + '/video.mp4')
+      stylizer.close()
+    elif args.predict and args.content_imgs:
+      output_img_path = args.output_img_path or 'results/plfrtst_predict'
+      if tf.gfile.IsDirectory(output_img_path):
+        tf.gfile.DeleteRecursively(output_img_path)
+      tf.gfile.MakeDirs(output_img_path)
+
+      stylizer = Stylizer(
+          model_path=args.model_path or 'models_freeze/model_freeze_s1.ckpt',
+          content_img_height=args.content_img_height,
+          content_img_width=args.content_img_width,
+          content_img_size=args.content_img_size,
+          content_img_channels=args.content_img_channels or 3,
+          batch_size=args.batch_size or 4,
+          bucket_size=args.bucket_size or 64,
+          num_threads=args.num_threads or 4,
+          style=style)
+      stylizer.stylize_paths(args.content_imgs, output_img_path)
+      stylizer.close()
     elif args.predict:
       ut = Utils()
       content_img_path = args.content_img_path or 'images/content/content1.jpg'
@@ -319,6 +633,7 @@ if __name__ == '__main__':
           beta=0.0 if args.beta == 0 else args.beta or 1.0,
           gamma=0.0 if args.gamma == 0 else args.gamma or 0.03,
           batch_size=args.batch_size or 2,
+          num_styles=args.num_styles,
           no_epochs=args.no_epochs or 2,
           learning_rate=args.learning_rate or 0.001)
 
@@ -334,7 +649,12 @@ if __name__ == '__main__':
           model_path=model_path,
           content_img_path=content_img_path,
           output_img_path=output_img_path,
-          show_img=args.show_img)
+          show_img=args.show_img,
+          tile_size=args.tile_size,
+          tile_overlap=32 if args.tile_overlap is None else args.tile_overlap,
+          tile_batch_size=args.tile_batch_size or 4,
+          tile_stats_size=args.tile_stats_size or 1024,
+          style=style)
     else:
       print('Nothing to be done!')
   elif args.method == 'dpst':
@@ -393,9 +713,21 @@ if __name__ == '__main__':
           alfa=0.0 if args.alfa == 0 else args.alfa or 100.0,
           beta=0.0 if args.beta == 0 else args.beta or 1.0,
           gamma=0.0 if args.gamma == 0 else args.gamma or 0.03,
+          llambda=0.0 if args.llambda == 0 else args.llambda or 1e4,
           learning_rate=args.learning_rate or 2,
           num_iters=args.num_iters or 2000,
-          output_img_init=args.output_img_init or 'random')
+          optimizer=args.optimizer or 'adam',
+          target_loss=args.target_loss,
+          stop_rel_tol=args.stop_rel_tol,
+          stop_window=args.stop_window or 100,
+          stop_max_time=args.stop_max_time,
+          stop_min_iters=args.stop_min_iters or 0,
+          log_interval=1.0 if args.log_interval is None else args.log_interval,
+          output_img_init=args.output_img_init or 'random',
+          mask_palette=[[int(c) for c in color.split(',')]
+                        for color in args.mask_palette or []] or None,
+          mask_tolerance=args.mask_tolerance or (49, 51),
+          mask_gram_mode=args.mask_gram_mode or 'batched')
 
       tensorboard_path = args.tensorboard_path or 'tensorboard/tensorboard_dpst'
       if tf.gfile.IsDirectory(tensorboard_path): # for gcloud comment this
@@ -418,7 +750,8 @@ if __name__ == '__main__':
                                   or 'images/mask/mask_d_style6_resized.png',
           output_img_path=output_img_path,
           tensorboard_path=tensorboard_path,
-          show_img=args.show_img)
+          show_img=args.show_img,
+          cache_path=args.cache_path or 'cache')
     else:
       print('Nothing to be done!')
   else:
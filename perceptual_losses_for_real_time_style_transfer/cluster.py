@@ -0,0 +1,47 @@
+import subprocess
+import time
+
+class LocalCluster():
+  # runs cmd once per ps and worker task of a cluster on localhost, with
+  # --job_name, --task_index, --ps_hosts and --worker_hosts appended. cmd is
+  # a train command of main.py, e.g. [sys.executable, 'main.py', ...]
+  def __init__(self,
+      cmd,
+      num_workers=2,
+      num_ps=1,
+      base_port=2222):
+    self.cmd = cmd
+    self.num_workers = num_workers
+    self.num_ps = num_ps
+    self.ps_hosts = ['localhost:%d' % (base_port + i) for i in range(num_ps)]
+    self.worker_hosts = ['localhost:%d' % (base_port + num_ps + i)
+                         for i in range(num_workers)]
+
+  def _start(self, job_name, task_index):
+    return subprocess.Popen(self.cmd + ['--job_name', job_name,
+                                        '--task_index', str(task_index),
+                                        '--ps_hosts', ','.join(self.ps_hosts),
+                                        '--worker_hosts', ','.join(self.worker_hosts)])
+
+  def run(self):
+    # returns the exit code of the chief. The ps tasks never exit on their
+    # own and a worker can stay blocked on a sync token after the last
+    # step, both are stopped once the chief is done
+    procs = [self._start('ps', i) for i in range(self.num_ps)]
+    procs = procs + [self._start('worker', i) for i in range(self.num_workers)]
+    chief = procs[self.num_ps]
+    try:
+      returncode = chief.wait()
+      deadline = time.time() + 30.0
+      for proc in procs[self.num_ps + 1:]:
+        try:
+          proc.wait(timeout=max(deadline - time.time(), 0.1))
+        except subprocess.TimeoutExpired:
+          pass
+    finally:
+      for proc in procs:
+        if proc.poll() is None:
+          proc.terminate()
+          proc.wait()
+
+    return returncode
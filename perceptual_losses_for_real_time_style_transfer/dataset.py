@@ -1,37 +1,120 @@
+import cv2
+import hashlib
 import json
 import os
 import random
+import tempfile
 import tensorflow as tf
 import numpy as np
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+class Sampler():
+  # index based: the names are held once in a compact numpy array and the
+  # order of an epoch is a permutation drawn from seed + epoch, so the state
+  # needed to resume is only (seed, epoch, position)
+  def __init__(self, seed=0):
+    self.seed = seed
+    self.epoch = 0
+    self.position = 0
+    self.shard_index = 0
+    self.num_shards = 1
+
+    self._names = np.array([], dtype=np.bytes_)
+    self._permutation = None
+    self._permutation_epoch = None
+
+  def set_names(self, names):
+    self._names = np.array([name.encode('utf-8') for name in names],
+                           dtype=np.bytes_)
+    self._permutation = None
+
+  def get_names(self):
+    return [name.decode('utf-8') for name in self._names]
+
+  def _get_permutation(self):
+    if self._permutation is None or self._permutation_epoch != self.epoch:
+      # every shard draws the same permutation and takes every
+      # num_shards-th name of it, so the shards never overlap
+      self._permutation = np.random.RandomState(self.seed + self.epoch) \
+                            .permutation(len(self._names)) \
+                            [self.shard_index::self.num_shards]
+      self._permutation_epoch = self.epoch
+
+    return self._permutation
+
+  def set_shard(self, shard_index, num_shards):
+    self.shard_index = shard_index
+    self.num_shards = num_shards
+    self._permutation = None
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+    self.position = 0
+
+  def next_batch(self, n_batch):
+    permutation = self._get_permutation()
+    idx = permutation[self.position:self.position + n_batch]
+    batch = [name.decode('utf-8') for name in self._names[idx]]
+
+    if self.position + n_batch < len(permutation):
+      self.position = self.position + n_batch
+      batch_end = False
+    else:
+      batch_end = True
+
+    return batch, batch_end
+
+  def get_remaining(self):
+    idx = self._get_permutation()[self.position:]
+
+    return [name.decode('utf-8') for name in self._names[idx]]
+
+  def get_state(self):
+    return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position}
+
+  def set_state(self, state):
+    self.seed = state['seed']
+    self.epoch = state['epoch']
+    self.position = state['position']
 
 class Dataset:
   def __init__(self,
-      data_path='perceptual_losses_for_real_time_style_transfer/dataset'):
-    self._x_train = None
+      data_path='perceptual_losses_for_real_time_style_transfer/dataset',
+      seed=0,
+      local_shards_path=None):
     self._x_val = None
     self.data_path = data_path
 
-    self.train_batch_idx = 0
+    self.sampler = Sampler(seed=seed)
 
-  def get_train_batch(self, n_batch=None):
-    if self._x_train is None: self._get_dataset()
+    # written by build_dataset_shards, used instead of the jpegs if present
+    self.shards_path = data_path + '/shards/train'
+    # remote (gs://) shards are copied here on first use and memory mapped
+    self.local_shards_path = local_shards_path or os.path.join(
+        tempfile.gettempdir(),
+        'shards_' + hashlib.sha1(self.shards_path.encode('utf-8')).hexdigest()[:12])
+    self._shard_files = None
+    self._shard_arrays = None
+    self._shard_rows = None
 
-    if n_batch is None:
-      return self._x_train
+  def __getstate__(self):
+    # the memory mapped shards are not pickled with the checkpoints
+    state = self.__dict__.copy()
+    state['_shard_files'] = None
+    state['_shard_arrays'] = None
+    state['_shard_rows'] = None
 
-    batch_end = False
+    return state
 
-    x_batch = [self.data_path + '/train_imgs/' + self._x_train[i]
-               for i in list(range(
-                 self.train_batch_idx,
-                 min(self.train_batch_idx + n_batch,
-                     len(self._x_train))))]
+  def get_train_batch(self, n_batch=None):
+    if self._x_val is None: self._get_dataset()
 
-    if self.train_batch_idx + n_batch < len(self._x_train):
-      self.train_batch_idx = self.train_batch_idx + n_batch
-    else:
-      batch_end = True
+    if n_batch is None:
+      return self.sampler.get_names()
+
+    x_batch, batch_end = self.sampler.next_batch(n_batch)
+    x_batch = [self.data_path + '/train_imgs/' + x for x in x_batch]
 
     return x_batch, batch_end
 
@@ -47,29 +130,120 @@ class Dataset:
 
     return x_batch
 
-  def _get_dataset(self):
-    s = tf.InteractiveSession()
-    val_tf = tf.read_file(self.data_path + '/anno/val.txt')
-    train_tf = tf.read_file(self.data_path + '/anno/train.txt')
+  def get_train_files(self):
+    # the train images not consumed yet in this epoch, in batch order
+    if self._x_val is None:
+      self._get_dataset()
+
+    return [self.data_path + '/train_imgs/' + x
+            for x in self.sampler.get_remaining()]
+
+  def has_shards(self):
+    return tf.gfile.Exists(self.shards_path + '/index.json')
+
+  def _get_shards(self):
+    with tf.gfile.GFile(self.shards_path + '/index.json', 'r') as f:
+      index = json.load(f)
+
+    # the shards are opened on first use, see _get_shard_array
+    self._shard_files = []
+    self._shard_rows = {}
+    for shard in index['shards']:
+      self._shard_files.append(shard['file'])
+      for row, name in enumerate(shard['names']):
+        self._shard_rows[name] = (len(self._shard_files) - 1, row)
+    self._shard_arrays = [None] * len(self._shard_files)
+
+  def _get_shard_array(self, shard):
+    # zero-copy mmap on local disk. A remote shard is first copied to
+    # local_shards_path in one sequential read, so only the pages in use
+    # are resident, never the whole dataset
+    if self._shard_arrays[shard] is None:
+      shard_path = self.shards_path + '/' + self._shard_files[shard]
+      if '://' in shard_path:
+        local_path = self.local_shards_path + '/' + self._shard_files[shard]
+        if not tf.gfile.Exists(local_path) \
+            or tf.gfile.Stat(local_path).length != tf.gfile.Stat(shard_path).length:
+          if not tf.gfile.IsDirectory(self.local_shards_path):
+            tf.gfile.MakeDirs(self.local_shards_path)
+          tmp_path = local_path + '.' + str(os.getpid()) + '.tmp'
+          tf.gfile.Copy(shard_path, tmp_path, overwrite=True)
+          tf.gfile.Rename(tmp_path, local_path, overwrite=True)
+        shard_path = local_path
+      self._shard_arrays[shard] = np.load(shard_path, mmap_mode='r')
+
+    return self._shard_arrays[shard]
+
+  def get_train_imgs(self, img_paths, height, width):
+    # img_paths as given by get_train_batch, the images come out like
+    # Utils.get_img with model='transform_net'
+    if self._shard_rows is None:
+      self._get_shards()
+
+    prefix = self.data_path + '/train_imgs/'
+    imgs = []
+    for img_path in img_paths:
+      shard, row = self._shard_rows[img_path[len(prefix):]]
+      img = self._get_shard_array(shard)[row]
+      if img.shape[0] != height or img.shape[1] != width:
+        img = cv2.resize(img, (width, height))
+      imgs.append(img)
+
+    return np.array(imgs).astype(np.float32) / 127.5 - 1
+
+  def build_train_pipeline(self, batch_size, height, width,
+                           num_parallel_calls=4, prefetch_batches=2):
+    # reads are interleaved over num_parallel_calls files, decode and resize
+    # run in parallel and batches are prefetched, the order of the files is
+    # kept. Images come out BGR in [-1, 1], like Utils.get_img with
+    # model='transform_net'
+    files = tf.placeholder(tf.string, [None])
+
+    def decode(img_bytes):
+      img = tf.image.decode_image(img_bytes, channels=3)
+      img.set_shape([None, None, 3])
+      img = tf.image.resize_images(img, [height, width])
+      img = tf.reverse(img, axis=[-1]) # RGB -> BGR
 
-    val_bytes = val_tf.eval()
-    train_bytes = train_tf.eval()
-    s.close()
+      return img / 127.5 - 1
 
-    val_imgs = BytesIO(val_bytes).read().decode('utf-8').split('\n')
-    train_imgs = BytesIO(train_bytes).read().decode('utf-8').split('\n')
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    ds = ds.apply(tf.contrib.data.parallel_interleave(
+        lambda f: tf.data.Dataset.from_tensors(tf.read_file(f)),
+        cycle_length=num_parallel_calls))
+    ds = ds.map(decode, num_parallel_calls=num_parallel_calls)
+    ds = ds.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+    ds = ds.prefetch(prefetch_batches)
+    iterator = ds.make_initializable_iterator()
+
+    return files, iterator.initializer, iterator.get_next()
+
+  def _get_dataset(self):
+    with tf.gfile.GFile(self.data_path + '/anno/val.txt', 'r') as f:
+      val_imgs = f.read().split('\n')
+    with tf.gfile.GFile(self.data_path + '/anno/train.txt', 'r') as f:
+      train_imgs = f.read().split('\n')
 
     self._x_val = []
     for line in val_imgs:
       img_line = line.rstrip() # remove newline
-      self._x_val.append(img_line)
+      if img_line:
+        self._x_val.append(img_line)
     random.shuffle(self._x_val)
 
-    self._x_train = []
+    # kept in file order, the sampler shuffles every epoch
+    x_train = []
     for line in train_imgs:
       img_line = line.rstrip() # remove newline
-      self._x_train.append(img_line)
-    random.shuffle(self._x_train)
+      if img_line:
+        x_train.append(img_line)
+
+    if self.has_shards(): # only the images that made it into the shards
+      if self._shard_rows is None:
+        self._get_shards()
+      x_train = list(self._shard_rows)
+
+    self.sampler.set_names(x_train)
 
     # self._x_val = []
     # if os.path.exists(self.data_path + '/anno/val.txt'):
@@ -99,3 +273,52 @@ class Dataset:
     with open(output_file, 'w') as f:
       for image in data['images']:
         f.write(image['file_name'] + '\n')
+
+  @staticmethod
+  def build_dataset_shards(
+      data_path='perceptual_losses_for_real_time_style_transfer/dataset',
+      anno_file='train.txt',
+      imgs_dir='train_imgs',
+      output_path='perceptual_losses_for_real_time_style_transfer/dataset/shards/train',
+      height=256,
+      width=256,
+      shard_size=4096,
+      num_threads=8):
+    # decode and resize every image once, shard_%05d.npy hold uint8 BGR
+    # [N, height, width, 3] arrays and index.json the names of their rows
+    with tf.gfile.GFile(data_path + '/anno/' + anno_file, 'r') as f:
+      names = [line.rstrip() for line in f if line.rstrip()]
+    if not tf.gfile.IsDirectory(output_path):
+      tf.gfile.MakeDirs(output_path)
+
+    def load(name):
+      with tf.gfile.GFile(data_path + '/' + imgs_dir + '/' + name, 'rb') as f:
+        img = cv2.imdecode(np.fromstring(f.read(), np.uint8), cv2.IMREAD_COLOR)
+      if img is None:
+        return None
+
+      return cv2.resize(img, (width, height))
+
+    pool = ThreadPool(num_threads)
+    index = {'height': height, 'width': width, 'channels': 3, 'shards': []}
+    for start in range(0, len(names), shard_size):
+      shard_names = names[start:start + shard_size]
+      shard = [(name, img)
+               for name, img in zip(shard_names, pool.map(load, shard_names))
+               if img is not None]
+      if not shard:
+        continue
+
+      shard_file = 'shard_%05d.npy' % len(index['shards'])
+      buf = BytesIO()
+      np.save(buf, np.array([img for _, img in shard], np.uint8))
+      with tf.gfile.GFile(output_path + '/' + shard_file, 'wb') as f:
+        f.write(buf.getvalue())
+      index['shards'].append({'file': shard_file,
+                              'names': [name for name, _ in shard]})
+      print('%s: %d images, %d skipped'
+            % (shard_file, len(shard), len(shard_names) - len(shard)))
+    pool.close()
+
+    with tf.gfile.GFile(output_path + '/index.json', 'w') as f:
+      f.write(json.dumps(index))
@@ -1,16 +1,21 @@
 import cv2
+import multiprocessing
 import pickle
+import time
 import numpy as np
 import tensorflow as tf
 import matplotlib.pyplot as plt
 
 from utils import Utils
+from async_writer import AsyncWriter
 try:
   from conv_nets.vgg19 import VGG19
   from conv_nets.transform_net import TransformNet
+  from perceptual_losses_for_real_time_style_transfer.dataset import Dataset
 except ImportError: #gcloud
   from vgg19 import VGG19
   from transform_net import TransformNet
+  from dataset import Dataset
 
 class StyleTransfer():
   def __init__(self,
@@ -31,7 +36,14 @@ class StyleTransfer():
       gamma=0.03,
       learning_rate=0.001,
       no_epochs=2,
-      batch_size=2):
+      batch_size=2,
+      num_parallel_calls=4,
+      seed=0,
+      num_styles=None,
+      job_name=None,
+      task_index=0,
+      ps_hosts=None,
+      worker_hosts=None):
     self.vgg_means = [103.939, 116.779, 123.68] # BGR
     self.model_name = model_name
     self.tensorflow_model_path = tensorflow_model_path
@@ -54,6 +66,16 @@ class StyleTransfer():
     self.learning_rate = learning_rate
     self.no_epochs = no_epochs
     self.batch_size = batch_size
+    self.num_parallel_calls = num_parallel_calls
+    self.seed = seed
+    # a multi-style transform_net, trained on num_styles style images
+    self.num_styles = num_styles
+
+    # data parallel training (train_distributed), one process per task
+    self.job_name = job_name
+    self.task_index = task_index
+    self.ps_hosts = ps_hosts or []
+    self.worker_hosts = worker_hosts or []
 
   def _get_content_loss(self, content_layer, noise_layer):
     content_loss = tf.constant(0.0)
@@ -71,53 +93,292 @@ class StyleTransfer():
 
     return content_loss
 
-  def _get_style_loss(self, style_layer, noise_layer):
-    style_loss = tf.constant(0.0)
+  def _get_gram_matrix(self, layer):
+    channels_matrix = tf.reshape(layer, [-1, tf.shape(layer)[3]])
+    gram_matrix = tf.matmul(tf.transpose(channels_matrix), channels_matrix)
 
-    channels_matrix_style_img = tf.reshape(style_layer,
-                                           [-1, tf.shape(style_layer)[3]])
-    channels_matrix_noise_img = tf.reshape(noise_layer,
-                                           [-1, tf.shape(noise_layer)[3]])
+    return gram_matrix
 
-    gram_matrix_style = tf.matmul(tf.transpose(channels_matrix_style_img),
-                                  channels_matrix_style_img)
-    gram_matrix_noise = tf.matmul(tf.transpose(channels_matrix_noise_img),
-                                  channels_matrix_noise_img)
+  def _get_style_loss(self, gram_matrix_style, style_layer_shape, noise_layer):
+    style_loss = tf.constant(0.0)
+
+    gram_matrix_noise = self._get_gram_matrix(noise_layer)
 
     El = tf.reduce_sum(tf.square(gram_matrix_style - gram_matrix_noise))
     El = tf.scalar_mul(1.0 / (4.0
-                       * tf.square(tf.cast(tf.shape(style_layer)[1],
-                                           tf.float32))
-                       * tf.square(tf.cast(tf.shape(style_layer)[2],
-                                           tf.float32))
-                       * tf.square(tf.cast(tf.shape(style_layer)[3],
-                                           tf.float32))),
+                       * float(style_layer_shape[1]) ** 2
+                       * float(style_layer_shape[2]) ** 2
+                       * float(style_layer_shape[3]) ** 2),
                        El)
 
     style_loss = style_loss + El
 
     return style_loss
 
+  def _read_style_imgs(self, sess, ut, style_img_path):
+    # style_img_path is a list of paths for a multi-style transform_net
+    style_img_paths = style_img_path if self.num_styles else [style_img_path]
+    if len(style_img_paths) != (self.num_styles or 1):
+      raise ValueError('Expected %d style images, got %d'
+                       % (self.num_styles or 1, len(style_img_paths)))
+
+    style_imgs_bytes = []
+    style_imgs = []
+    for path in style_img_paths:
+      style_img_bytes = sess.run(self.file_bytes,
+          feed_dict={self.name_file: path})
+      style_img_np = np.fromstring(style_img_bytes, np.uint8)
+      style_imgs_bytes.append(style_img_bytes)
+      style_imgs.append(np.reshape(ut.get_img(style_img_np,
+                                              width=self.style_img_width,
+                                              height=self.style_img_height),
+                                              (1,
+                                               self.style_img_height,
+                                               self.style_img_width,
+                                               self.style_img_channels)))
+
+    return style_imgs_bytes, style_imgs
+
+  def _load_style_grams(self, sess, ut, style_imgs_bytes, style_imgs, cache_path):
+    # cached per style image, a new style list reuses the grams it shares
+    # with the previous ones
+    all_style_grams = []
+    for style_img_bytes, style_img in zip(style_imgs_bytes, style_imgs):
+      key = ut.get_cache_key(style_img_bytes,
+                             self.style_img_height,
+                             self.style_img_width,
+                             self.style_layers,
+                             self.tensorflow_model_path)
+      style_grams = ut.load_cache(cache_path, key)
+      if style_grams is None:
+        style_grams = sess.run(self.style_grams,
+                               feed_dict={self.style_img: style_img})
+        ut.save_cache(cache_path, key, style_grams)
+      all_style_grams.append(style_grams)
+
+    for style_layer_name, style_gram in self.style_grams_var.items():
+      if self.num_styles:
+        style_gram.load(np.stack([style_grams[style_layer_name]
+                                  for style_grams in all_style_grams]), sess)
+      else:
+        style_gram.load(all_style_grams[0][style_layer_name], sess)
+
+  def _get_batch_style_weights(self, img):
+    # the same style weights for every image of the batch
+    if not self.num_styles:
+      return None
+
+    return tf.tile(self.style_weights[tf.newaxis], [tf.shape(img)[0], 1])
+
+  def _get_style_feed(self, i, style=None):
+    # in training the styles take turns, one per step
+    if not self.num_styles:
+      return {}
+    if style is None:
+      style = i % self.num_styles
+
+    return {self.style_weights: self.model_transform.get_style_weights(style),
+            self.style_idx: style if np.ndim(style) == 0 else 0}
+
+  def _load_manifest(self, sess, checkpoints_path):
+    manifest_path = checkpoints_path + '/manifest.pkl'
+    if tf.gfile.Exists(manifest_path):
+      manifest = pickle.loads(sess.run(self.file_bytes,
+          feed_dict={self.name_file: manifest_path}))
+    else:
+      # checkpoints written before the manifest, one pickle per field
+      manifest = {}
+      for key, name in [('model_path', 'model_path.pkl'),
+                        ('utils', 'utils.pkl'),
+                        ('epoch', 'epoch.pkl'),
+                        ('iteration', 'iteration.pkl')]:
+        manifest[key] = pickle.loads(sess.run(self.file_bytes,
+            feed_dict={self.name_file: checkpoints_path + '/' + name}))
+
+    if 'sampler' not in manifest:
+      # a pickled Utils: keep the position in the epoch, the order of the
+      # rest of that epoch comes from the sampler
+      manifest['sampler'] = {
+          'seed': self.seed,
+          'epoch': manifest['epoch'],
+          'position': getattr(manifest['utils'].ds, 'train_batch_idx', 0)}
+
+    return manifest
+
+  def _get_tile_starts(self, size, tile_size, tile_overlap):
+    # the last tile is moved back so it ends on the border
+    starts = list(range(0, size - tile_size + 1, tile_size - tile_overlap))
+    if starts[-1] + tile_size < size:
+      starts.append(size - tile_size)
+
+    return starts
+
+  def _get_feather_weights(self, tile_size, tile_overlap):
+    # linear ramp over the overlap on every side of the tile
+    dist = np.minimum(np.arange(tile_size) + 0.5,
+                      tile_size - np.arange(tile_size) - 0.5)
+    ramp = np.clip(dist / max(tile_overlap, 1), 0.0, 1.0)
+
+    return np.outer(ramp, ramp)[:, :, np.newaxis].astype(np.float32)
+
+  def _build_tiled(self):
+    # shares the transform_net variables, any tile size can be fed. The
+    # norm statistics are taken once over the whole (downscaled) image and
+    # fed to every tile, so all the tiles are normalized alike
+    self.stats_img = tf.placeholder(tf.float32, [1, None, None,
+                                                 self.content_img_channels])
+    self.model_transform.run(
+        self.stats_img,
+        reuse=True,
+        style_weights=self._get_batch_style_weights(self.stats_img),
+        per_sample_norm=True)
+    self.norm_stats = list(self.model_transform.norm_stats)
+    self.tile_norm_stats = [
+        (tf.placeholder(tf.float32, mean.get_shape()),
+         tf.placeholder(tf.float32, variance.get_shape()))
+        for mean, variance in self.norm_stats]
+
+    self.tile_img = tf.placeholder(tf.float32, [None, None, None,
+                                                self.content_img_channels])
+    self.tile_noise_img = self.model_transform.run(
+        self.tile_img,
+        reuse=True,
+        style_weights=self._get_batch_style_weights(self.tile_img),
+        per_sample_norm=True,
+        norm_stats=self.tile_norm_stats)
+    self.tile_noise_img = (self.tile_noise_img + 1) * 127.5
+    if self.model_name == 'vgg19':
+      self.tile_noise_img = self.tile_noise_img - self.vgg_means
+
+  def _get_norm_stats_feed(self, sess, content_img, stats_size, style=None):
+    # statistics of the whole image, downscaled so its longest side is at
+    # most stats_size
+    height, width = content_img.shape[:2]
+    if max(height, width) > stats_size:
+      scale = float(stats_size) / max(height, width)
+      content_img = cv2.resize(content_img,
+                               (max(int(round(width * scale)), 1),
+                                max(int(round(height * scale)), 1)),
+                               interpolation=cv2.INTER_AREA)
+      if content_img.ndim == 2:
+        content_img = content_img[:, :, np.newaxis]
+
+    feed_dict = {self.stats_img: content_img[np.newaxis]}
+    feed_dict.update(self._get_style_feed(0, style))
+    norm_stats = sess.run(self.norm_stats, feed_dict=feed_dict)
+
+    feed_dict = {}
+    for (mean, variance), (mean_value, variance_value) \
+        in zip(self.tile_norm_stats, norm_stats):
+      feed_dict[mean] = mean_value
+      feed_dict[variance] = variance_value
+
+    return feed_dict
+
+  def _run_tiled(self, sess, content_img, tile_size, tile_overlap,
+                 tile_batch_size, style=None, tile_stats_size=1024):
+    # the transform_net downsamples twice by 2
+    if tile_size % 4 != 0:
+      raise ValueError('tile_size must be a multiple of 4')
+    if not 0 <= tile_overlap < tile_size:
+      raise ValueError('tile_overlap must be in [0, tile_size)')
+
+    height, width = content_img.shape[:2]
+    # reflect pad so the image borders are blended like the inner seams
+    pad = tile_overlap // 2
+    img = np.pad(content_img,
+                 ((pad, pad + max(tile_size - height - 2 * pad, 0)),
+                  (pad, pad + max(tile_size - width - 2 * pad, 0)),
+                  (0, 0)),
+                 mode='reflect')
+
+    norm_stats_feed = self._get_norm_stats_feed(sess, content_img,
+                                                tile_stats_size, style)
+    weights = self._get_feather_weights(tile_size, tile_overlap)
+    out_img = np.zeros(img.shape, np.float32)
+    out_weights = np.zeros(img.shape[:2] + (1,), np.float32)
+    tiles = [(y, x)
+             for y in self._get_tile_starts(img.shape[0], tile_size, tile_overlap)
+             for x in self._get_tile_starts(img.shape[1], tile_size, tile_overlap)]
+    for b in range(0, len(tiles), tile_batch_size):
+      batch = tiles[b:b + tile_batch_size]
+      feed_dict = {self.tile_img: np.array([img[y:y + tile_size,
+                                                x:x + tile_size]
+                                            for y, x in batch])}
+      feed_dict.update(self._get_style_feed(0, style))
+      feed_dict.update(norm_stats_feed)
+      out_tiles = sess.run(self.tile_noise_img, feed_dict=feed_dict)
+      for (y, x), out_tile in zip(batch, out_tiles):
+        out_img[y:y + tile_size, x:x + tile_size] += out_tile * weights
+        out_weights[y:y + tile_size, x:x + tile_size] += weights
+
+    out_img = out_img / out_weights
+
+    return out_img[pad:pad + height, pad:pad + width]
+
   def _get_total_variation_loss(self, noise_img):
     tv_loss = tf.reduce_sum(tf.image.total_variation(noise_img))
 
     return tv_loss
 
+  def _get_device_fn(self):
+    # the transform_net and adam variables live on the ps tasks. The vgg19
+    # weights and the style grams never change, every worker keeps its own
+    # copy instead of reading them from the ps on every step
+    ps_device_fn = tf.train.replica_device_setter(
+        worker_device='/job:worker/task:%d' % self.task_index,
+        cluster=tf.train.ClusterSpec({'ps': self.ps_hosts,
+                                      'worker': self.worker_hosts}))
+
+    def device_fn(op):
+      if op.type in ['Variable', 'VariableV2'] \
+          and (op.name.startswith('vgg19/') or op.name.startswith('style_gram_')):
+        return '/job:worker/task:%d' % self.task_index
+
+      return ps_device_fn(op)
+
+    return device_fn
+
   def build(self):
     tf.reset_default_graph()
-    self.model_transform = TransformNet()
+    self.model_transform = TransformNet(num_styles=self.num_styles)
 
+    # VGG19 reads its weights with a local session, so it is created
+    # outside the cluster device scope
     if self.model_name == 'vgg19':
       self.model = VGG19(tensorflow_model_path=self.tensorflow_model_path)
 
-    self.content_img_transform = tf.placeholder(tf.float32, [None, self.content_img_height,
-                self.content_img_width, self.content_img_channels])
+    if self.job_name == 'worker':
+      with tf.device(self._get_device_fn()):
+        self._build_graph()
+    else:
+      self._build_graph()
+
+  def _build_graph(self):
+    # free spatial dims, a new content size does not need a rebuild
+    self.content_img_transform = tf.placeholder(tf.float32, [None, None, None,
+                self.content_img_channels])
     self.content_img_vgg = tf.placeholder(tf.float32, [None, self.content_img_height,
                 self.content_img_width, self.content_img_channels])
     self.style_img = tf.placeholder(tf.float32, [None, self.style_img_height,
                 self.style_img_width, self.style_img_channels])
 
-    self.noise_img = self.model_transform.run(self.content_img_transform)
+    self.train_files, self.train_iterator_init, self.train_batch = \
+        Dataset(self.data_path).build_train_pipeline(
+            self.batch_size,
+            self.content_img_height,
+            self.content_img_width,
+            num_parallel_calls=self.num_parallel_calls)
+
+    # multi-style: the style weights of the batch and, in training, the
+    # style whose grams are the target
+    if self.num_styles:
+      self.style_weights = tf.placeholder(tf.float32, [self.num_styles])
+      self.style_idx = tf.placeholder(tf.int32, [])
+
+    self.noise_img = self.model_transform.run(
+        self.content_img_transform,
+        style_weights=self._get_batch_style_weights(self.content_img_transform))
     self.noise_img = (self.noise_img + 1) * 127.5 # denormalize img from transform_net
 
     self.total_variation_loss = self._get_total_variation_loss(self.noise_img)
@@ -125,20 +386,50 @@ class StyleTransfer():
     if self.model_name == 'vgg19':
       self.noise_img = self.noise_img - self.vgg_means # normalize img for vgg19
 
+    content_layers = self.model.run_layers(self.content_img_vgg,
+                                           self.content_layers)
+    style_layers = self.model.run_layers(self.style_img, self.style_layers)
+    noise_layers = self.model.run_layers(self.noise_img,
+                                         self.content_layers + self.style_layers)
+
     self.content_loss = tf.constant(0.0)
     for content_layer_name in self.content_layers:
-      content_layer = self.model.run(self.content_img_vgg, content_layer_name)
-      noise_layer = self.model.run(self.noise_img, content_layer_name)
+      content_layer = content_layers[content_layer_name]
+      noise_layer = noise_layers[content_layer_name]
       self.content_loss = self.content_loss \
                           + self._get_content_loss(content_layer, noise_layer)
 
+    # the style image never changes, its grams are evaluated once in train
+    # and kept in local (non-checkpointed) variables
+    self.style_grams = {}
+    self.style_grams_var = {}
     self.style_loss = tf.constant(0.0)
     for i, style_layer_name in enumerate(self.style_layers):
-      style_layer = self.model.run(self.style_img, style_layer_name)
-      noise_layer = self.model.run(self.noise_img, style_layer_name)
+      style_layer = style_layers[style_layer_name]
+      noise_layer = noise_layers[style_layer_name]
+      style_layer_shape = style_layer.get_shape().as_list()
+
+      self.style_grams[style_layer_name] = self._get_gram_matrix(style_layer)
+      self.style_grams_var[style_layer_name] = tf.get_variable(
+          name='style_gram_' + style_layer_name,
+          shape=([self.num_styles] if self.num_styles else [])
+                + [style_layer_shape[3], style_layer_shape[3]],
+          initializer=tf.zeros_initializer(),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES])
+      style_gram = self.style_grams_var[style_layer_name]
+      if self.num_styles:
+        style_gram = tf.gather(style_gram, self.style_idx)
+
+      # the noise gram is taken over the whole flattened batch, so the
+      # target is the single style image gram repeated batch_size times
       self.style_loss = self.style_loss \
                           + tf.scalar_mul(self.style_layers_w[i],
-                                self._get_style_loss(style_layer, noise_layer))
+                                self._get_style_loss(
+                                    tf.cast(tf.shape(noise_layer)[0], tf.float32)
+                                    * style_gram,
+                                    style_layer_shape,
+                                    noise_layer))
 
     self.total_loss = self.alfa * self.content_loss \
                       + self.beta * self.style_loss \
@@ -147,8 +438,22 @@ class StyleTransfer():
     var_list = tf.trainable_variables()
     self.var_list = [var for var in var_list if 'transform_net' in var.name]
 
-    self.optim = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
-        name='adam_optimizer').minimize(self.total_loss, var_list=self.var_list)
+    adam = tf.train.AdamOptimizer(learning_rate=self.learning_rate,
+                                  name='adam_optimizer')
+    if self.job_name == 'worker':
+      # synchronous: the gradients of all the workers are averaged before
+      # one update, the same as a single process with a batch of
+      # batch_size * len(worker_hosts)
+      self.global_step = tf.train.get_or_create_global_step()
+      self.sync_optim = tf.train.SyncReplicasOptimizer(
+          adam,
+          replicas_to_aggregate=len(self.worker_hosts),
+          total_num_replicas=len(self.worker_hosts))
+      self.optim = self.sync_optim.minimize(self.total_loss,
+                                            var_list=self.var_list,
+                                            global_step=self.global_step)
+    else:
+      self.optim = adam.minimize(self.total_loss, var_list=self.var_list)
 
     tf.summary.scalar('content_loss', self.content_loss)
     tf.summary.scalar('style_loss', self.style_loss)
@@ -158,9 +463,7 @@ class StyleTransfer():
     tf.summary.histogram("noise_img", self.noise_img)
 
     self.decoded_img = tf.placeholder(tf.uint8,
-                                      [self.content_img_height,
-                                       self.content_img_width,
-                                       self.content_img_channels])
+                                      [None, None, self.content_img_channels])
     self.name_file = tf.placeholder(tf.string)
 
     self.encoded_img = tf.image.encode_png(self.decoded_img)
@@ -168,79 +471,80 @@ class StyleTransfer():
 
     self.file_bytes = tf.read_file(self.name_file)
 
-    self.pickle_file = tf.placeholder(tf.string)
-    self.fwrite_pickle = tf.write_file(self.name_file, self.pickle_file)
-
   def train(self,
             style_img_path='images/style/style1.jpg',
             output_img_path='results/plfrtst',
             tensorboard_path='tensorboard/tensorboard_plfrtst',
             model_path='models',
             resume=False,
-            checkpoints_path='checkpoints'):
+            checkpoints_path='checkpoints',
+            cache_path='cache'):
     saver = tf.train.Saver()
     summ = tf.summary.merge_all()
     with tf.Session() as sess:
       if resume == True:
-        model_path_pickle = pickle.loads(sess.run(self.file_bytes,
-            feed_dict={self.name_file: checkpoints_path + '/model_path.pkl'}))
-        saver.restore(sess, model_path_pickle)
-
-        ut = pickle.loads(sess.run(self.file_bytes,
-            feed_dict={self.name_file: checkpoints_path + '/utils.pkl'}))
-        ep = pickle.loads(sess.run(self.file_bytes,
-            feed_dict={self.name_file: checkpoints_path + '/epoch.pkl'}))
-        i = pickle.loads(sess.run(self.file_bytes,
-            feed_dict={self.name_file: checkpoints_path + '/iteration.pkl'})) + 1
+        manifest = self._load_manifest(sess, checkpoints_path)
+        saver.restore(sess, manifest['model_path'])
+
+        ut = Utils(data_path=self.data_path, seed=manifest['sampler']['seed'])
+        ut.ds.sampler.set_state(manifest['sampler'])
+        ep = manifest['epoch']
+        i = manifest['iteration'] + 1
       else:
         sess.run(tf.global_variables_initializer())
-        ut = Utils(data_path=self.data_path)
+        ut = Utils(data_path=self.data_path, seed=self.seed)
         ep = 0
         i = 0
+      sess.run(tf.local_variables_initializer())
+      self.async_writer = AsyncWriter()
 
       writer = tf.summary.FileWriter(tensorboard_path)
       writer.add_graph(sess.graph)
 
-      y_batch = []
-      style_img_bytes = sess.run(self.file_bytes,
-          feed_dict={self.name_file: style_img_path})
-      style_img_np = np.fromstring(style_img_bytes, np.uint8)
-      for _ in range(self.batch_size):
-        y_batch.append(ut.get_img(style_img_np,
-                                  width=self.style_img_width,
-                                  height=self.style_img_height))
-      y_batch = np.array(y_batch).astype(np.float32)
+      style_imgs_bytes, style_imgs = self._read_style_imgs(sess, ut,
+                                                           style_img_path)
+      self._load_style_grams(sess, ut, style_imgs_bytes, style_imgs, cache_path)
 
       while ep < self.no_epochs:
-        if resume == False: # if resume=True use ut from the last checkpoint
-          ut = Utils(data_path=self.data_path) # shuffle data every epoch
+        if resume == False: # if resume=True keep the restored position
+          ut.ds.sampler.set_epoch(ep) # new permutation every epoch
         else:
           resume = False
+        # the pipeline yields the batches in the order of next_batch_train,
+        # which is still called for the epoch/resume bookkeeping. Prebuilt
+        # shards (Dataset.build_dataset_shards) replace it when present
+        use_shards = ut.ds.has_shards()
+        if not use_shards:
+          sess.run(self.train_iterator_init,
+                   feed_dict={self.train_files: ut.ds.get_train_files()})
+        data_wait = 0.0
+        ep_steps = 0
         while True:
           x_batch_transform_name, batch_end = ut.next_batch_train(self.batch_size)
-          x_batch_transform = []
-          for x in x_batch_transform_name:
-            content_img_bytes = sess.run(self.file_bytes,
-              feed_dict={self.name_file: x})
-            content_img_np = np.fromstring(content_img_bytes, np.uint8)
-            x_img = ut.get_img(content_img_np,
-                               width=self.content_img_width,
-                               height=self.content_img_height,
-                               model='transform_net')
-            x_batch_transform.append(x_img)
-          x_batch_transform = np.array(x_batch_transform).astype(np.float32)
+          if batch_end == True: # end of epoch
+            break
+
+          data_start_time = time.time()
+          if use_shards:
+            x_batch_transform = ut.ds.get_train_imgs(x_batch_transform_name,
+                                                     self.content_img_height,
+                                                     self.content_img_width)
+          else:
+            x_batch_transform = sess.run(self.train_batch)
+          step_data_wait = time.time() - data_start_time
+          data_wait = data_wait + step_data_wait
+          ep_steps = ep_steps + 1
 
           x_batch_vgg = ut.normalize_img(ut.denormalize_img(x_batch_transform,
                                                             model='transform_net'))
-          if batch_end == True: # end of epoch
-            break
 
+          feed_dict = {self.content_img_transform: x_batch_transform,
+                       self.content_img_vgg: x_batch_vgg}
+          feed_dict.update(self._get_style_feed(i))
           _, content_loss, style_loss, tv_loss, out_loss =  sess.run(
                 [self.optim, self.content_loss, self.style_loss, self.total_variation_loss,
                  self.total_loss],
-                 feed_dict={self.content_img_transform: x_batch_transform,
-                            self.content_img_vgg: x_batch_vgg,
-                            self.style_img: y_batch})
+                 feed_dict=feed_dict)
 
           print('ep', ep)
           print('it: ', i)
@@ -263,54 +567,191 @@ class StyleTransfer():
               x_batch_transform.append(x_img)
             x_batch_transform = np.array(x_batch_transform).astype(np.float32)
 
-            out_img = sess.run(self.noise_img,
-                               feed_dict={self.content_img_transform: x_batch_transform})
-
-            decoded_img = ut.denormalize_img(out_img[0])
-            decoded_img = cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB)
-            sess.run(self.fwrite,
-                   feed_dict={self.decoded_img: decoded_img,
-                              self.name_file: output_img_path + '/img' + str(i) + '.png'})
-
-            decoded_img = ut.denormalize_img(x_batch_transform[0], model='transform_net')
-            decoded_img = cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB)
-            sess.run(self.fwrite,
-                   feed_dict={self.decoded_img: decoded_img,
-                              self.name_file: output_img_path + '/img' + str(i) + 'o.png'})
-
-            s = sess.run(summ,
-                         feed_dict={self.content_img_transform: x_batch_transform,
-                                    self.content_img_vgg: x_batch_vgg,
-                                    self.style_img: y_batch})
+            feed_dict = {self.content_img_transform: x_batch_transform}
+            feed_dict.update(self._get_style_feed(i))
+            out_img = sess.run(self.noise_img, feed_dict=feed_dict)
+
+            self.async_writer.write_img(
+                output_img_path + '/img' + str(i) + '.png',
+                ut.denormalize_img(out_img[0]))
+            self.async_writer.write_img(
+                output_img_path + '/img' + str(i) + 'o.png',
+                ut.denormalize_img(x_batch_transform[0], model='transform_net'))
+
+            feed_dict[self.content_img_vgg] = x_batch_vgg
+            s = sess.run(summ, feed_dict=feed_dict)
             writer.add_summary(s, i)
+            writer.add_summary(self.async_writer.get_summary(), i)
+            writer.add_summary(tf.Summary(value=[tf.Summary.Value(
+                tag='data_wait_ms', simple_value=step_data_wait * 1000.0)]), i)
 
           if i % 5000 == 0:
             saver.save(sess, model_path + '/model_freeze_' + str(ep) + '_' + str(i)  + '_.ckpt')
             model_path_pickle_save = model_path + '/model_freeze_' + str(ep) + '_' + str(i)  + '_.ckpt'
-            sess.run(self.fwrite_pickle,
-                feed_dict={self.name_file: checkpoints_path + '/model_path.pkl',
-                           self.pickle_file: pickle.dumps(model_path_pickle_save)})
-            sess.run(self.fwrite_pickle,
-                feed_dict={self.name_file: checkpoints_path + '/utils.pkl',
-                           self.pickle_file: pickle.dumps(ut)})
-            sess.run(self.fwrite_pickle,
-                feed_dict={self.name_file: checkpoints_path + '/epoch.pkl',
-                           self.pickle_file: pickle.dumps(ep)})
-            sess.run(self.fwrite_pickle,
-                feed_dict={self.name_file: checkpoints_path + '/iteration.pkl',
-                           self.pickle_file: pickle.dumps(i)})
+            # pickled here so the manifest matches the saved weights, the
+            # write itself happens in the background
+            self.async_writer.write_atomic(
+                checkpoints_path + '/manifest.pkl',
+                pickle.dumps({'model_path': model_path_pickle_save,
+                              'sampler': ut.ds.sampler.get_state(),
+                              'epoch': ep,
+                              'iteration': i}))
 
           i = i + 1
+        print('ep %d: %.1f ms data wait per step on average'
+              % (ep, data_wait * 1000.0 / max(ep_steps, 1)))
         ep = ep + 1
       saver.save(sess, model_path + '/model_freeze.ckpt')
+      self.async_writer.close()
+      print('Blocked on snapshot/checkpoint writes: %.2f s'
+            % self.async_writer.blocked_time)
+
+  def train_distributed(self,
+            style_img_path='images/style/style1.jpg',
+            tensorboard_path='tensorboard/tensorboard_plfrtst',
+            checkpoints_path='checkpoints',
+            cache_path='cache',
+            max_steps=None):
+    # between-graph replication, every ps and worker process calls this
+    # with its own job_name and task_index. The chief (worker 0) initializes
+    # the shared variables and writes the summaries and the checkpoints
+    cluster = tf.train.ClusterSpec({'ps': self.ps_hosts,
+                                    'worker': self.worker_hosts})
+    num_workers = len(self.worker_hosts)
+    # the local workers share the cores, the device filters keep a worker
+    # from waiting on the other workers when it starts
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=max(multiprocessing.cpu_count()
+                                         // num_workers, 1),
+        inter_op_parallelism_threads=2,
+        device_filters=['/job:ps', '/job:worker/task:%d' % self.task_index])
+    server = tf.train.Server(cluster,
+                             job_name=self.job_name,
+                             task_index=self.task_index,
+                             config=config)
+    if self.job_name == 'ps':
+      server.join()
+      return
+
+    is_chief = self.task_index == 0
+    ut = Utils(data_path=self.data_path, seed=self.seed)
+    ut.ds.sampler.set_shard(self.task_index, num_workers)
+    # one global step takes a batch from every worker, the same number of
+    # steps per epoch on all of them keeps the shards in step
+    steps_per_epoch = max(len(ut.ds.get_train_batch())
+                          // num_workers // self.batch_size - 1, 1)
+    if max_steps is None:
+      max_steps = self.no_epochs * steps_per_epoch
+
+    # the vgg19 weights are on the worker devices, each worker initializes
+    # its own once the chief has initialized the shared variables
+    vgg_vars = [var for var in tf.global_variables()
+                if var.op.name.startswith('vgg19/')]
+    shared_vars = [var for var in tf.global_variables()
+                   if not var.op.name.startswith('vgg19/')]
+    scaffold = tf.train.Scaffold(
+        ready_for_local_init_op=tf.report_uninitialized_variables(shared_vars),
+        local_init_op=tf.group(tf.local_variables_initializer(),
+                               tf.variables_initializer(vgg_vars)))
+    hooks = [self.sync_optim.make_session_run_hook(is_chief),
+             tf.train.StopAtStepHook(last_step=max_steps)]
+    summ = tf.summary.merge_all()
+
+    # the summaries need the placeholders fed, they are run in the train
+    # step below instead of by a SummarySaverHook
+    with tf.train.MonitoredTrainingSession(master=server.target,
+                                           is_chief=is_chief,
+                                           checkpoint_dir=checkpoints_path,
+                                           scaffold=scaffold,
+                                           hooks=hooks,
+                                           save_summaries_steps=None,
+                                           save_summaries_secs=None,
+                                           config=config) as sess:
+      if is_chief:
+        writer = tf.summary.FileWriter(tensorboard_path)
+
+      style_imgs_bytes, style_imgs = self._read_style_imgs(sess, ut,
+                                                           style_img_path)
+      self._load_style_grams(sess, ut, style_imgs_bytes, style_imgs, cache_path)
+
+      use_shards = ut.ds.has_shards()
+      # the start position in the data stream follows from the global step,
+      # a restored checkpoint resumes where it stopped. After that every
+      # worker moves through its shard at its own pace: the sync optimizer
+      # can take more than one gradient per global step from a fast worker
+      step = sess.run(self.global_step)
+      start_step = step
+      ep = step // steps_per_epoch
+      ut.ds.sampler.set_state({
+          'seed': self.seed,
+          'epoch': ep,
+          'position': step % steps_per_epoch * self.batch_size})
+      if not use_shards:
+        sess.run(self.train_iterator_init,
+                 feed_dict={self.train_files: ut.ds.get_train_files()})
+      local_steps = 0
+      start_time = time.time()
+      last_log_time = start_time
+      while not sess.should_stop():
+        x_batch_transform_name, batch_end = ut.next_batch_train(self.batch_size)
+        if batch_end == True: # end of this worker's shard, next permutation
+          ep = ep + 1
+          ut.ds.sampler.set_epoch(ep)
+          if not use_shards:
+            sess.run(self.train_iterator_init,
+                     feed_dict={self.train_files: ut.ds.get_train_files()})
+          continue
+
+        if use_shards:
+          x_batch_transform = ut.ds.get_train_imgs(x_batch_transform_name,
+                                                   self.content_img_height,
+                                                   self.content_img_width)
+        else:
+          x_batch_transform = sess.run(self.train_batch)
+        x_batch_vgg = ut.normalize_img(ut.denormalize_img(x_batch_transform,
+                                                          model='transform_net'))
+
+        fetches = [self.optim, self.global_step, self.total_loss]
+        if is_chief and step % 100 == 0:
+          fetches = fetches + [summ]
+        feed_dict = {self.content_img_transform: x_batch_transform,
+                     self.content_img_vgg: x_batch_vgg}
+        feed_dict.update(self._get_style_feed(step))
+        results = sess.run(fetches, feed_dict=feed_dict)
+        if len(results) == 4:
+          writer.add_summary(results[3], step)
+        step = results[1]
+        local_steps = local_steps + 1
+
+        now = time.time()
+        if now - last_log_time >= 10.0:
+          last_log_time = now
+          print('worker %d, ep %d, step %d, total loss %f, %.2f images/s'
+                % (self.task_index, ep, step, results[2],
+                   local_steps * self.batch_size / (now - start_time)))
+
+      elapsed = time.time() - start_time
+      if is_chief:
+        writer.close()
+        # every global step is one batch from each worker
+        print('Throughput: %.2f images/s with %d workers'
+              % ((step - start_step) * self.batch_size * num_workers
+                 / max(elapsed, 1e-6), num_workers))
 
   def predict(self,
             content_img_path='images/content/content1.jpg',
             output_img_path='results/plfrtst_predict',
             model_path='models/model_freeze.ckpt',
-            show_img=None):
+            show_img=None,
+            tile_size=None,
+            tile_overlap=32,
+            tile_batch_size=4,
+            tile_stats_size=1024,
+            style=None):
     saver = tf.train.Saver()
     summ = tf.summary.merge_all()
+    if tile_size:
+      self._build_tiled()
     with tf.Session() as sess:
       saver.restore(sess, model_path)
       ut = Utils(data_path=self.data_path)
@@ -327,8 +768,15 @@ class StyleTransfer():
                                            self.content_img_width,
                                            self.content_img_channels))
 
-      out_img = sess.run(self.noise_img,
-                         feed_dict={self.content_img_transform: content_img})
+      if tile_size:
+        out_img = self._run_tiled(sess, content_img[0], tile_size,
+                                  tile_overlap, tile_batch_size,
+                                  style=style,
+                                  tile_stats_size=tile_stats_size)[np.newaxis]
+      else:
+        feed_dict = {self.content_img_transform: content_img}
+        feed_dict.update(self._get_style_feed(0, style))
+        out_img = sess.run(self.noise_img, feed_dict=feed_dict)
 
       decoded_img = ut.denormalize_img(out_img[0])
       decoded_img = cv2.cvtColor(decoded_img, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+import numpy as np
+import tensorflow as tf
+from collections import OrderedDict
+
+try:
+  from perceptual_losses_for_real_time_style_transfer.stylizer import Stylizer, decode_img
+except ImportError: #gcloud
+  from stylizer import Stylizer, decode_img
+
+class ModelRegistry():
+  # style name -> Stylizer, loaded on first use. Past max_models or
+  # max_bytes the least recently used styles are dropped, and a style whose
+  # checkpoint files changed is reloaded on its next use. The restores run
+  # outside the lock, one at a time per style, so the loaded styles and
+  # the stats stay available meanwhile.
+  # models_path is a directory of checkpoints/frozen graphs or a dict of
+  # style name -> model path
+  def __init__(self,
+      models_path='models_freeze',
+      default_style=None,
+      max_models=None,
+      max_bytes=None,
+      reload_interval=1.0,
+      **stylizer_kwargs):
+    self.models_path = models_path
+    self.max_models = max_models
+    self.max_bytes = max_bytes
+    self.reload_interval = reload_interval
+    self.stylizer_kwargs = stylizer_kwargs
+
+    self.model_paths = self._get_model_paths()
+    self.default_style = default_style or sorted(self.model_paths)[0]
+
+    self.lock = threading.Lock()
+    self.load_locks = {}
+    self.models = OrderedDict()
+    self.num_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.reloads = 0
+    self.evictions = 0
+    self.load_times = []
+
+  def get_style_name(self, model_path):
+    name = os.path.basename(model_path)
+    for ext in ['.pb', '.ckpt']:
+      if name.endswith(ext):
+        name = name[:-len(ext)]
+
+    return name
+
+  def _get_model_paths(self):
+    if isinstance(self.models_path, dict):
+      return dict(self.models_path)
+
+    model_paths = {}
+    for name in tf.gfile.ListDirectory(self.models_path):
+      if name.endswith('.ckpt.index'):
+        model_path = self.models_path + '/' + name[:-len('.index')]
+      elif name.endswith('.pb'):
+        model_path = self.models_path + '/' + name
+      else:
+        continue
+      model_paths[self.get_style_name(model_path)] = model_path
+
+    return model_paths
+
+  def _get_files(self, model_path):
+    if model_path.endswith('.pb'):
+      return [model_path]
+
+    return sorted(tf.gfile.Glob(model_path + '.*'))
+
+  def _get_version(self, model_path):
+    return tuple((f, tf.gfile.Stat(f).mtime_nsec)
+                 for f in self._get_files(model_path))
+
+  def _get_num_bytes(self, model_path):
+    # resident weights, the checkpoints also hold VGG19 and Adam variables
+    if model_path.endswith('.pb'):
+      return tf.gfile.Stat(model_path).length
+
+    return sum(4 * int(np.prod(shape))
+               for name, shape in tf.train.list_variables(model_path)
+               if name.startswith('transform_net/'))
+
+  def _load(self, style):
+    model_path = self.model_paths[style]
+    version = self._get_version(model_path)
+
+    start_time = time.time()
+    stylizer = Stylizer(model_path=model_path, **self.stylizer_kwargs)
+
+    return {'stylizer': stylizer,
+            'version': version,
+            'num_bytes': self._get_num_bytes(model_path),
+            'checked': time.time(),
+            'load_time': time.time() - start_time}
+
+  def _evict(self):
+    # the evicted session is not closed here, a request may still be using
+    # it, it is released with its last reference
+    while len(self.models) > 1 \
+          and ((self.max_models is not None
+                and len(self.models) > self.max_models)
+               or (self.max_bytes is not None
+                   and self.num_bytes > self.max_bytes)):
+      _, entry = self.models.popitem(last=False)
+      self.num_bytes -= entry['num_bytes']
+      self.evictions += 1
+
+  def _check_style(self, style):
+    # called with the lock held
+    if style not in self.model_paths:
+      self.model_paths = self._get_model_paths()
+      if style not in self.model_paths:
+        raise KeyError('Unknown style ' + style)
+
+  def check_style(self, style=None):
+    # raises KeyError for an unknown style, never loads a model
+    with self.lock:
+      self._check_style(style or self.default_style)
+
+  def get(self, style=None):
+    style = style or self.default_style
+    with self.lock:
+      self._check_style(style)
+
+      entry = self.models.get(style)
+      if entry is not None and time.time() - entry['checked'] > self.reload_interval:
+        entry['checked'] = time.time()
+        if self._get_version(self.model_paths[style]) != entry['version']:
+          del self.models[style]
+          self.num_bytes -= entry['num_bytes']
+          self.reloads += 1
+          entry = None
+
+      if entry is not None:
+        self.hits += 1
+        self.models.move_to_end(style)
+        return entry['stylizer']
+
+      self.misses += 1
+      load_lock = self.load_locks.setdefault(style, threading.Lock())
+
+    with load_lock:
+      with self.lock:
+        # loaded by another caller while this one waited
+        entry = self.models.get(style)
+        if entry is not None:
+          self.models.move_to_end(style)
+          return entry['stylizer']
+
+      entry = self._load(style)
+      with self.lock:
+        self.models[style] = entry
+        self.num_bytes += entry['num_bytes']
+        self.load_times.append(entry['load_time'])
+        self._evict()
+
+      return entry['stylizer']
+
+  def decode_img(self, img_bytes):
+    # resized like the stylizers will do, without touching the models
+    return decode_img(img_bytes,
+                      self.stylizer_kwargs.get('content_img_height'),
+                      self.stylizer_kwargs.get('content_img_width'),
+                      self.stylizer_kwargs.get('content_img_size'))
+
+  def get_stats(self):
+    with self.lock:
+      stats = {'styles': sorted(self.model_paths),
+               'loaded': list(self.models),
+               'num_bytes': self.num_bytes,
+               'hits': self.hits,
+               'misses': self.misses,
+               'hit_rate': self.hits / float(max(self.hits + self.misses, 1)),
+               'reloads': self.reloads,
+               'evictions': self.evictions}
+      if self.load_times:
+        stats['load_mean_s'] = float(np.mean(self.load_times))
+        stats['load_max_s'] = float(np.max(self.load_times))
+
+    return stats
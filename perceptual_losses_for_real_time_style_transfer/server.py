@@ -0,0 +1,164 @@
+import cv2
+import json
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+class MicroBatcher():
+  # one thread runs the sessions, concurrent requests are coalesced into
+  # batches of at most max_batch_size, waiting at most max_wait seconds
+  # after the first request of a batch. The styles come from a
+  # ModelRegistry, a batch runs once per style it contains
+  def __init__(self,
+      registry,
+      max_batch_size=8,
+      max_wait=0.01,
+      num_latencies=10000):
+    self.registry = registry
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.latencies = deque(maxlen=num_latencies)
+    self.batch_sizes = deque(maxlen=num_latencies)
+    self.num_requests = 0
+    self.num_errors = 0
+
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _next_batch(self):
+    batch = [self.queue.get()]
+    deadline = time.time() + self.max_wait
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self.queue.get(timeout=timeout))
+      except queue.Empty:
+        break
+
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      styles = {}
+      for req in batch:
+        styles.setdefault(req['style'], []).append(req)
+
+      for style, reqs in styles.items():
+        try:
+          stylizer = self.registry.get(style)
+          out_imgs = stylizer.stylize_imgs([req['img'] for req in reqs])
+          for req, out_img in zip(reqs, out_imgs):
+            req['out_img'] = out_img
+        except Exception as e:
+          for req in reqs:
+            req['error'] = e
+
+      end_time = time.time()
+      with self.lock:
+        self.batch_sizes.append(len(batch))
+        for req in batch:
+          self.latencies.append(end_time - req['start_time'])
+          self.num_requests += 1
+          self.num_errors += 'error' in req
+      for req in batch:
+        req['event'].set()
+
+  def submit(self, img, style=None):
+    req = {'img': img,
+           'style': style,
+           'start_time': time.time(),
+           'event': threading.Event()}
+    self.queue.put(req)
+    req['event'].wait()
+    if 'error' in req:
+      raise req['error']
+
+    return req['out_img']
+
+  def get_stats(self):
+    with self.lock:
+      latencies = np.array(self.latencies) * 1000.0
+      batch_sizes = np.array(self.batch_sizes)
+      stats = {'num_requests': self.num_requests,
+               'num_errors': self.num_errors,
+               'queue_depth': self.queue.qsize()}
+
+    if len(latencies):
+      for p in [50, 90, 99]:
+        stats['latency_p%d_ms' % p] = float(np.percentile(latencies, p))
+      stats['mean_batch_size'] = float(np.mean(batch_sizes))
+    stats['registry'] = self.registry.get_stats()
+
+    return stats
+
+class StylizeHandler(BaseHTTPRequestHandler):
+  # POST /stylize?style=<name> with the encoded image as body returns a
+  # png, GET /stats returns the latency percentiles, the queue depth and
+  # the registry hit rates and load times
+  def _send(self, code, body, content_type):
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _send_json(self, code, obj):
+    self._send(code, json.dumps(obj).encode('utf-8'), 'application/json')
+
+  def do_GET(self):
+    if self.path == '/stats':
+      self._send_json(200, self.server.batcher.get_stats())
+    else:
+      self._send_json(404, {'error': 'not found'})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    if url.path != '/stylize':
+      self._send_json(404, {'error': 'not found'})
+      return
+    style = parse_qs(url.query).get('style', [None])[0]
+
+    img_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    # only the batcher gets the models, so every request is counted once
+    # in the registry stats and no restore runs on this thread
+    try:
+      self.server.batcher.registry.check_style(style)
+    except KeyError as e:
+      self._send_json(404, {'error': str(e)})
+      return
+    try:
+      img = self.server.batcher.registry.decode_img(img_bytes)
+    except Exception as e:
+      self._send_json(400, {'error': str(e)})
+      return
+
+    try:
+      out_img = self.server.batcher.submit(img, style)
+    except Exception as e:
+      self._send_json(500, {'error': str(e)})
+      return
+
+    _, encoded_img = cv2.imencode('.png', out_img)
+    self._send(200, encoded_img.tobytes(), 'image/png')
+
+  def log_message(self, format, *args):
+    pass
+
+class StylizeServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, batcher, host='127.0.0.1', port=8000):
+    HTTPServer.__init__(self, (host, port), StylizeHandler)
+    self.batcher = batcher
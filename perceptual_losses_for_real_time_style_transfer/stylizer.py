@@ -0,0 +1,321 @@
+import cv2
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from multiprocessing.pool import ThreadPool
+
+from utils import Utils
+try:
+  from conv_nets.transform_net import TransformNet
+except ImportError: #gcloud
+  from transform_net import TransformNet
+
+def resize_img(img, height=None, width=None, size=None):
+  # a fixed size, the longest side or the original size
+  if height and width:
+    img = cv2.resize(img, (width, height))
+  elif size:
+    height, width = Utils().resize_with_ratio(height=img.shape[0],
+                                              width=img.shape[1],
+                                              size=size)
+    img = cv2.resize(img, (width, height))
+
+  return img
+
+def decode_img(img_bytes, height=None, width=None, size=None):
+  img = cv2.imdecode(np.fromstring(img_bytes, np.uint8), cv2.IMREAD_COLOR)
+  if img is None:
+    raise ValueError('Could not decode image')
+
+  return resize_img(img, height, width, size)
+
+class Stylizer():
+  # inference only: the graph holds the transform_net and the pre/post
+  # processing, uint8 BGR images in and out, no VGG19 and no losses.
+  # The spatial dims are free, images are padded to a shape bucket so
+  # mixed sizes still batch together and run without a rebuild.
+  # model_path is a training checkpoint or a graph written by export (.pb).
+  # A multi-style model takes a style index or blend vector, style is the
+  # default one
+  def __init__(self,
+      model_path='models_freeze/model_freeze_s1.ckpt',
+      content_img_height=None,
+      content_img_width=None,
+      content_img_size=None,
+      content_img_channels=3,
+      batch_size=4,
+      bucket_size=64,
+      num_threads=4,
+      style=None):
+    if bucket_size % 4 != 0:
+      raise ValueError('bucket_size must be a multiple of 4')
+
+    self.model_path = model_path
+    self.content_img_height = content_img_height
+    self.content_img_width = content_img_width
+    self.content_img_size = content_img_size
+    self.content_img_channels = content_img_channels
+    self.batch_size = batch_size
+    self.bucket_size = bucket_size
+    self.num_threads = num_threads
+    self.style = style
+
+    self.img_extensions = ['.jpg', '.jpeg', '.png', '.bmp']
+
+    self.graph = tf.Graph()
+    if self.model_path.endswith('.pb'):
+      self._load_frozen()
+    else:
+      self._build()
+
+  def _get_num_styles(self):
+    # the multi-style checkpoints have a scale per style in every norm
+    for name, shape in tf.train.list_variables(self.model_path):
+      if name == 'transform_net/conv1/StyleNorm/gamma':
+        return shape[0]
+
+    return None
+
+  def _build(self):
+    with self.graph.as_default():
+      self.model_transform = TransformNet(num_styles=self._get_num_styles())
+
+      self.content_img = tf.placeholder(tf.uint8,
+                                        [None, None, None,
+                                         self.content_img_channels],
+                                        name='content_img')
+      # 1 on the pixels of the image, 0 on the bucket padding
+      self.content_mask = tf.placeholder_with_default(
+          tf.ones_like(self.content_img[:, :, :, :1], dtype=tf.float32),
+          [None, None, None, 1],
+          name='content_mask')
+      self.style_weights = None
+      if self.model_transform.num_styles:
+        self.style_weights = tf.placeholder(tf.float32,
+                                            [None,
+                                             self.model_transform.num_styles],
+                                            name='style_weights')
+      img = tf.cast(self.content_img, tf.float32) / 127.5 - 1
+      # per image statistics over the unpadded pixels, the output does
+      # not depend on the other images of the batch or on the bucket
+      out_img = (self.model_transform.run(img,
+                     style_weights=self.style_weights,
+                     per_sample_norm=True,
+                     mask=self.content_mask) + 1) * 127.5
+      self.out_img = tf.cast(tf.clip_by_value(out_img, 0.0, 255.0), tf.uint8,
+                             name='out_img')
+
+      # the checkpoints also hold VGG19 and Adam variables, skip them
+      var_list = [var for var in tf.global_variables()
+                  if var.name.startswith('transform_net/')]
+      saver = tf.train.Saver(var_list=var_list)
+
+    self.sess = tf.Session(graph=self.graph)
+    saver.restore(self.sess, self.model_path)
+
+  def _load_frozen(self):
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(self.model_path, 'rb') as f:
+      graph_def.ParseFromString(f.read())
+
+    with self.graph.as_default():
+      self.content_img, self.out_img = tf.import_graph_def(
+          graph_def,
+          return_elements=['content_img:0', 'out_img:0'],
+          name='')
+
+      # graphs exported before the mask was added take no mask
+      self.content_mask = None
+      if 'content_mask' in [node.name for node in graph_def.node]:
+        self.content_mask = self.graph.get_tensor_by_name('content_mask:0')
+
+      self.style_weights = None
+      num_styles = None
+      if 'style_weights' in [node.name for node in graph_def.node]:
+        self.style_weights = self.graph.get_tensor_by_name('style_weights:0')
+        num_styles = self.style_weights.get_shape().as_list()[1]
+      self.model_transform = TransformNet(num_styles=num_styles)
+
+    self.sess = tf.Session(graph=self.graph)
+
+  def export(self, export_path):
+    # weights become constants and only the ops needed for out_img are
+    # kept, the summaries and the VGG19/Adam variables are dropped
+    graph_def = tf.graph_util.convert_variables_to_constants(
+        self.sess,
+        self.graph.as_graph_def(),
+        ['out_img'])
+
+    with tf.gfile.GFile(export_path, 'wb') as f:
+      f.write(graph_def.SerializeToString())
+
+  def close(self):
+    self.sess.close()
+
+  def get_img_paths(self, input_path):
+    # a directory, a glob or a manifest with one image path per line
+    if tf.gfile.IsDirectory(input_path):
+      return sorted([input_path + '/' + name
+                     for name in tf.gfile.ListDirectory(input_path)
+                     if os.path.splitext(name)[1].lower()
+                        in self.img_extensions])
+    elif any(c in input_path for c in '*?['):
+      return sorted(tf.gfile.Glob(input_path))
+    elif os.path.splitext(input_path)[1].lower() in self.img_extensions:
+      return [input_path]
+
+    with tf.gfile.GFile(input_path, 'r') as f:
+      lines = [line.strip() for line in f]
+      return [line for line in lines if line and not line.startswith('#')]
+
+  def read_img(self, img_path, skip_errors=False):
+    # with skip_errors an unreadable or undecodable file gives None and a
+    # warning instead of an exception
+    try:
+      with tf.gfile.GFile(img_path, 'rb') as f:
+        return self.decode_img(f.read())
+    except Exception as e:
+      if not skip_errors:
+        raise
+      print('Skipping %s: %s' % (img_path, e))
+
+      return None
+
+  def decode_img(self, img_bytes):
+    return decode_img(img_bytes,
+                      self.content_img_height,
+                      self.content_img_width,
+                      self.content_img_size)
+
+  def resize_img(self, img):
+    return resize_img(img,
+                      self.content_img_height,
+                      self.content_img_width,
+                      self.content_img_size)
+
+  def write_img(self, img_path, img):
+    _, encoded_img = cv2.imencode('.png', img)
+    with tf.gfile.GFile(img_path, 'wb') as f:
+      f.write(encoded_img.tobytes())
+
+  def stylize(self, imgs, style=None, masks=None):
+    feed_dict = {self.content_img: imgs}
+    if masks is not None and self.content_mask is not None:
+      feed_dict[self.content_mask] = masks
+    if self.style_weights is not None:
+      style_weights = self.model_transform.get_style_weights(
+          self.style if style is None else style)
+      feed_dict[self.style_weights] = np.tile(style_weights, (len(imgs), 1))
+    elif style is not None:
+      raise ValueError('Not a multi-style model: ' + self.model_path)
+
+    return self.sess.run(self.out_img, feed_dict=feed_dict)
+
+  def get_bucket(self, height, width):
+    return (-(-height // self.bucket_size) * self.bucket_size,
+            -(-width // self.bucket_size) * self.bucket_size)
+
+  def stylize_imgs(self, imgs, style=None):
+    # group the images by bucket, reflect pad them to it and crop the
+    # outputs back, the result keeps the order of imgs. The padding is
+    # masked out of the norm statistics, it only reaches the pixels whose
+    # receptive field crosses the right/bottom border
+    buckets = {}
+    for n, img in enumerate(imgs):
+      buckets.setdefault(self.get_bucket(img.shape[0], img.shape[1]),
+                         []).append(n)
+
+    out_imgs = [None] * len(imgs)
+    for (height, width), ns in buckets.items():
+      for b in range(0, len(ns), self.batch_size):
+        batch = ns[b:b + self.batch_size]
+        padded_imgs = np.array([np.pad(imgs[n],
+                                       ((0, height - imgs[n].shape[0]),
+                                        (0, width - imgs[n].shape[1]),
+                                        (0, 0)),
+                                       mode='reflect')
+                                for n in batch])
+        masks = np.zeros((len(batch), height, width, 1), np.float32)
+        for m, n in enumerate(batch):
+          masks[m, :imgs[n].shape[0], :imgs[n].shape[1]] = 1.0
+        for n, out_img in zip(batch, self.stylize(padded_imgs, style, masks)):
+          out_imgs[n] = out_img[:imgs[n].shape[0], :imgs[n].shape[1]]
+
+    return out_imgs
+
+  def get_output_names(self, img_paths):
+    # the file names, or the paths below the common directory when two
+    # inputs in different directories share a name (a/x.jpg, b/x.jpg)
+    names = [os.path.splitext(os.path.basename(img_path))[0] + '.png'
+             for img_path in img_paths]
+    if len(set(names)) == len(names):
+      return names
+
+    parts = [img_path.split('/') for img_path in img_paths]
+    n = 0
+    while all(len(p) > n + 1 and p[n] == parts[0][n] for p in parts):
+      n = n + 1
+    names = [os.path.splitext('/'.join(p[n:]))[0] + '.png' for p in parts]
+    if len(set(names)) != len(names):
+      duplicates = sorted(set(name for name in names if names.count(name) > 1))
+      raise ValueError('Several inputs map to the same output: '
+                       + ', '.join(duplicates))
+
+    return names
+
+  def stylize_paths(self, input_path, output_path):
+    img_paths = self.get_img_paths(input_path)
+    output_paths = [output_path + '/' + name
+                    for name in self.get_output_names(img_paths)]
+    batches = [list(range(b, min(b + self.batch_size, len(img_paths))))
+               for b in range(0, len(img_paths), self.batch_size)]
+    for output_dir in set(os.path.dirname(path) for path in output_paths):
+      if not tf.gfile.IsDirectory(output_dir):
+        tf.gfile.MakeDirs(output_dir)
+
+    def read(img_path):
+      return self.read_img(img_path, skip_errors=True)
+
+    read_pool = ThreadPool(self.num_threads)
+    write_pool = ThreadPool(self.num_threads)
+    start_time = time.time()
+    num_stylized = 0
+
+    # decode the next batch and write the previous one while the current
+    # one runs through the transform_net
+    try:
+      writes = []
+      next_imgs = read_pool.map_async(read,
+                                      [img_paths[n] for n in batches[0]]) \
+                  if batches else None
+      for b, batch in enumerate(batches):
+        imgs = next_imgs.get()
+        if b + 1 < len(batches):
+          next_imgs = read_pool.map_async(read,
+                                          [img_paths[n] for n in batches[b + 1]])
+
+        batch = [n for n, img in zip(batch, imgs) if img is not None]
+        imgs = [img for img in imgs if img is not None]
+        out_imgs = self.stylize_imgs(imgs)
+        num_stylized = num_stylized + len(out_imgs)
+
+        for write in writes:
+          write.get()
+        writes = [write_pool.apply_async(self.write_img,
+                                         (output_paths[n], out_img))
+                  for n, out_img in zip(batch, out_imgs)]
+      for write in writes:
+        write.get()
+    finally:
+      read_pool.close()
+      write_pool.close()
+      read_pool.join()
+      write_pool.join()
+
+    elapsed = time.time() - start_time
+    print('Stylized %d images in %.2f s, %.2f images/s, skipped %d'
+          % (num_stylized, elapsed, num_stylized / max(elapsed, 1e-6),
+             len(img_paths) - num_stylized))
+
+    return num_stylized, elapsed
@@ -0,0 +1,157 @@
+import cv2
+import queue
+import threading
+import time
+
+class VideoStylizer():
+  # decode thread -> batched transform_net -> encode thread, connected by
+  # bounded queues. With drop_frames the decoder skips the frames that do
+  # not fit in the queue, the encoder repeats the last stylized frame in
+  # their place, the dropped frames at the end included, so the output
+  # keeps the length and timing of the input
+  def __init__(self,
+      stylizer,
+      batch_size=4,
+      queue_size=16,
+      drop_frames=False,
+      fourcc='mp4v'):
+    self.stylizer = stylizer
+    self.batch_size = batch_size
+    self.queue_size = queue_size
+    self.drop_frames = drop_frames
+    self.fourcc = fourcc
+
+  def _decode(self, cap, frame, frames, stats):
+    try:
+      i = 0
+      while frame is not None:
+        frame = self.stylizer.resize_img(frame)
+        if self.drop_frames:
+          try:
+            frames.put_nowait((i, frame))
+          except queue.Full:
+            stats['dropped'] += 1
+        else:
+          frames.put((i, frame))
+        i += 1
+        ok, frame = cap.read()
+        if not ok:
+          break
+      stats['read'] = i
+    except Exception as e:
+      stats['error'] = e
+    finally:
+      frames.put(None)
+
+  def _encode(self, writer, out_frames, decode_stats, stats):
+    next_i = 0
+    last_frame = None
+    try:
+      while True:
+        item = out_frames.get()
+        if item is None:
+          # the decoder is done, its count of frames read is final
+          if last_frame is not None:
+            for _ in range(decode_stats['read'] - next_i):
+              writer.write(last_frame)
+              stats['repeated'] += 1
+          break
+        i, frame = item
+        for _ in range(i - next_i):
+          writer.write(last_frame if last_frame is not None else frame)
+          stats['repeated'] += 1
+        writer.write(frame)
+        last_frame = frame
+        next_i = i + 1
+        stats['written'] += 1
+    except Exception as e:
+      stats['error'] = e
+      # keep draining so the inference loop never blocks on a full queue
+      while out_frames.get() is not None:
+        pass
+
+  def _next_batch(self, frames):
+    item = frames.get()
+    if item is None:
+      return [], True
+
+    batch = [item]
+    while len(batch) < self.batch_size:
+      try:
+        item = frames.get(timeout=0.001)
+      except queue.Empty:
+        break
+      if item is None:
+        return batch, True
+      batch.append(item)
+
+    return batch, False
+
+  def stylize_video(self, video_path, output_video_path):
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+      raise ValueError('Could not open video ' + video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25.0
+    ok, frame = cap.read()
+    if not ok:
+      raise ValueError('No frames in video ' + video_path)
+    height, width = self.stylizer.resize_img(frame).shape[:2]
+
+    writer = cv2.VideoWriter(output_video_path,
+                             cv2.VideoWriter_fourcc(*self.fourcc),
+                             fps,
+                             (width, height))
+
+    frames = queue.Queue(maxsize=self.queue_size)
+    out_frames = queue.Queue(maxsize=self.queue_size)
+    decode_stats = {'read': 0, 'dropped': 0}
+    encode_stats = {'written': 0, 'repeated': 0}
+    decoder = threading.Thread(target=self._decode,
+                               args=(cap, frame, frames, decode_stats))
+    encoder = threading.Thread(target=self._encode,
+                               args=(writer, out_frames, decode_stats,
+                                     encode_stats))
+
+    start_time = time.time()
+    decoder.start()
+    encoder.start()
+    try:
+      done = False
+      while not done:
+        batch, done = self._next_batch(frames)
+        if not batch:
+          break
+        out_imgs = self.stylizer.stylize_imgs([frame for _, frame in batch])
+        for (i, _), out_img in zip(batch, out_imgs):
+          out_frames.put((i, out_img))
+    finally:
+      out_frames.put(None)
+      # unblock the decoder if inference stopped early
+      while decoder.is_alive():
+        try:
+          frames.get(timeout=0.1)
+        except queue.Empty:
+          pass
+      decoder.join()
+      encoder.join()
+      cap.release()
+      writer.release()
+
+    for stats in [decode_stats, encode_stats]:
+      if 'error' in stats:
+        raise stats['error']
+
+    elapsed = time.time() - start_time
+    stylized = encode_stats['written']
+    print('Read %d frames, stylized %d, dropped %d (repeated %d) in %.2f s, '
+          '%.2f fps (input %.2f fps)'
+          % (decode_stats['read'], stylized, decode_stats['dropped'],
+             encode_stats['repeated'], elapsed,
+             stylized / max(elapsed, 1e-6), fps))
+
+    return {'read': decode_stats['read'],
+            'stylized': stylized,
+            'dropped': decode_stats['dropped'],
+            'repeated': encode_stats['repeated'],
+            'elapsed': elapsed,
+            'fps': stylized / max(elapsed, 1e-6)}
@@ -1,5 +1,9 @@
 import cv2
+import hashlib
+import os
 import numpy as np
+import tensorflow as tf
+from io import BytesIO
 
 try:
   from perceptual_losses_for_real_time_style_transfer.dataset import Dataset
@@ -8,10 +12,11 @@ except ImportError: #gcloud
 
 class Utils():
   def __init__(self,
-        data_path=None):
+        data_path=None,
+        seed=0):
 
     if data_path is not None:
-      self.ds = Dataset(data_path)
+      self.ds = Dataset(data_path, seed=seed)
     self.vgg_means = [103.939, 116.779, 123.68] # BGR
 
   def next_batch_train(self, n_batch=None):
@@ -96,6 +101,47 @@ class Utils():
 
     return img
 
+  def get_cache_key(self, *parts):
+    # every part is length prefixed, (224, 224) and (2242, 24) must not
+    # hash to the same key
+    h = hashlib.sha1()
+    for part in parts:
+      if not isinstance(part, bytes):
+        part = repr(part).encode('utf-8')
+      h.update(str(len(part)).encode('utf-8') + b':')
+      h.update(part)
+
+    return h.hexdigest()
+
+  def load_cache(self, cache_path, key):
+    if cache_path is None:
+      return None
+
+    file_path = cache_path + '/' + key + '.npz'
+    if not tf.gfile.Exists(file_path):
+      return None
+
+    with tf.gfile.GFile(file_path, 'rb') as f:
+      data = np.load(BytesIO(f.read()))
+      return {k: data[k] for k in data.files}
+
+  def save_cache(self, cache_path, key, arrays):
+    if cache_path is None:
+      return
+
+    if not tf.gfile.IsDirectory(cache_path):
+      tf.gfile.MakeDirs(cache_path)
+
+    buf = BytesIO()
+    np.savez(buf, **arrays)
+
+    # write then rename, so concurrent runs never read a partial file
+    file_path = cache_path + '/' + key + '.npz'
+    tmp_path = file_path + '.' + str(os.getpid()) + '.tmp'
+    with tf.gfile.GFile(tmp_path, 'wb') as f:
+      f.write(buf.getvalue())
+    tf.gfile.Rename(tmp_path, file_path, overwrite=True)
+
   def show_img(self, img):
     cv2.namedWindow('image', cv2.WINDOW_NORMAL)
     cv2.imshow('image', img)